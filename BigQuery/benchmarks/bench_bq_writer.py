@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Benchmarks the crawler's BigQuery writers against a fake client that enforces the streaming insert limits
+# No GCP project or credentials are needed
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'meta_data_crawler'))
+import bq_meta_data_crawler as crawler_mod
+from fake_bigquery import FakeBigQueryClient, FakeInsertClient
+
+
+parser = argparse.ArgumentParser(description='Benchmark the crawler BigQuery writers with a fake client')
+parser.add_argument('--rows',            type=int,   help='Number of crawl rows to write', default=20000)
+parser.add_argument('--batch_size',      type=int,   help='Rows per insert request', default=500)
+parser.add_argument('--batch_bytes',     type=int,   help='Max bytes per insert request', default=9 * 1024 * 1024)
+parser.add_argument('--transient_rate',  type=float, help='Share of insert requests that fail with a 503', default=0.01)
+parser.add_argument('--reject',          type=int,   help='Number of rows the fake client rejects as invalid', default=3)
+
+
+def main():
+    args = parser.parse_args()
+
+    # build the rows with the crawler itself so they have the real shape
+    crawler_mod.client     = FakeBigQueryClient('bench', 1, args.rows, columns=2)
+    crawler_mod.count_incr = args.rows + 1
+    rows = list(crawler_mod.crawler('bench'))
+    reject_table_names = [row['table_name'] for row in rows[:args.reject]]
+    crawler_mod.output_bq_table = 'bench.meta.tables'
+
+    for mode in ['stream', 'load']:
+        fake_client = FakeInsertClient(transient_error_rate=args.transient_rate, reject_table_names=reject_table_names)
+        crawler_mod.client = fake_client
+        if mode == 'stream':
+            sink = crawler_mod.BigQuerySink(batch_size=args.batch_size, batch_bytes=args.batch_bytes)
+        else:
+            sink = crawler_mod.BigQueryLoadSink()
+
+        start = time.perf_counter()
+        crawler_mod.write_to_sink(sink, rows)
+        elapsed = time.perf_counter() - start
+
+        stored = len(fake_client.inserted.get(crawler_mod.output_bq_table, {}))
+        print('{:<6}  {:>7.2f}s  {} rows stored  {} insert calls  {} load calls  {} failed rows'.format(
+            mode, elapsed, stored, fake_client.insert_calls, fake_client.load_calls, len(getattr(sink, 'failed_rows', []))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Checks the crawler's bulk INFORMATION_SCHEMA engine builds the same rows as the per table API engine
+# on the synthetic project, then times both. Covers views, time & range partitioning, clustering, labels,
+# descriptions & nested, repeated & required columns
+# No GCP project or credentials are needed
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'meta_data_crawler'))
+import bq_meta_data_crawler as crawler_mod
+from fake_bigquery import FakeBigQueryClient
+
+
+parser = argparse.ArgumentParser(description='Compare the bulk & api crawl engines on a synthetic project')
+parser.add_argument('--datasets', type=int,   help='Number of datasets in the fake project', default=3)
+parser.add_argument('--tables',   type=int,   help='Number of tables per dataset', default=40)
+parser.add_argument('--columns',  type=int,   help='Number of top level columns in the fake tables', default=20)
+parser.add_argument('--nesting',  type=int,   help='How many levels deep the fake RECORD columns go', default=2)
+parser.add_argument('--latency',  type=float, help='Seconds each fake API call sleeps', default=0.002)
+parser.add_argument('--workers',  type=int,   help='Crawler worker threads', default=8)
+
+# a repeated record with required & nested repeated members, the synthetic schema has neither
+extra_fields = [{'name': 'events', 'type': 'RECORD', 'mode': 'REPEATED', 'fields': [
+                    {'name': 'event_id', 'type': 'STRING',  'mode': 'REQUIRED'},
+                    {'name': 'value',    'type': 'FLOAT',   'mode': 'NULLABLE'},
+                    {'name': 'params',   'type': 'RECORD',  'mode': 'REPEATED', 'fields': [
+                        {'name': 'key',  'type': 'STRING',  'mode': 'NULLABLE'},
+                        {'name': 'hits', 'type': 'INTEGER', 'mode': 'REPEATED'}]}]},
+                {'name': 'loaded_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED'}]
+
+
+def crawl(args, engine):
+    """
+    Crawl the fake project with one engine, the rows keyed by table name & the seconds it took
+    """
+    client = FakeBigQueryClient('bench', args.datasets, args.tables, args.columns, args.nesting, args.latency)
+    client.schema = client.schema + extra_fields
+    crawler_mod.client       = client
+    crawler_mod.governor     = crawler_mod.RequestGovernor(None, args.workers, 8)
+    crawler_mod.metrics      = crawler_mod.CrawlMetrics()
+    crawler_mod.crawl_filter = crawler_mod.CrawlFilter()
+    crawler_mod.count_incr   = 10 ** 9 # no progress lines
+    crawler_mod.bulk_regions = None
+
+    start = time.perf_counter()
+    rows = list(crawler_mod.bulk_crawler('bench') if engine == 'bulk' else crawler_mod.crawler('bench'))
+    seconds = time.perf_counter() - start
+
+    return {row.table_name: row for row in rows}, seconds, crawler_mod.governor.stats()['calls']
+
+
+def main():
+    args = parser.parse_args()
+    api_rows, api_seconds, api_calls = crawl(args, 'api')
+    bulk_rows, bulk_seconds, bulk_calls = crawl(args, 'bulk')
+
+    mismatches = []
+    for table_name in sorted(set(api_rows) | set(bulk_rows)):
+        if table_name not in api_rows or table_name not in bulk_rows:
+            mismatches.append('{} only crawled by the {} engine'.format(table_name, 'api' if table_name in api_rows else 'bulk'))
+            continue
+        for field, value in api_rows[table_name].items():
+            if bulk_rows[table_name][field] != value:
+                mismatches.append('{}.{}: api {!r} != bulk {!r}'.format(table_name, field, value, bulk_rows[table_name][field]))
+
+    if len(mismatches) > 0:
+        print('\n'.join(mismatches[:20]))
+        sys.exit('The bulk engine built {} fields differently than the api engine'.format(len(mismatches)))
+    print('{} tables, every row matches'.format(len(api_rows)))
+
+    print('{:<6} {:>9} {:>7}'.format('engine', 'seconds', 'calls'))
+    for engine, seconds, calls in [('api', api_seconds, api_calls), ('bulk', bulk_seconds, bulk_calls)]:
+        print('{:<6} {:>9.3f} {:>7}'.format(engine, seconds, calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Benchmarks the crawler's concurrent table detail fetching against the fake client with simulated API latency
+# No GCP project or credentials are needed
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'meta_data_crawler'))
+import bq_meta_data_crawler as crawler_mod
+from fake_bigquery import FakeBigQueryClient
+
+
+parser = argparse.ArgumentParser(description='Benchmark the crawler with a simulated latency client')
+parser.add_argument('--datasets', type=int,   help='Number of datasets in the fake project', default=4)
+parser.add_argument('--tables',   type=int,   help='Number of tables per dataset', default=50)
+parser.add_argument('--latency',  type=float, help='Seconds each API call sleeps', default=0.02)
+parser.add_argument('--workers',  type=str,   help='Comma separated list of worker counts to try', default='1,2,4,8,16')
+
+
+def main():
+    args = parser.parse_args()
+    crawler_mod.client     = FakeBigQueryClient('bench', args.datasets, args.tables, columns=2, latency=args.latency)
+    crawler_mod.count_incr = args.datasets * args.tables + 1 # keep the progress logging quiet
+
+    baseline = None
+    print('workers  seconds  speedup')
+    for worker_count in [int(i) for i in args.workers.split(',')]:
+        crawler_mod.workers  = worker_count
+        crawler_mod.governor = crawler_mod.RequestGovernor(None, worker_count, 8)
+        start = time.perf_counter()
+        rows = list(crawler_mod.crawler('bench'))
+        elapsed = time.perf_counter() - start
+        if baseline == None:
+            baseline = elapsed
+        print('{:>7}  {:>7.2f}  {:>6.2f}x  ({} rows)'.format(worker_count, elapsed, baseline / elapsed, len(rows)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Compares the memory of the crawler's TableRow rows with the OrderedDict rows the crawler used to build
+# No GCP project or credentials are needed
+
+import os
+import sys
+import argparse
+import tracemalloc
+import datetime as dt
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'meta_data_crawler'))
+import bq_meta_data_crawler as crawler_mod
+from fake_bigquery import FakeBigQueryClient
+
+
+parser = argparse.ArgumentParser(description='Benchmark the memory used by crawl rows')
+parser.add_argument('--rows', type=int, help='Number of crawl rows to hold in memory', default=100000)
+
+
+def as_ordered_dict(row):
+    """
+    The row the way the crawler used to build it, an OrderedDict with its own log date
+    """
+    table_doc = OrderedDict(row.items())
+    table_doc['log_date']     = dt.datetime.now()
+    table_doc['column_names'] = list(row['column_names'])
+
+    return table_doc
+
+
+def measure(build_rows):
+    """
+    Peak traced memory while holding all of the rows
+    """
+    tracemalloc.start()
+    rows = build_rows()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return len(rows), peak
+
+
+def main():
+    args = parser.parse_args()
+    crawler_mod.client     = FakeBigQueryClient('bench', 1, 1, columns=2)
+    crawler_mod.count_incr = args.rows + 1
+
+    template = next(crawler_mod.crawler('bench'))
+
+    def table_row():
+        row = template.copy()
+        row['column_names'] = list(template['column_names'])
+        return row
+
+    def table_rows():
+        return [table_row() for i in range(args.rows)]
+
+    def dict_rows():
+        return [as_ordered_dict(template) for i in range(args.rows)]
+
+    print('rows     type         peak MB  bytes/row')
+    for name, build_rows in [('OrderedDict', dict_rows), ('TableRow', table_rows)]:
+        count, peak = measure(build_rows)
+        print('{:<8} {:<12} {:>7.1f}  {:>9.0f}'.format(count, name, peak / 1048576, peak / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Compares the profiler's compiled template SQL builder with the str.replace generator it replaced
+# on a very wide synthetic schema, the time & peak memory of generating the query
+# No GCP project or credentials are needed
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'table_profiler'))
+import bq_table_profiler as profiler_mod
+from fake_bigquery import FakeBigQueryClient
+
+
+parser = argparse.ArgumentParser(description='Benchmark the profiler SQL generator on a wide schema')
+parser.add_argument('--columns', type=int, help='Number of top level columns in the synthetic table', default=10000)
+parser.add_argument('--nesting', type=int, help='How many levels deep the RECORD columns go', default=0)
+parser.add_argument('--repeat',  type=int, help='Times each generator is timed, the best run is reported', default=3)
+
+
+def legacy_sql_gen(sql_cols_dic, unnest_cols, table_id):
+    """
+    The generator the way the profiler used to build the query, every snippet is rendered with str.replace
+    & the whole statement is split into lines twice to size the spacers
+    """
+    select_statement_ls = []
+    for column_type, column_names in sql_cols_dic.items():
+        for column_name, alias_name, field_mode in column_names:
+            select_statement_ls.append(profiler_mod.profilers[column_type](column_name, alias_name, field_mode))
+
+    full_table_name = "`{table_id}`".replace('{table_id}', table_id)
+    char_length = 0
+
+    select_statement_unformatted = '\n'.join(select_statement_ls)
+    for i in select_statement_unformatted.split('\n'):
+        if 'AS ' in i or '#' in i:
+            statement = i.split(' {spacer} ')[0].rstrip()
+            statement_len = len(statement)
+            if statement_len > char_length:
+                char_length = statement_len
+    char_length = char_length + 2
+
+    select_statement_formated = []
+    for i in select_statement_unformatted.split('\n'):
+        if 'AS ' in i:
+            statement = i.split('{spacer}')[0].rstrip()
+            statement_len = len(statement)
+            spacer = ' ' * (char_length - statement_len)
+            new_statement = i.replace('{spacer}', spacer)
+            select_statement_formated.append(new_statement)
+        elif '{comment}' in i or '{spacer}# ▼' in i:
+            spacer = ' ' * (char_length + 2)
+            new_statement = i.replace('{spacer}', spacer)
+            select_statement_formated.append(new_statement)
+        else:
+            select_statement_formated.append(i)
+
+    query_skelton = """
+# Created by BigQuery Table Profiler: https://github.com/go-dustin/gcp_data_utilities
+# Empty & Null profile returns Infinity if a divide by zero occurs
+SELECT 
+{select_statement}
+FROM   {full_table_name}"""
+
+    nested_statement = ',\n'
+    for nested in unnest_cols:
+        nested_statement = nested_statement + '        UNNEST({}),\n'.format(nested)
+    if nested_statement[-2:] == ',\n':
+        nested_statement = nested_statement[:-2]
+    query_skelton = query_skelton + nested_statement
+    select_statement = '\n'.join(select_statement_formated)
+
+    return query_skelton.replace('{select_statement}', select_statement).replace('{full_table_name}', full_table_name)
+
+
+def measure(generate, repeat):
+    """
+    Best seconds of the runs & the peak traced memory of one run
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        generate()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    generate()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def main():
+    args = parser.parse_args()
+    client = FakeBigQueryClient('bench', 1, 1, args.columns, args.nesting)
+    profiler_mod.client_factory = lambda project=None: client
+    fields_ls, unnest_cols = profiler_mod.get_schema('bench', 'dataset_0.table_0')
+    sql_cols_dic = profiler_mod.sql_cols(fields_ls)
+    table_id = 'bench.dataset_0.table_0'
+
+    def compiled():
+        profiler_mod.select_cache.clear() # time the generation, not the cache
+        return profiler_mod.sql_gen(sql_cols_dic, unnest_cols, table_id)
+
+    def cached():
+        return profiler_mod.sql_gen(sql_cols_dic, unnest_cols, 'bench.dataset_0.table_1')
+
+    query = legacy_sql_gen(sql_cols_dic, unnest_cols, table_id)
+    if compiled() != query:
+        sys.exit('The compiled builder generated a different query than the legacy generator')
+    print('{} columns, {} lines, {:,} characters'.format(len(fields_ls), query.count('\n'), len(query)))
+
+    print('{:<10} {:>9} {:>12}'.format('generator', 'best s', 'peak MB'))
+    for name, generate in [('legacy', lambda: legacy_sql_gen(sql_cols_dic, unnest_cols, table_id)), ('compiled', compiled), ('cached', cached)]:
+        seconds, peak = measure(generate, args.repeat)
+        print('{:<10} {:>9.4f} {:>12.1f}'.format(name, seconds, peak / 1048576))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+# In process stand ins for bigquery.Client, no GCP project or credentials are needed
+
+import re
+import json
+import time
+import decimal
+import hashlib
+import random
+import threading
+import datetime as dt
+from google.cloud import bigquery
+from google.cloud.bigquery.table import TableListItem
+from google.cloud.bigquery.dataset import DatasetListItem
+from google.api_core import exceptions
+
+
+# column types the synthetic tables cycle through
+column_types = ['STRING', 'INTEGER', 'FLOAT', 'NUMERIC', 'TIMESTAMP', 'DATE', 'BOOLEAN', 'DATETIME']
+
+# the API's legacy type names -> the standard SQL names of INFORMATION_SCHEMA.COLUMNS
+standard_types = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+
+# INFORMATION_SCHEMA.TABLES table types of the API's table types
+information_schema_types = {'TABLE': 'BASE TABLE', 'VIEW': 'VIEW'}
+
+
+class FakeInsertClient():
+    """
+    Accepts insert_rows_json & load_table_from_file calls and enforces the real streaming insert limits
+    Optionally fails a share of requests with a transient error & rejects rows that have a given table_name
+    """
+
+    max_request_bytes = 10 * 1024 * 1024
+    max_request_rows  = 50000
+
+    def __init__(self, transient_error_rate=0.0, reject_table_names=(), seed=0):
+        self.transient_error_rate = transient_error_rate
+        self.reject_table_names   = set(reject_table_names)
+        self.random               = random.Random(seed)
+        self.inserted             = {} # table -> {row_id: row}
+        self.insert_calls         = 0
+        self.load_calls           = 0
+
+    def insert_rows_json(self, table, json_rows, row_ids=None):
+        self.insert_calls += 1
+        body = json.dumps({'rows': [{'insertId': row_id, 'json': row} for row_id, row in zip(row_ids, json_rows)]})
+        if len(body) > self.max_request_bytes:
+            raise exceptions.BadRequest('Request payload size exceeds the limit: {} bytes.'.format(self.max_request_bytes))
+        if len(json_rows) > self.max_request_rows:
+            raise exceptions.BadRequest('too many rows present in the request, limit: {}'.format(self.max_request_rows))
+        if self.random.random() < self.transient_error_rate:
+            raise exceptions.ServiceUnavailable('backendError')
+
+        # like BigQuery, one invalid row stops the whole request
+        errors = []
+        for index, row in enumerate(json_rows):
+            if row.get('table_name') in self.reject_table_names:
+                errors.append({'index': index, 'errors': [{'reason': 'invalid', 'message': 'rejected by fake client'}]})
+        if len(errors) > 0:
+            invalid = set(error['index'] for error in errors)
+            errors.extend({'index': index, 'errors': [{'reason': 'stopped', 'message': ''}]} for index in range(len(json_rows)) if index not in invalid)
+            return sorted(errors, key=lambda error: error['index'])
+
+        # insert ids de-duplicate retried rows
+        stored = self.inserted.setdefault(str(table), {})
+        for row_id, row in zip(row_ids, json_rows):
+            stored[row_id] = row
+
+        return []
+
+    def load_table_from_file(self, file_obj, destination, job_config=None):
+        self.load_calls += 1
+        stored = self.inserted.setdefault(str(destination), {})
+        for line in file_obj:
+            stored['load_{}'.format(len(stored))] = json.loads(line)
+
+        return FakeJob()
+
+
+class FakeBigQueryClient(FakeInsertClient):
+    """
+    A synthetic project of N datasets with M tables each, every table has the same generated schema
+    Each dataset can also hold a family of date sharded tables, events_20200101, events_20200102, ...
+    Each API call sleeps for the latency & can fail with a rate limit error like the real API
+    Also accepts the inserts & loads of FakeInsertClient
+    """
+
+    def __init__(self, project='bench', datasets=10, tables=100, columns=20, nesting=0, latency=0.0,
+                 quota_error_rate=0.0, transient_error_rate=0.0, reject_table_names=(), seed=0, shards=0, query_seconds=0.0):
+        FakeInsertClient.__init__(self, transient_error_rate, reject_table_names, seed)
+        self.project          = project
+        self.dataset_ids      = ['dataset_{}'.format(i) for i in range(datasets)]
+        self.table_ids        = ['table_{}'.format(i) for i in range(tables)]
+        self.table_ids       += [(dt.date(2020, 1, 1) + dt.timedelta(days=i)).strftime('events_%Y%m%d') for i in range(shards)]
+        self.table_numbers    = {table_id: number for number, table_id in enumerate(self.table_ids)}
+        self.latency          = latency
+        self.quota_error_rate = quota_error_rate
+        self.query_seconds    = query_seconds
+        self.partitions       = 100
+        self.bytes_billed     = 0
+        self.lock             = threading.Lock()
+        self.calls            = {}
+        self.schema           = synthetic_schema(columns, nesting)
+        self.created_tables   = {} # (dataset_id, table_id) -> bigquery.Table made with create_table
+
+    def api_call(self, call_name):
+        """
+        Count the call, sleep for the latency & maybe fail it with a quota error
+        """
+        with self.lock:
+            self.calls[call_name] = self.calls.get(call_name, 0) + 1
+            quota_error = self.random.random() < self.quota_error_rate
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if quota_error == True:
+            raise exceptions.Forbidden('Exceeded rate limits', errors=[{'reason': 'rateLimitExceeded'}])
+
+    def list_datasets(self, project=None, filter=None):
+        self.api_call('list_datasets')
+        dataset_ids = self.dataset_ids
+        if filter != None:
+            # labels.key:value terms, every one has to match
+            terms = [term[len('labels.'):].split(':') for term in filter.split()]
+            dataset_ids = [dataset_id for dataset_id in dataset_ids
+                           if all(key in self.dataset_labels(dataset_id) and (len(value) == 0 or self.dataset_labels(dataset_id)[key] == value[0]) for key, *value in terms)]
+        return [DatasetListItem({'datasetReference': {'projectId': self.project, 'datasetId': dataset_id},
+                                 'labels': self.dataset_labels(dataset_id)}) for dataset_id in dataset_ids]
+
+    def dataset_labels(self, dataset_id):
+        """
+        Even datasets are labeled env:prod, odd ones env:dev
+        """
+        return {'env': 'prod' if self.dataset_ids.index(dataset_id) % 2 == 0 else 'dev'}
+
+    def get_dataset(self, dataset_ref):
+        self.api_call('get_dataset')
+        dataset = bigquery.Dataset(dataset_ref)
+        dataset.location = 'US'
+        dataset.labels   = self.dataset_labels(dataset.dataset_id)
+        return dataset
+
+    def list_tables(self, dataset):
+        self.api_call('list_tables')
+        dataset_id = str(dataset).split('.')[-1]
+        return [TableListItem(self.table_resource(dataset_id, table_id)) for table_id in self.table_ids]
+
+    def get_table(self, table):
+        self.api_call('get_table')
+        dataset_id, table_id = str(table).split('.')[-2:]
+        if (dataset_id, table_id) in self.created_tables:
+            return self.created_tables[(dataset_id, table_id)]
+        if dataset_id not in self.dataset_ids:
+            raise exceptions.NotFound('Not found: Table {}:{}.{}'.format(self.project, dataset_id, table_id))
+        return bigquery.Table.from_api_repr(self.table_resource(dataset_id, table_id))
+
+    def dataset(self, dataset_id, project=None):
+        return bigquery.DatasetReference(project or self.project, dataset_id)
+
+    def create_table(self, table, exists_ok=False):
+        """
+        Keep the table so get_table & update_table see it, like the output table of the crawler
+        """
+        self.api_call('create_table')
+        table = table if isinstance(table, bigquery.Table) else bigquery.Table(table)
+        key = (table.dataset_id, table.table_id)
+        if key in self.created_tables and exists_ok == False:
+            raise exceptions.Conflict('Already Exists: Table {}:{}.{}'.format(table.project, table.dataset_id, table.table_id))
+        self.created_tables.setdefault(key, table)
+        return self.created_tables[key]
+
+    def update_table(self, table, fields):
+        self.api_call('update_table')
+        self.created_tables[(table.dataset_id, table.table_id)] = table
+        return table
+
+    def table_resource(self, dataset_id, table_id):
+        number = self.table_numbers.get(table_id, 0)
+        return {'tableReference'   : {'projectId': self.project, 'datasetId': dataset_id, 'tableId': table_id},
+                'id'               : '{}:{}.{}'.format(self.project, dataset_id, table_id),
+                'etag'             : 'etag_{}'.format(number),
+                'type'             : 'VIEW' if number % 10 == 9 else 'TABLE',
+                'location'         : 'US',
+                'numBytes'         : str(1048576 * (number + 1)),
+                'numRows'          : str(1000 * (number + 1)),
+                'creationTime'     : str(1600000000000 - number),
+                'lastModifiedTime' : str(1600000000000 + number),
+                'timePartitioning' : {'type': 'DAY', 'field': 'col_4'} if number % 2 == 0 else None,
+                'rangePartitioning': {'field': 'col_1', 'range': {'start': '0', 'end': '100', 'interval': '10'}} if number % 4 == 3 else None,
+                'clustering'       : {'fields': ['col_0', 'col_1']} if number % 3 == 0 else None,
+                'labels'           : {'team': 'data', 'tier': str(number % 3)} if number % 4 == 1 else {},
+                'description'      : 'Synthetic table {}'.format(number) if number % 5 == 2 else None,
+                'schema'           : {'fields': self.schema}}
+
+    def information_schema(self, query):
+        """
+        Rows of the region INFORMATION_SCHEMA views the bulk engine reads, made from the same resources as get_table
+        """
+        resources = [self.table_resource(dataset_id, table_id) for dataset_id in self.dataset_ids for table_id in self.table_ids]
+        if 'INFORMATION_SCHEMA.SCHEMATA' in query:
+            return [{'schema_name': dataset_id, 'location': 'US'} for dataset_id in self.dataset_ids]
+        if 'INFORMATION_SCHEMA.TABLE_OPTIONS' in query:
+            rows = []
+            for resource in resources:
+                reference = resource['tableReference']
+                if len(resource['labels']) > 0:
+                    labels = ', '.join('STRUCT({}, {})'.format(json.dumps(key), json.dumps(value)) for key, value in resource['labels'].items())
+                    rows.append({'table_schema': reference['datasetId'], 'table_name': reference['tableId'], 'option_name': 'labels', 'option_value': '[{}]'.format(labels)})
+                if resource['description'] != None:
+                    rows.append({'table_schema': reference['datasetId'], 'table_name': reference['tableId'], 'option_name': 'description', 'option_value': json.dumps(resource['description'])})
+            return rows
+        if 'INFORMATION_SCHEMA.COLUMNS' in query:
+            rows = []
+            for resource in resources:
+                clustering = (resource['clustering'] or {}).get('fields', [])
+                for position, field in enumerate(resource['schema']['fields']):
+                    rows.append({'table_schema'                : resource['tableReference']['datasetId'],
+                                 'table_name'                  : resource['tableReference']['tableId'],
+                                 'column_name'                 : field['name'],
+                                 'ordinal_position'            : position + 1,
+                                 'data_type'                   : standard_type(field),
+                                 'is_nullable'                 : 'NO' if field.get('mode') == 'REQUIRED' else 'YES',
+                                 'clustering_ordinal_position' : clustering.index(field['name']) + 1 if field['name'] in clustering else None})
+            return rows
+        return [{'table_schema'  : resource['tableReference']['datasetId'],
+                 'table_name'    : resource['tableReference']['tableId'],
+                 'table_type'    : information_schema_types[resource['type']],
+                 'creation_time' : dt.datetime.fromtimestamp(int(resource['creationTime']) / 1000, tz=dt.timezone.utc),
+                 'ddl'           : table_ddl(resource)} for resource in resources]
+
+    def query(self, query, job_config=None, location=None):
+        self.api_call('query')
+        # a query scans 1KB per generated expression
+        query_bytes = 1024 * query.count(' AS ')
+        if job_config != None and job_config.dry_run == True:
+            return FakeJob(total_bytes_processed=query_bytes)
+        if 'INFORMATION_SCHEMA.PARTITIONS' in query:
+            # every partitioned table has the same daily partitions, later days hold more rows & each is written the day after
+            return FakeJob(rows=[{'partition_id'       : (dt.date(2020, 1, 1) + dt.timedelta(days=i)).strftime('%Y%m%d'),
+                                  'total_rows'         : 10 * (i + 1),
+                                  'last_modified_time' : dt.datetime(2020, 1, 2, tzinfo=dt.timezone.utc) + dt.timedelta(days=i)} for i in range(self.partitions)])
+        if re.search(r'INFORMATION_SCHEMA\.(SCHEMATA|TABLES|TABLE_OPTIONS|COLUMNS)\b', query):
+            return FakeJob(rows=self.information_schema(query))
+        if '__TABLES__' in query:
+            # one dataset's view or a UNION ALL of several
+            resources = [self.table_resource(dataset_id, table_id) for dataset_id in re.findall(r'\.(\w+)\.__TABLES__', query) for table_id in self.table_ids]
+            return FakeJob(rows=[{'dataset_id'         : resource['tableReference']['datasetId'],
+                                  'table_id'           : resource['tableReference']['tableId'],
+                                  'creation_time'      : int(resource['creationTime']),
+                                  'last_modified_time' : int(resource['lastModifiedTime']),
+                                  'row_count'          : int(resource['numRows']),
+                                  'size_bytes'         : int(resource['numBytes'])} for resource in resources])
+        with self.lock:
+            self.bytes_billed += query_bytes
+        if ' AS table_name, * FROM (' in query:
+            # a profile row for each table of a pack, tagged with its table_name
+            rows = [dict(profile_row(part), table_name=re.search(r"SELECT '([^']+)' AS table_name", part).group(1)) for part in query.split('\nUNION ALL\n')]
+            return FakeJob(total_bytes_processed=query_bytes, rows=rows, seconds=self.query_seconds)
+        if 'GROUP BY partition_id' in query:
+            # a profile row for each of the daily partitions
+            rows = [dict(profile_row(query), partition_id=(dt.date(2020, 1, 1) + dt.timedelta(days=i)).strftime('%Y%m%d')) for i in range(self.partitions)]
+            return FakeJob(total_bytes_processed=query_bytes, rows=rows, seconds=self.query_seconds)
+        return FakeJob(total_bytes_processed=query_bytes, rows=[profile_row(query)], seconds=self.query_seconds)
+
+
+def standard_type(field):
+    """
+    The INFORMATION_SCHEMA.COLUMNS data_type of an API schema field, Ex: ARRAY<STRUCT<a INT64, b STRING NOT NULL>>
+    """
+    if field['type'] in ['RECORD', 'STRUCT']:
+        members = ['{} {}{}'.format(member['name'], standard_type(member), ' NOT NULL' if member.get('mode') == 'REQUIRED' else '')
+                   for member in field['fields']]
+        data_type = 'STRUCT<{}>'.format(', '.join(members))
+    else:
+        data_type = standard_types.get(field['type'], field['type'])
+
+    return 'ARRAY<{}>'.format(data_type) if field.get('mode') == 'REPEATED' else data_type
+
+
+def table_ddl(resource):
+    """
+    The CREATE statement INFORMATION_SCHEMA.TABLES has for the resource, only the PARTITION BY & CLUSTER BY lines matter
+    """
+    reference = resource['tableReference']
+    ddl = ['CREATE TABLE `{}.{}.{}`'.format(reference['projectId'], reference['datasetId'], reference['tableId']),
+           '(\n{}\n)'.format(',\n'.join('  {} {}'.format(field['name'], standard_type(field)) for field in resource['schema']['fields']))]
+    if resource['timePartitioning'] != None:
+        ddl.append('PARTITION BY DATE({})'.format(resource['timePartitioning']['field']))
+    if resource['rangePartitioning'] != None:
+        partition_range = resource['rangePartitioning']['range']
+        ddl.append('PARTITION BY RANGE_BUCKET({}, GENERATE_ARRAY({}, {}, {}))'.format(resource['rangePartitioning']['field'],
+                   partition_range['start'], partition_range['end'], partition_range['interval']))
+    if resource['clustering'] != None:
+        ddl.append('CLUSTER BY {}'.format(', '.join(resource['clustering']['fields'])))
+
+    return '\n'.join(ddl) + ';'
+
+
+def synthetic_schema(columns, nesting, prefix='col'):
+    """
+    API schema fields of the given width, every 5th column is a RECORD nested nesting levels deep & every 7th is REPEATED
+    """
+    fields = []
+    for i in range(columns):
+        name = '{}_{}'.format(prefix, i)
+        if nesting > 0 and i % 5 == 4:
+            fields.append({'name': name, 'type': 'RECORD', 'mode': 'NULLABLE', 'fields': synthetic_schema(3, nesting - 1, name)})
+        elif i % 7 == 6:
+            fields.append({'name': name, 'type': 'STRING', 'mode': 'REPEATED'})
+        else:
+            fields.append({'name': name, 'type': column_types[i % len(column_types)], 'mode': 'NULLABLE'})
+
+    return fields
+
+
+def profile_row(query):
+    """
+    A result row with a value for each alias of the query, sums are NUMERIC like the profiler's casts
+    The values only depend on the alias so the same column always profiles the same
+    """
+    row = {}
+    for alias in re.findall(r'\bAS\s+(\w+)\s*(?:,|$)', query, re.MULTILINE):
+        value = int(hashlib.md5(alias.encode('utf-8')).hexdigest()[:6], 16)
+        row[alias] = decimal.Decimal(value) if alias.endswith('_sum') else value
+
+    return row
+
+
+class FakeRowIterator(list):
+    """
+    Result rows with the pages & schema of a RowIterator
+    """
+
+    def __init__(self, rows, page_size=None):
+        super().__init__(rows)
+        self.page_size = page_size or max(len(rows), 1)
+        types = {bool: 'BOOLEAN', int: 'INTEGER', float: 'FLOAT', str: 'STRING', decimal.Decimal: 'NUMERIC'}
+        self.schema = [bigquery.SchemaField(name, types.get(type(value), 'STRING')) for name, value in (rows[0].items() if len(rows) > 0 else [])]
+
+    @property
+    def pages(self):
+        for start in range(0, len(self), self.page_size):
+            yield self[start:start + self.page_size]
+
+
+class FakeJob():
+    """
+    A job that finishes seconds after it's created, immediately by default
+    """
+
+    errors = None
+
+    def __init__(self, total_bytes_processed=0, rows=(), seconds=0.0):
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed    = total_bytes_processed
+        self.rows                  = list(rows)
+        self.done_at               = time.monotonic() + seconds
+        self.job_id                = 'job_{}'.format(id(self))
+
+    def done(self):
+        return time.monotonic() >= self.done_at
+
+    def result(self, page_size=None):
+        wait = self.done_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        return FakeRowIterator(self.rows, page_size)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# Repeatable offline benchmarks of the crawler & profiler hot paths against the synthetic FakeBigQueryClient
+# Each run is appended to a history file with the git commit & python version and compared with the previous run
+# No GCP project or credentials are needed
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+import datetime as dt
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarks_dir, '..', 'meta_data_crawler'))
+sys.path.insert(0, os.path.join(benchmarks_dir, '..', 'table_profiler'))
+import bq_meta_data_crawler as crawler_mod
+import bq_table_profiler as profiler_mod
+from fake_bigquery import FakeBigQueryClient
+
+
+parser = argparse.ArgumentParser(description='Run the offline crawler & profiler benchmarks')
+parser.add_argument('--repeat',     type=int,   help='Times each benchmark is run, the min & median are reported', default=5)
+parser.add_argument('--datasets',   type=int,   help='Number of datasets in the fake project', default=4)
+parser.add_argument('--tables',     type=int,   help='Number of tables per dataset', default=100)
+parser.add_argument('--columns',    type=int,   help='Number of top level columns in the fake tables', default=50)
+parser.add_argument('--nesting',    type=int,   help='How many levels deep the fake RECORD columns go', default=2)
+parser.add_argument('--latency',    type=float, help='Seconds each fake API call sleeps', default=0.005)
+parser.add_argument('--workers',    type=int,   help='Crawler worker threads', default=8)
+parser.add_argument('--only',       type=str,   help='Comma separated list of benchmarks to run, all by default')
+parser.add_argument('--history',    type=str,   help='JSON lines file the results are appended to', default=os.path.join(benchmarks_dir, 'benchmark_history.jsonl'))
+parser.add_argument('--threshold',  type=float, help='Flag a benchmark as a regression when its median is this much slower than the last run', default=0.2)
+
+
+def fake_client(args, latency=None, quota_error_rate=0.0):
+    """
+    A fake client shaped by the command line arguments
+    """
+    latency = args.latency if latency == None else latency
+
+    return FakeBigQueryClient('bench', args.datasets, args.tables, args.columns, args.nesting, latency, quota_error_rate)
+
+
+def crawl_setup(args, quota_error_rate=0.0):
+    """
+    A crawl of the fake project, optionally with rate limit errors the governor has to back off from
+    """
+    def crawl():
+        crawler_mod.client   = fake_client(args, quota_error_rate=quota_error_rate)
+        crawler_mod.governor = crawler_mod.RequestGovernor(None, args.workers, 8)
+        crawler_mod.metrics  = crawler_mod.CrawlMetrics()
+        return list(crawler_mod.crawler('bench'))
+
+    return crawl
+
+
+def writer_setup(args, make_sink):
+    """
+    Write a crawl's rows to a sink, the rows are crawled once up front so only the writer is timed
+    """
+    crawler_mod.client   = fake_client(args, latency=0)
+    crawler_mod.governor = crawler_mod.RequestGovernor(None, args.workers, 8)
+    rows = list(crawler_mod.crawler('bench'))
+
+    def write():
+        crawler_mod.client = fake_client(args, latency=0)
+        crawler_mod.write_to_sink(make_sink(), rows)
+
+    return write
+
+
+def crawl_main_setup(args, output_dir):
+    """
+    The crawler's main() end to end: the output table is created, the crawl is streamed to it & to a JSON lines file
+    """
+    def crawl_main():
+        client = fake_client(args)
+        crawler_mod.client_factory = lambda project=None: client
+        argv = sys.argv
+        sys.argv = ['bq_meta_data_crawler.py', '--project', 'bench', '--output_bq_table', 'bench.crawler.tables',
+                    '--jsonl_path', os.path.join(output_dir, 'main.jsonl'), '--workers', str(args.workers)]
+        try:
+            crawler_mod.main()
+        finally:
+            sys.argv = argv
+
+    return crawl_main
+
+
+def profiler_setup(args):
+    """
+    Point the profiler at a table of the fake project
+    """
+    client = fake_client(args, latency=0)
+    profiler_mod.client_factory    = lambda project=None: client
+    profiler_mod.table_project     = 'bench'
+    profiler_mod.dataset_tablename = 'dataset_0.table_0'
+
+
+def get_schema_setup(args):
+    profiler_setup(args)
+
+    return lambda: profiler_mod.get_schema('bench', 'dataset_0.table_0')
+
+
+def sql_gen_setup(args):
+    profiler_setup(args)
+    fields_ls, unnest_cols = profiler_mod.get_schema('bench', 'dataset_0.table_0')
+
+    def sql_gen():
+        profiler_mod.select_cache.clear() # time the generation, not the cache
+        return profiler_mod.sql_gen(profiler_mod.sql_cols(fields_ls), unnest_cols)
+
+    return sql_gen
+
+
+def shard_queries_setup(args):
+    profiler_setup(args)
+    profiler_mod.shard_expressions = 200 # split the fake table into a few shards
+    fields_ls, unnest_cols = profiler_mod.get_schema('bench', 'dataset_0.table_0')
+
+    return lambda: profiler_mod.shard_queries(profiler_mod.sql_cols(fields_ls), unnest_cols)
+
+
+def benchmarks(output_dir):
+    """
+    Benchmark name -> setup function, the setup returns the callable that gets timed
+    """
+    return {'crawl'          : lambda args: crawl_setup(args),
+            'crawl_quota'    : lambda args: crawl_setup(args, quota_error_rate=0.05),
+            'crawl_main'     : lambda args: crawl_main_setup(args, output_dir),
+            'get_schema'     : get_schema_setup,
+            'sql_gen'        : sql_gen_setup,
+            'shard_queries'  : shard_queries_setup,
+            'write_csv'      : lambda args: writer_setup(args, lambda: crawler_mod.CsvSink(os.path.join(output_dir, 'bench.csv'))),
+            'write_jsonl'    : lambda args: writer_setup(args, lambda: crawler_mod.JsonLinesSink(os.path.join(output_dir, 'bench.jsonl'))),
+            'write_bq_stream': lambda args: writer_setup(args, crawler_mod.BigQuerySink),
+            'write_bq_load'  : lambda args: writer_setup(args, crawler_mod.BigQueryLoadSink)}
+
+
+def time_benchmark(run, repeat):
+    """
+    Seconds each of the runs took, the crawler's logging is swallowed so it doesn't skew the timings
+    """
+    timings = []
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchmarks_dir, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def last_results(history_path):
+    """
+    The most recent result of each benchmark in the history file, keyed by benchmark name
+    """
+    results = {}
+    if not os.path.exists(history_path):
+        return results
+    with open(history_path) as f:
+        for line in f:
+            if line.strip() != '':
+                run = json.loads(line)
+                for name, result in run['results'].items():
+                    results[name] = dict(result, commit=run['commit'], parameters=run['parameters'])
+
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    crawler_mod.count_incr      = args.datasets * args.tables + 1 # keep the progress logging quiet
+    crawler_mod.workers         = args.workers
+    crawler_mod.output_bq_table = 'bench.meta.tables'
+    crawler_mod.backoff_seconds = 0.01 # the fake quota errors shouldn't make the benchmark wait seconds
+
+    previous = last_results(args.history)
+    run = {'timestamp'  : dt.datetime.now().isoformat(),
+           'commit'     : git_commit(),
+           'python'     : platform.python_version(),
+           'parameters' : {k: v for k, v in vars(args).items() if k not in ['only', 'history', 'threshold']},
+           'results'    : {}}
+
+    regressions = []
+    print('{:<16} {:>9} {:>9}  {}'.format('benchmark', 'min s', 'median s', 'change'))
+    with tempfile.TemporaryDirectory() as output_dir:
+        for name, setup in benchmarks(output_dir).items():
+            if args.only != None and name not in args.only.split(','):
+                continue
+            with contextlib.redirect_stdout(io.StringIO()):
+                benchmark = setup(args)
+            timings = time_benchmark(benchmark, args.repeat)
+            result = {'min': round(min(timings), 6), 'median': round(statistics.median(timings), 6), 'repeat': args.repeat}
+            run['results'][name] = result
+
+            # only runs with the same parameters are comparable
+            change = ''
+            if name in previous and previous[name]['parameters'] == run['parameters']:
+                ratio = result['median'] / previous[name]['median'] - 1
+                change = '{:+.0%} vs {}'.format(ratio, previous[name]['commit'])
+                if ratio > args.threshold:
+                    regressions.append(name)
+                    change = change + ' !'
+            print('{:<16} {:>9.4f} {:>9.4f}  {}'.format(name, result['min'], result['median'], change))
+
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+    print('Results appended to', args.history)
+    if len(regressions) > 0:
+        print('Slower than the last run by more than {:.0%}:'.format(args.threshold), ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
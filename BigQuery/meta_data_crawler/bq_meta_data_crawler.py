@@ -5,39 +5,100 @@
 import sys
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
+from google.api_core import exceptions
 from collections import Counter
 import argparse
 import csv
 from collections import OrderedDict
+from collections import deque
 import datetime as dt
 import json
+import itertools
+import os
+import hashlib
+import random
+import tempfile
+import time
+import uuid
+import threading
+import bisect
+import contextlib
+import re
+import decimal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# pyarrow is only needed for the Parquet output
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 parser = argparse.ArgumentParser(description='Crawl all datasets & tables in a project and save the table details')
 parser.add_argument('--project',         type=str, help='The project that contains the BigQuery', required=True )
+parser.add_argument('--projects',        type=str, help='Comma separated list of projects to crawl, --project is then only used for the BigQuery output')
+parser.add_argument('--projects_file',   type=str, help='File with one project to crawl per line')
+parser.add_argument('--processes',       type=int, help='Number of processes for a multi project crawl', default=os.cpu_count())
 parser.add_argument('--csv_path',        type=str, help='Output dir for CSV')
 parser.add_argument('--json_path',       type=str, help='Output dir for JSON')
+parser.add_argument('--jsonl_path',      type=str, help='Output path for JSON Lines, one table per line')
+parser.add_argument('--parquet_path',    type=str, help='Output path for a Parquet file with typed & list columns, needs pyarrow')
 parser.add_argument('--output_bq_table', type=str, help='Table to write to in BigQuery. Ex: mydataset.mytable')
+parser.add_argument('--bq_write_mode',   type=str, help='stream: batched streaming inserts, load: one load job from a local NDJSON file', choices=['stream', 'load'], default='stream')
+parser.add_argument('--max_calls_per_second', type=float, help='Cap on BigQuery API calls per second, the number of calls in flight adapts to quota errors')
+parser.add_argument('--max_retries',     type=int, help='Retries for an API call that hits a quota or transient error', default=8)
+parser.add_argument('--metrics_json',    type=str, help='Save the crawl metrics, API latency histograms, rates & retries, to this JSON file')
+parser.add_argument('--metrics_prom',    type=str, help='Save the crawl metrics in the Prometheus textfile format, Ex: /var/lib/node_exporter/bq_crawler.prom')
+parser.add_argument('--checkpoint',      type=str, help='Save the crawl progress to this file so a failed crawl can be resumed')
+parser.add_argument('--resume',                    help='Resume the crawl saved in --checkpoint', action='store_true', default=False)
 parser.add_argument('--count_incr',      type=int, help='Log out every x tables. Choose an integer to use as a divisor', default=10)
-args = parser.parse_args()
-project         = args.project
-csv_path        = args.csv_path
-json_path       = args.json_path
-output_bq_table = args.output_bq_table
-count_incr      = args.count_incr
-
+parser.add_argument('--workers',         type=int, help='Number of tables to fetch details for in parallel', default=1)
+parser.add_argument('--engine',          type=str, help='api: a get_table call per table, bulk: a few INFORMATION_SCHEMA queries per region', choices=['api', 'bulk'], default='api')
+parser.add_argument('--regions',         type=str, help='Comma separated regions for the bulk engine. Ex: us,eu. Looks up each dataset location if not set')
+parser.add_argument('--include_datasets', type=str, help='Only crawl datasets whose id matches this regex')
+parser.add_argument('--exclude_datasets', type=str, help='Skip datasets whose id matches this regex')
+parser.add_argument('--dataset_labels',  type=str, help='Only crawl datasets with all of these labels, comma separated key:value or key. Ex: env:prod,team')
+parser.add_argument('--include_tables',  type=str, help='Only crawl tables whose id matches this regex')
+parser.add_argument('--exclude_tables',  type=str, help='Skip tables whose id matches this regex')
+parser.add_argument('--table_types',     type=str, help='Comma separated table types to crawl. Ex: TABLE,VIEW,EXTERNAL,MATERIALIZED_VIEW,SNAPSHOT')
+parser.add_argument('--snapshot',        type=str, help='Incremental crawl, only fetch tables that changed since the crawl saved in this snapshot file')
+parser.add_argument('--collapse_shards',           help='Fetch one representative of each family of date sharded tables, Ex: events_20200101, & copy it for the other shards', action='store_true', default=False)
+parser.add_argument('--schemas_path',    type=str, help='Save each unique table schema once to this JSON lines file, rows reference it by schema_hash instead of listing their columns')
+parser.add_argument('--bq_delta_only',             help='With --snapshot, only write new, changed & deleted tables to BigQuery', action='store_true', default=False)
 
-if output_bq_table != None:
-    des_proj, dataset_n, table_n = output_bq_table.split('.')
+# the arguments & client are set in main() so the crawl functions can be imported without a live project
+project         = None
+crawl_projects  = []
+processes       = 1
+csv_path        = None
+json_path       = None
+jsonl_path      = None
+parquet_path    = None
+output_bq_table = None
+bq_write_mode   = 'stream'
+count_incr      = 10
+workers         = 1
+engine          = 'api'
+bulk_regions    = None
+snapshot_path   = None
+bq_delta_only   = False
+collapse_shards = False
+schemas_path    = None
+checkpoint_path = None
+resume          = False
+checkpoint      = None
+metrics_json    = None
+metrics_prom    = None
+des_proj        = None
+dataset_n       = None
+table_n         = None
+client          = None
 
-if csv_path == None and output_bq_table == None and json_path == None:
-    sys.exit('No output target, set --csv_path or --output_bq_table')
+# creates the BigQuery clients, swapped for a fake client by the benchmarks
+client_factory  = bigquery.Client
 
 
-# create bigquery connection obj
-client = bigquery.Client(project=project)
-
-# BigQuery output table schema
 # BigQuery output table schema
 schema = [bigquery.SchemaField("log_date",              "DATETIME", mode="NULLABLE", description='Date & time of the crawl'),
           bigquery.SchemaField("project",               "STRING",   mode="NULLABLE"), 
@@ -81,46 +142,501 @@ schema = [bigquery.SchemaField("log_date",              "DATETIME", mode="NULLAB
           bigquery.SchemaField("integer",               "INT64",    mode="NULLABLE", description='Number of INTEGER columns in the table'),
           bigquery.SchemaField("geography",             "INT64",    mode="NULLABLE", description='Number of GEOGRAPHY columns in the table'),
           bigquery.SchemaField("string",                "INT64",    mode="NULLABLE", description='Number of STRING columns in the table'),
+          bigquery.SchemaField("schema_hash",           "STRING",   mode="NULLABLE", description='Hash of the column names, types & modes, tables with the same columns share a hash'),
           ]
 
 
+# --- compact crawl rows
+
+# every row of a crawl shares one log date, set when the crawl starts
+crawl_log_date = dt.datetime.now()
+
+
+class TableRow():
+    """
+    One crawled table. The values are slots in the output schema's column order instead of a dict per row,
+    it reads & writes like a dict of the schema's columns so the writers can use it as is
+    """
+
+    __slots__ = tuple(field.name for field in schema)
+
+    # column names already encoded for to_json
+    json_keys = tuple(json.dumps(field.name) + ': ' for field in schema)
+
+    def __init__(self, values=None):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        if values != None:
+            self.update(values)
+
+    def __getitem__(self, key):
+        if key not in column_positions:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in column_positions:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in column_positions
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return list(self.items()) == list(other.items())
+
+    def __repr__(self):
+        return 'TableRow({})'.format(dict(self.items()))
+
+    def get(self, key, default=None):
+        if key not in column_positions:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self.__slots__
+
+    def values(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def update(self, values):
+        """
+        Set the columns from a dict or (column, value) pairs, values that aren't a column in the schema are dropped
+        """
+        if hasattr(values, 'items'):
+            values = values.items()
+        for key, value in values:
+            if key in column_positions:
+                setattr(self, key, value)
+
+    def copy(self):
+        return TableRow(self.items())
+
+    def to_json(self, default=None):
+        """
+        The row as a JSON object, same output as json.dumps of the equivalent dict
+        """
+        return '{' + ', '.join(json_key + json.dumps(getattr(self, name), default=default) for json_key, name in zip(self.json_keys, self.__slots__)) + '}'
+
+
+column_positions = {field.name: i for i, field in enumerate(schema)}
+
+
+# --- API request governor
+# Every BigQuery API call of the crawl goes through the governor. A token bucket caps the calls per second and
+# AIMD (additive increase, multiplicative decrease) adjusts how many calls can be in flight: the limit creeps up
+# while calls succeed & is halved on a quota error, so the crawl settles at the highest rate the quota allows.
+
+# reasons BigQuery gives for quota & rate limit errors, these come back as 403s as well as 429s
+quota_error_reasons = ['rateLimitExceeded', 'quotaExceeded', 'backendRateLimitExceeded']
+
+
+class RequestGovernor():
+    """
+    Rate limits, throttles & retries the API calls shared by all of the crawl's threads
+    """
+
+    def __init__(self, max_calls_per_second=None, max_concurrency=1, max_retries=8):
+        self.condition            = threading.Condition()
+        self.max_calls_per_second = max_calls_per_second
+        self.max_concurrency      = max(max_concurrency, 1)
+        self.max_retries          = max_retries
+        self.concurrency_limit    = float(self.max_concurrency)
+        self.in_flight            = 0
+        self.tokens               = float(max_calls_per_second or 0)
+        self.last_refill          = time.monotonic()
+        self.counters             = Counter(calls=0, retries=0, throttled=0, quota_errors=0, failed=0)
+
+    def call(self, call_name, api_call, *args, **kwargs):
+        """
+        Run an API call when the rate & concurrency limits allow it, retrying quota & transient errors with backoff
+        call_name labels the call's latency in the crawl metrics
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            start = time.perf_counter()
+            try:
+                result = api_call(*args, **kwargs)
+            except Exception as e:
+                metrics.observe('api_call_seconds', call_name, time.perf_counter() - start)
+                quota_error = is_quota_error(e)
+                self.release('quota_error' if quota_error else 'error')
+                if attempt == self.max_retries or (quota_error == False and not isinstance(e, retryable_errors)):
+                    with self.condition:
+                        self.counters['failed'] += 1
+                    raise
+                with self.condition:
+                    self.counters['retries'] += 1
+                backoff(attempt, e)
+                continue
+            metrics.observe('api_call_seconds', call_name, time.perf_counter() - start)
+            self.release('ok')
+            return result
+
+    def acquire(self):
+        with self.condition:
+            throttled = False
+            while True:
+                if self.in_flight < int(self.concurrency_limit):
+                    wait = self.token_wait()
+                    if wait == 0:
+                        break
+                else:
+                    wait = None # woken up by release()
+                throttled = True
+                self.condition.wait(wait)
+            if throttled == True:
+                self.counters['throttled'] += 1
+            self.in_flight += 1
+            self.counters['calls'] += 1
+
+    def token_wait(self):
+        """
+        Take a token from the bucket, returns 0 if one was taken or the seconds until the next one
+        """
+        if self.max_calls_per_second == None:
+            return 0
+        # the bucket holds at least one token, a rate below 1 call per second would never fill it otherwise
+        now = time.monotonic()
+        self.tokens = min(max(1.0, self.max_calls_per_second), self.tokens + (now - self.last_refill) * self.max_calls_per_second)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.max_calls_per_second
+
+    def release(self, outcome):
+        """
+        outcome is ok, quota_error or error, other errors don't change the concurrency limit
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == 'quota_error':
+                self.counters['quota_errors'] += 1
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+            elif outcome == 'ok':
+                # +1 in flight call for each limit's worth of successful calls
+                self.concurrency_limit = min(float(self.max_concurrency), self.concurrency_limit + 1 / self.concurrency_limit)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats['concurrency_limit'] = round(self.concurrency_limit, 2)
+        return stats
+
+    def drain(self):
+        """
+        The counters since the last drain, reset to zero. A crawl process sends them with each task's result
+        """
+        with self.condition:
+            counters = dict(self.counters)
+            for counter in self.counters:
+                self.counters[counter] = 0
+        return counters
+
+    def merge(self, counters):
+        with self.condition:
+            self.counters.update(counters)
+
+
+def is_quota_error(error):
+    """
+    True for 429s & the 403s BigQuery returns when a rate limit or quota is hit
+    """
+    if isinstance(error, exceptions.TooManyRequests):
+        return True
+    if isinstance(error, exceptions.Forbidden):
+        return any(e.get('reason') in quota_error_reasons for e in (error.errors or []))
+    return False
+
+
+governor = RequestGovernor()
+
+
+# --- crawl metrics
+# Latency histograms of the API calls & writer flushes plus the crawl's counters.
+# A progress line with the rate & ETA is printed every --count_incr tables and the totals can be saved as JSON
+# or in the Prometheus textfile format.
+
+# histogram bucket upper bounds in seconds
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+metric_help = {'api_call_seconds'     : 'Latency of BigQuery API calls, including failed attempts',
+               'writer_flush_seconds' : 'Time spent flushing rows to an output',
+               'tables_listed'        : 'Tables found by listing the datasets',
+               'tables_written'       : 'Table rows written to the outputs',
+               'tables_failed'        : 'Tables whose details could not be fetched',
+               'writer_retries'       : 'Retried output writes',
+               'tables_filtered'      : 'Listed tables skipped by the include & exclude filters',
+               'shards_collapsed'     : 'Sharded tables copied from their family representative instead of fetched'}
+
+
+class CrawlMetrics():
+    """
+    Thread safe latency histograms & counters for a crawl
+    """
+
+    def __init__(self):
+        self.lock             = threading.Lock()
+        self.start            = time.monotonic()
+        self.histograms       = OrderedDict() # (metric, label) -> [bucket counts, sum, count]
+        self.counters         = Counter()
+        self.listing_complete = False
+
+    def observe(self, metric, label, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault((metric, label), [[0] * len(latency_buckets), 0.0, 0])
+            histogram[0][bisect.bisect_left(latency_buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, metric, label):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(metric, label, time.perf_counter() - start)
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def drain(self):
+        """
+        The histograms & counters since the last drain, reset to empty. A crawl process sends them with each task's result
+        """
+        with self.lock:
+            histograms, counters = self.histograms, dict(self.counters)
+            self.histograms = OrderedDict()
+            self.counters   = Counter()
+        return histograms, counters
+
+    def merge(self, histograms, counters):
+        with self.lock:
+            for key, (buckets, total, count) in histograms.items():
+                histogram = self.histograms.setdefault(key, [[0] * len(latency_buckets), 0.0, 0])
+                histogram[0] = [merged + bucket for merged, bucket in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+            self.counters.update(counters)
+
+    def row_written(self):
+        """
+        Count a row that went to the outputs & print the progress line every count_incr rows
+        """
+        self.increment('tables_written')
+        if self.counters['tables_written'] % count_incr == 0:
+            print(self.progress_line())
+
+    def progress_line(self):
+        elapsed = time.monotonic() - self.start
+        written = self.counters['tables_written']
+        listed  = self.counters['tables_listed']
+        rate    = written / elapsed if elapsed > 0 else 0
+        if self.listing_complete == True and rate > 0:
+            eta = str(dt.timedelta(seconds=int((listed - written) / rate)))
+        else:
+            eta = '? (still listing)'
+
+        return '{} of {} tables written, {:.1f} tables/s, {} failed, {} API retries, elapsed {}, eta {}'.format(
+            written, listed, rate, self.counters['tables_failed'], governor.stats()['retries'], str(dt.timedelta(seconds=int(elapsed))), eta)
+
+    def summary(self):
+        """
+        Totals of the crawl as a dict
+        """
+        elapsed = time.monotonic() - self.start
+        with self.lock:
+            summary = OrderedDict()
+            summary['crawl_seconds']     = round(elapsed, 3)
+            summary['tables_per_second'] = round(self.counters['tables_written'] / elapsed, 3) if elapsed > 0 else None
+            summary['counters']          = dict(self.counters)
+            summary['governor']          = governor.stats()
+            summary['histograms']        = OrderedDict()
+            for (metric, label), (buckets, total, count) in self.histograms.items():
+                summary['histograms'].setdefault(metric, OrderedDict())[label] = {
+                    'count'       : count,
+                    'sum_seconds' : round(total, 6),
+                    'avg_seconds' : round(total / count, 6),
+                    'buckets'     : OrderedDict(('+Inf' if bound == float('inf') else str(bound), bucket) for bound, bucket in zip(latency_buckets, buckets))}
+
+        return summary
+
+    def prometheus(self):
+        """
+        The metrics in the Prometheus text format, histograms have cumulative buckets
+        """
+        summary = self.summary()
+        lines = []
+        label_names = {'api_call_seconds': 'call', 'writer_flush_seconds': 'sink'}
+        for metric, labels in summary['histograms'].items():
+            name = 'bq_crawler_' + metric
+            lines.append('# HELP {} {}'.format(name, metric_help.get(metric, metric)))
+            lines.append('# TYPE {} histogram'.format(name))
+            for label, histogram in labels.items():
+                label_pair = '{}="{}"'.format(label_names.get(metric, 'label'), label)
+                cumulative = 0
+                for bound, bucket in histogram['buckets'].items():
+                    cumulative += bucket
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_pair, bound, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(name, label_pair, histogram['sum_seconds']))
+                lines.append('{}_count{{{}}} {}'.format(name, label_pair, histogram['count']))
+        for counter, value in sorted(summary['counters'].items()):
+            name = 'bq_crawler_' + counter + '_total'
+            lines.append('# HELP {} {}'.format(name, metric_help.get(counter, counter)))
+            lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, value))
+        for counter, value in sorted(summary['governor'].items()):
+            name = 'bq_crawler_api_' + counter
+            if counter == 'concurrency_limit':
+                lines.append('# TYPE {} gauge'.format(name))
+            else:
+                name = name + '_total'
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{} {}'.format(name, value))
+        for gauge in ['crawl_seconds', 'tables_per_second']:
+            lines.append('# TYPE bq_crawler_{} gauge'.format(gauge))
+            lines.append('bq_crawler_{} {}'.format(gauge, summary[gauge] or 0))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prom_path=None):
+        """
+        Save the summary as JSON and/or a Prometheus textfile, written to a temp file & renamed so a collector never reads half a file
+        """
+        for path, text in [(json_path, lambda: json.dumps(self.summary(), indent=4)), (prom_path, self.prometheus)]:
+            if path == None:
+                continue
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(text())
+            os.replace(temp_path, path)
+            print('Metrics saved to:', path)
+
+
+metrics = CrawlMetrics()
+
+
 def crawler(project):
     """
     Crawl all of the datasets and tables in the project
+    Returns a generator, the rows stream out as the tables are fetched
+    """
+
+    if checkpoint == None:
+        return iter_table_details(iter_all_tables(project))
+
+    # resuming, retry the tables that failed & skip the work that's already done, the retried tables aren't listed again
+    skip_tables = checkpoint.completed_tables | set(checkpoint.retry_tables)
+    all_tables = itertools.chain(checkpoint.retry_tables, iter_all_tables(project, checkpoint.completed_datasets, skip_tables))
+
+    return iter_table_details(all_tables)
+
+
+def iter_all_tables(project, completed_datasets=(), completed_tables=()):
+    """
+    List every dataset.table in the project, one dataset at a time
+    Datasets & tables that a resumed crawl already finished are skipped
     """
     
-    client.list_datasets(project=project)
-    datasets = list(client.list_datasets())
-    all_tables = []
-    counter = 0
+    datasets = list_datasets(client)
     
     for dataset in datasets:
         dataset_nm = dataset.dataset_id
-        tables_list = list(client.list_tables(dataset_nm))
+        if dataset_nm in completed_datasets:
+            continue
+        tables_list = governor.call('list_tables', lambda: list(client.list_tables(dataset_nm)))
         
         for table in tables_list:
             dataset_table_name = dataset_nm + '.' + table.table_id
-            all_tables.append(dataset_table_name)
-            counter += 1
-            if counter % count_incr == 0:
-                print(counter, 'tables crawled')
-                
-    print(counter, 'tables crawled')
+            if dataset_table_name in completed_tables:
+                continue
+            if crawl_filter.table_selected(table.table_id, table.table_type) == False:
+                metrics.increment('tables_filtered')
+                continue
+            metrics.increment('tables_listed')
+            yield dataset_table_name
 
-    all_table_details = []
-    for table in all_tables:
-        table_details = get_table_details(table)
-        all_table_details.append(table_details)
-        
-    return all_table_details
+    metrics.listing_complete = True
+
+
+def iter_table_details(all_tables, versions=None):
+    """
+    Get the details for each table, in parallel when --workers is set
+    Only a few tables per worker are in flight so memory doesn't grow with the project size
+    versions collects the snapshot version of each fetched table for an incremental crawl
+    """
+
+    max_in_flight = max(workers, 1) * 2
+    in_flight = deque()
+    tables = iter(all_tables)
+    failed_tables = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        while True:
+            for dataset_table_name in tables:
+                in_flight.append((dataset_table_name, executor.submit(fetch_table_details, dataset_table_name, versions)))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if len(in_flight) == 0:
+                break
+
+            # results are taken in submission order so the output is deterministic
+            dataset_table_name, future = in_flight.popleft()
+            table_details, error = future.result()
+            if checkpoint != None:
+                checkpoint.table_done(dataset_table_name, table_details)
+            if error is None:
+                yield table_details
+            else:
+                failed_tables.append(dataset_table_name)
+                metrics.increment('tables_failed')
+                print('Failed to get details for', dataset_table_name, error)
+
+    if len(failed_tables) > 0:
+        print(len(failed_tables), 'tables failed:', ', '.join(failed_tables))
 
 
-def get_table_details(dataset_tablename):
+def fetch_table_details(dataset_tablename, versions=None):
+    """
+    Wraps get_table_details so one failing table doesn't stop the rest of the crawl
+    """
+    try:
+        return get_table_details(dataset_tablename, versions), None
+    except Exception as e:
+        return None, e
+
+
+def get_table_details(dataset_tablename, versions=None):
     """
     Extract details using the BQ API
     """
+    table = governor.call('get_table', client.get_table, dataset_tablename)
+    table_doc = table_to_doc(table, dataset_tablename)
+    if versions != None:
+        versions[table.full_table_id] = table_version(table, table_doc['schema_hash'])
+
+    return table_doc
+
+
+def table_to_doc(table, dataset_tablename):
+    """
+    Convert a bigquery.Table into the crawler's output row
+    """
     dataset = dataset_tablename.split('.')[0]
-    table = client.get_table(dataset_tablename)
     
     type_list = list()
     table_schema = table.schema
@@ -133,9 +649,16 @@ def get_table_details(dataset_tablename):
     for i in table_schema:
         column_list.append(i.name)
     column_list.sort()
+    column_count = len(column_list)
+
+    table_hash = schema_hash(table_schema)
+    if schema_store != None:
+        # the columns are saved once in the schemas file, the row references them by hash
+        schema_store.add(table_hash, table_schema)
+        column_list = []
     
-    table_doc = OrderedDict()
-    table_doc['log_date']          = dt.datetime.now()
+    table_doc = TableRow()
+    table_doc['log_date']          = crawl_log_date
     table_doc['project']           = table.project
     table_doc['dataset']           = dataset
     table_doc['table_path']        = table.path
@@ -149,7 +672,7 @@ def get_table_details(dataset_tablename):
     table_doc['location']          = table.location
     table_doc['description']       = table.description
     table_doc['labels']            = str(table.labels) # conver this to tuples in an array?
-    table_doc['column_count']      = len(column_list)
+    table_doc['column_count']      = column_count
     table_doc['column_names']      = column_list
     table_doc['partitioning_type'] = table.partitioning_type
     
@@ -163,10 +686,10 @@ def get_table_details(dataset_tablename):
         table_doc['range_part_end']      = None
         table_doc['range_part_interval'] = None
         table_doc['range_part_start']    = None
-    try:
+    if table.time_partitioning != None:
         table_doc['time_partition_field'] = table.time_partitioning.field
         table_doc['time_partition_type']  = table.time_partitioning.type_
-    except:
+    else:
         table_doc['time_partition_field'] = None
         table_doc['time_partition_type']  = None
     if table.clustering_fields != None:
@@ -174,14 +697,7 @@ def get_table_details(dataset_tablename):
     else:
         table_doc['clustering_fields']    = []
         
-    table_doc['size_mb']  = int(table.num_bytes / 1000000)
-    table_doc['num_rows'] = table.num_rows
-    try:
-        table_doc['avg_byte_per_row']  = round(table.num_bytes / table.num_rows, 2)
-        table_doc['avg_kbyte_per_row'] = round(int(table.num_bytes / 1000) / table.num_rows, 2)
-    except:
-        table_doc['avg_byte_per_row']  = None
-        table_doc['avg_kbyte_per_row'] = None
+    set_table_size(table_doc, table.num_bytes, table.num_rows)
 
     table_doc['float']     = None
     table_doc['datetime']  = None
@@ -199,20 +715,1306 @@ def get_table_details(dataset_tablename):
     table_doc['string']    = None
     
     table_doc.update(schema_types_count)
+    table_doc['schema_hash'] = table_hash
     
     return table_doc
 
 
+def set_table_size(table_doc, num_bytes, num_rows):
+    """
+    Set the size & average row size columns
+    """
+    table_doc['size_mb']  = int(num_bytes / 1000000)
+    table_doc['num_rows'] = num_rows
+    # empty tables & tables without a row count don't have an average
+    if num_rows:
+        table_doc['avg_byte_per_row']  = round(num_bytes / num_rows, 2)
+        table_doc['avg_kbyte_per_row'] = round(int(num_bytes / 1000) / num_rows, 2)
+    else:
+        table_doc['avg_byte_per_row']  = None
+        table_doc['avg_kbyte_per_row'] = None
+
+
+def schema_hash(table_schema):
+    """
+    Hash of the column names, types & modes including the nested columns
+    """
+    schema_json = json.dumps(schema_fields(table_schema), sort_keys=True)
+
+    return hashlib.sha1(schema_json.encode('utf-8')).hexdigest()[:16]
+
+
+def schema_fields(table_schema):
+    """
+    The parts of a schema that make up its hash, as JSON ready dicts
+    """
+    return [{'name': field.name, 'type': field.field_type, 'mode': field.mode, 'fields': schema_fields(field.fields)} for field in table_schema]
+
+
+# --- crawl filters
+# The include & exclude filters are applied while listing: the dataset label filter is passed to list_datasets,
+# datasets that don't match aren't listed & tables that don't match never reach get_table.
+
+class CrawlFilter():
+    """
+    Decides which datasets & tables a crawl covers, regexes are matched with re.search against the dataset & table ids
+    """
+
+    def __init__(self, include_datasets=None, exclude_datasets=None, dataset_labels=None, include_tables=None, exclude_tables=None, table_types=None):
+        self.include_datasets = re.compile(include_datasets) if include_datasets != None else None
+        self.exclude_datasets = re.compile(exclude_datasets) if exclude_datasets != None else None
+        self.include_tables   = re.compile(include_tables) if include_tables != None else None
+        self.exclude_tables   = re.compile(exclude_tables) if exclude_tables != None else None
+        self.table_types      = set(table_type.strip().upper() for table_type in table_types.split(',')) if table_types != None else None
+        self.label_filter     = None
+        if dataset_labels != None:
+            # list_datasets takes labels.key or labels.key:value terms, all of them have to match
+            self.label_filter = ' '.join('labels.' + label.strip() for label in dataset_labels.split(',') if label.strip() != '')
+
+    def dataset_selected(self, dataset_id):
+        if self.include_datasets != None and self.include_datasets.search(dataset_id) == None:
+            return False
+        if self.exclude_datasets != None and self.exclude_datasets.search(dataset_id) != None:
+            return False
+        return True
+
+    def table_selected(self, table_id, table_type=None):
+        if self.include_tables != None and self.include_tables.search(table_id) == None:
+            return False
+        if self.exclude_tables != None and self.exclude_tables.search(table_id) != None:
+            return False
+        if self.table_types != None and table_type not in self.table_types:
+            return False
+        return True
+
+    def row_selected(self, row, listed_datasets):
+        """
+        True if a crawl with these filters would have listed the row's table
+        Without a label filter the datasets can be checked by id, with one only the listed datasets are known
+        """
+        if self.label_filter != None and row['dataset'] not in listed_datasets:
+            return False
+        return self.dataset_selected(row['dataset']) and self.table_selected(row['table_name'].split('.')[1], row['table_type'])
+
+
+crawl_filter = CrawlFilter()
+
+
+def list_datasets(bq_client):
+    """
+    List the project's datasets that pass the filters, the label filter is applied by the API
+    """
+    datasets = governor.call('list_datasets', lambda: list(bq_client.list_datasets(filter=crawl_filter.label_filter)))
+
+    return [dataset for dataset in datasets if crawl_filter.dataset_selected(dataset.dataset_id)]
+
+
+# --- sharded tables & schema dedup
+# Date sharded tables (events_20200101, events_20200102, ...) almost always share one schema. With --collapse_shards
+# only the latest shard of a family is fetched with get_table, the other shards get their sizes & times from the
+# dataset's __TABLES__ view and the rest of their row from that representative.
+# With --schemas_path each unique schema is written once & rows reference it by schema_hash.
+
+# a table name ending in a YYYYMMDD date, the prefix names the family
+shard_pattern = re.compile(r'^(.*?)_?((?:19|20)\d{6})$')
+
+# fewer shards than this are fetched as normal tables
+shard_family_min = 2
+
+# SchemaStore of the crawl when --schemas_path is set
+schema_store = None
+
+
+def shard_crawler(project):
+    """
+    Crawl like crawler() but fetch a single representative shard per family of date sharded tables
+    Returns a generator, a family's rows come out together in shard order
+    """
+
+    families = {} # representative dataset.table -> [(dataset.table, __TABLES__ row) of the other shards]
+
+    def tables_to_fetch():
+        for dataset_id, dataset_tables in itertools.groupby(iter_all_tables(project), key=lambda name: name.split('.')[0]):
+            dataset_tables = list(dataset_tables)
+            dataset_families = shard_families(dataset_tables)
+            storage = dataset_storage(project, dataset_id) if len(dataset_families) > 0 else None
+            if storage == None:
+                # no families or __TABLES__ failed, every table is fetched
+                dataset_families = {}
+            for dataset_table_name in dataset_tables:
+                family = dataset_families.get(dataset_table_name)
+                if family == None:
+                    yield dataset_table_name
+                elif dataset_table_name == family[-1]:
+                    # the latest shard is the representative, shards missing from __TABLES__ are fetched on their own
+                    families[dataset_table_name] = [(shard, storage[shard.split('.')[1]]) for shard in family[:-1] if shard.split('.')[1] in storage]
+                    for shard in family[:-1]:
+                        if shard.split('.')[1] not in storage:
+                            yield shard
+                    yield dataset_table_name
+
+    for row in iter_table_details(tables_to_fetch()):
+        for dataset_table_name, storage_row in families.pop(row['table_name'], []):
+            yield shard_row(row, dataset_table_name, storage_row)
+            metrics.increment('shards_collapsed')
+        yield row
+
+    # families whose representative failed to fetch
+    if len(families) > 0:
+        print(len(families), 'shard families skipped, their representative failed:', ', '.join(families))
+
+
+def shard_families(dataset_tables):
+    """
+    Group the date sharded tables of a dataset by prefix, maps each shard to its family's shards in date order
+    """
+    prefixes = OrderedDict()
+    for dataset_table_name in dataset_tables:
+        match = shard_pattern.match(dataset_table_name.split('.')[1])
+        if match != None:
+            prefixes.setdefault(match.group(1), []).append((match.group(2), dataset_table_name))
+
+    families = {}
+    for shards in prefixes.values():
+        if len(shards) >= shard_family_min:
+            family = [dataset_table_name for date, dataset_table_name in sorted(shards)]
+            for dataset_table_name in family:
+                families[dataset_table_name] = family
+
+    return families
+
+
+def dataset_storage(project, dataset_id):
+    """
+    Times, size & row count of every table in a dataset from its __TABLES__ view keyed by table id, None if the query fails
+    """
+    query = 'SELECT table_id, creation_time, last_modified_time, row_count, size_bytes FROM `{}.{}.__TABLES__`'.format(project, dataset_id)
+    try:
+        return {row['table_id']: row for row in governor.call('query', lambda: list(client.query(query).result()))}
+    except Exception as e:
+        print('Failed to list the tables of', dataset_id, 'its shards are fetched one by one', e)
+        return None
+
+
+def shard_row(representative, dataset_table_name, storage_row):
+    """
+    A shard's row, the representative's row with the shard's name, times & size
+    """
+    dataset_id, table_id = dataset_table_name.split('.')
+    row = representative.copy()
+    row['table_name']    = dataset_table_name
+    row['full_table_id'] = '{}:{}'.format(representative['project'], dataset_table_name)
+    row['table_path']    = '/projects/{}/datasets/{}/tables/{}'.format(representative['project'], dataset_id, table_id)
+    row['created']       = from_epoch_ms(storage_row['creation_time'])
+    row['modified']      = from_epoch_ms(storage_row['last_modified_time'])
+    row['column_names']  = list(representative['column_names'])
+    set_table_size(row, storage_row['size_bytes'], storage_row['row_count'])
+
+    return row
+
+
+def from_epoch_ms(epoch_ms):
+    """
+    Convert the epoch milliseconds of __TABLES__ to a UTC datetime, same as the API's table times
+    """
+    if epoch_ms == None:
+        return None
+
+    return dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc) + dt.timedelta(milliseconds=int(epoch_ms))
+
+
+class SchemaStore():
+    """
+    Appends each schema not seen before to a JSON lines file, one {schema_hash, fields} object per line
+    The hashes already in the file are loaded first so a schema is only saved once across crawls
+    """
+
+    def __init__(self, path):
+        self.path      = path
+        self.lock      = threading.Lock()
+        self.hashes    = set()
+        self.new_count = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                self.hashes.update(json.loads(line)['schema_hash'] for line in f if line.strip() != '')
+        self.outfile = open(path, 'a')
+
+    def add(self, table_hash, table_schema):
+        with self.lock:
+            if table_hash in self.hashes:
+                return
+            self.hashes.add(table_hash)
+            self.outfile.write(json.dumps({'schema_hash': table_hash, 'fields': schema_fields(table_schema)}) + '\n')
+            self.outfile.flush()
+            self.new_count += 1
+
+    def close(self):
+        self.outfile.close()
+        print(self.new_count, 'new schemas saved to:', self.path, len(self.hashes), 'in total')
+
+
+# --- incremental crawl
+# The snapshot file keeps the last crawl's rows keyed by full_table_id along with the table's version.
+# A cheap __TABLES__ query per dataset tells which tables changed, only those are fetched with get_table.
+
+# row fields that hold datetimes, they are stored as ISO strings in the snapshot
+snapshot_datetime_fields = ['log_date', 'created', 'modified', 'expires']
+
+
+def incremental_crawler(project):
+    """
+    Crawl only the new & changed tables, reuse the snapshot rows for the rest and tombstone deleted tables
+    Returns all the current rows, the rows that changed since the snapshot & the new snapshot
+    """
+
+    snapshot = load_snapshot(snapshot_path)
+    all_tables = list(iter_all_tables(project))
+    dataset_ids = list(OrderedDict.fromkeys(dataset_table_name.split('.')[0] for dataset_table_name in all_tables))
+    versions = list_table_versions(project, dataset_ids)
+
+    to_fetch = [dataset_table_name for dataset_table_name in all_tables
+                if table_changed(snapshot.get(project + ':' + dataset_table_name), versions.get(dataset_table_name))]
+    print(len(to_fetch), 'of', len(all_tables), 'tables are new or changed')
+    fetched_versions = {} # versions of the tables fetched with get_table, keyed by full_table_id
+    fetched = {row['table_name']: row for row in iter_table_details(to_fetch, fetched_versions)}
+
+    log_date = dt.datetime.now()
+    all_table_details = []
+    delta_rows = []
+    new_snapshot = OrderedDict()
+    for dataset_table_name in all_tables:
+        full_table_id = project + ':' + dataset_table_name
+        cached = snapshot.get(full_table_id)
+        if dataset_table_name in fetched:
+            row = fetched[dataset_table_name]
+            delta_rows.append(row)
+            new_snapshot[full_table_id] = dict(fetched_versions.get(full_table_id, {}), row=row)
+        elif cached != None and cached.get('deleted') == None:
+            # unchanged, or the fetch failed & the stale entry is kept so it is retried next run
+            row = cached['row']
+            row['log_date'] = log_date
+            new_snapshot[full_table_id] = cached
+        else:
+            continue
+        all_table_details.append(row)
+
+    # tables in the snapshot that are no longer listed
+    for full_table_id, cached in snapshot.items():
+        if full_table_id in new_snapshot:
+            continue
+        # tables the filters leave out weren't listed, they're kept as they are
+        if cached.get('deleted') == None and full_table_id.split(':')[0] == project and crawl_filter.row_selected(cached['row'], dataset_ids):
+            cached['deleted'] = log_date.isoformat()
+            tombstone = cached['row'].copy()
+            tombstone['log_date']   = log_date
+            tombstone['table_type'] = 'DELETED'
+            delta_rows.append(tombstone)
+        new_snapshot[full_table_id] = cached
+
+    print(len(delta_rows), 'tables new, changed or deleted')
+
+    return all_table_details, delta_rows, new_snapshot
+
+
+def list_table_versions(project, dataset_ids):
+    """
+    Get the last modified time & size of every table from each dataset's __TABLES__ view, keyed by dataset.table
+    """
+
+    def dataset_versions(dataset_id):
+        query = 'SELECT table_id, last_modified_time, size_bytes FROM `{}.{}.__TABLES__`'.format(project, dataset_id)
+        try:
+            return [(dataset_id + '.' + row['table_id'], (row['last_modified_time'], row['size_bytes'])) for row in governor.call('query', lambda: list(client.query(query).result()))]
+        except Exception as e:
+            # the dataset's tables are treated as changed & fetched
+            print('Failed to get table versions for', dataset_id, e)
+            return []
+
+    versions = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for dataset_versions_ls in executor.map(dataset_versions, dataset_ids):
+            versions.update(dataset_versions_ls)
+
+    return versions
+
+
+def table_version(table, table_hash):
+    """
+    The snapshot's version of a table, used to tell if it changed since the last crawl
+    table_hash is the schema_hash of the table's row
+    """
+    return {'modified'    : to_epoch_ms(table.modified) if table.modified != None else None,
+            'etag'        : table.etag,
+            'num_bytes'   : table.num_bytes,
+            'schema_hash' : table_hash}
+
+
+def table_changed(cached, version):
+    """
+    True if the table isn't in the snapshot or its modified time / size differ from the snapshot
+    """
+    if cached == None or cached.get('deleted') != None or version == None:
+        return True
+    modified, num_bytes = version
+
+    return cached.get('modified') != modified or cached.get('num_bytes') != num_bytes
+
+
+def load_snapshot(snapshot_path):
+    """
+    Read the previous crawl's snapshot, an empty snapshot if there isn't one yet
+    """
+    if not os.path.exists(snapshot_path):
+        print('No snapshot found at', snapshot_path, 'crawling every table')
+        return OrderedDict()
+
+    with open(snapshot_path) as f:
+        snapshot = json.load(f, object_pairs_hook=OrderedDict)
+
+    for cached in snapshot['tables'].values():
+        cached['row'] = restore_datetimes(TableRow(cached['row']))
+
+    return snapshot['tables']
+
+
+def restore_datetimes(row):
+    """
+    Turn the ISO strings of a row read back from JSON into datetimes
+    """
+    for key in snapshot_datetime_fields:
+        if isinstance(row.get(key), str):
+            row[key] = dt.datetime.fromisoformat(row[key])
+
+    return row
+
+
+def save_snapshot(snapshot_path, snapshot):
+    """
+    Write the snapshot to a temp file & swap it in so a failed write doesn't corrupt the previous snapshot
+    """
+
+    def json_date_fixer(dic_vals):
+        if isinstance(dic_vals, dt.datetime):
+            return dic_vals.isoformat()
+        if isinstance(dic_vals, TableRow):
+            return OrderedDict(dic_vals.items())
+
+    temp_path = snapshot_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'crawled': dt.datetime.now().isoformat(), 'tables': snapshot}, f, default=json_date_fixer)
+    os.replace(temp_path, snapshot_path)
+    print('Snapshot saved to:', snapshot_path)
+
+
+# --- multi project crawl
+# Listing datasets, listing tables & fetching table details are separate tasks on a shared process pool queue,
+# so a big project is spread over every process instead of one process setting the wall clock time.
+# Each process has its own clients, one per project.
+
+# tables per fetch task
+tables_per_task = 200
+
+# clients of this process, keyed by project
+project_clients = {}
+
+
+def multi_project_crawler(projects):
+    """
+    Crawl every dataset & table of each project on a process pool
+    Returns a generator, rows from all the projects come out as the tasks finish & are tagged by their project
+    """
+
+    failed_tasks = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_crawl_process,
+                             initargs=(workers, count_incr, governor.max_calls_per_second, governor.max_retries, crawl_filter)) as executor:
+        pending = set(executor.submit(list_project_datasets, project_id) for project_id in projects)
+        listing = set(pending) # the listing tasks that haven't finished, the ETA is known once they all have
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, result, metric_deltas, governor_deltas = future.result()
+                metrics.merge(*metric_deltas)
+                governor.merge(governor_deltas)
+                listing.discard(future)
+                if task == 'failed':
+                    failed_tasks.append(result)
+                    print('Failed:', result)
+                elif task == 'datasets':
+                    project_id, dataset_ids = result
+                    tables_tasks = [executor.submit(list_dataset_tables, project_id, dataset_id) for dataset_id in dataset_ids]
+                    pending.update(tables_tasks)
+                    listing.update(tables_tasks)
+                elif task == 'tables':
+                    project_id, dataset_tables = result
+                    metrics.increment('tables_listed', len(dataset_tables))
+                    for i in range(0, len(dataset_tables), tables_per_task):
+                        pending.add(executor.submit(fetch_table_chunk, project_id, dataset_tables[i:i + tables_per_task]))
+                else:
+                    for row in result:
+                        yield row
+                if len(listing) == 0:
+                    metrics.listing_complete = True
+
+    if len(failed_tasks) > 0:
+        print(len(failed_tasks), 'listing or fetch tasks failed')
+
+
+def init_crawl_process(workers_, count_incr_, max_calls_per_second, max_retries, crawl_filter_):
+    """
+    Sets the crawl settings in a worker process, each process governs its own API calls
+    """
+    global workers, count_incr, governor, crawl_filter, metrics
+
+    workers      = workers_
+    count_incr   = count_incr_
+    governor     = RequestGovernor(max_calls_per_second, workers, max_retries)
+    crawl_filter = crawl_filter_
+    metrics      = CrawlMetrics()
+
+
+def task_result(task, result):
+    """
+    A task's result with the process's metric & governor counts since its last task, the parent merges them
+    """
+    return task, result, metrics.drain(), governor.drain()
+
+
+def project_client(project_id):
+    """
+    This process's client for the project
+    """
+    if project_id not in project_clients:
+        project_clients[project_id] = client_factory(project=project_id)
+
+    return project_clients[project_id]
+
+
+def list_project_datasets(project_id):
+    """
+    Task: list the datasets of a project
+    """
+    try:
+        datasets = list_datasets(project_client(project_id))
+        return task_result('datasets', (project_id, [dataset.dataset_id for dataset in datasets]))
+    except Exception as e:
+        return task_result('failed', 'listing datasets of {}: {}'.format(project_id, e))
+
+
+def list_dataset_tables(project_id, dataset_id):
+    """
+    Task: list the tables of a dataset
+    """
+    try:
+        tables_list = governor.call('list_tables', lambda: list(project_client(project_id).list_tables(dataset_id)))
+        tables_list = [table for table in tables_list if crawl_filter.table_selected(table.table_id, table.table_type)]
+        return task_result('tables', (project_id, [dataset_id + '.' + table.table_id for table in tables_list]))
+    except Exception as e:
+        return task_result('failed', 'listing tables of {}.{}: {}'.format(project_id, dataset_id, e))
+
+
+def fetch_table_chunk(project_id, dataset_tables):
+    """
+    Task: fetch the details of a chunk of tables from one project
+    """
+    global client
+
+    # a process runs one task at a time, so the crawl functions can use the module client
+    client = project_client(project_id)
+    try:
+        return task_result('rows', list(iter_table_details(dataset_tables)))
+    except Exception as e:
+        return task_result('failed', 'fetching {} tables of {}: {}'.format(len(dataset_tables), project_id, e))
+
+
+# --- checkpoint & resume
+
+# tables between checkpoints
+checkpoint_every = 500
+
+
+class Checkpoint():
+    """
+    Saves the crawl progress so a crawl that dies can pick up where it stopped with --resume
+    The fetched rows are appended to <path>.rows.jsonl, the state file is swapped in atomically & records how much of it is valid
+    """
+
+    def __init__(self, path, project):
+        self.path               = path
+        self.rows_path          = path + '.rows.jsonl'
+        self.project            = project
+        self.completed_datasets = set()
+        self.completed_tables   = set() # only the tables of the dataset in progress, finished datasets are in completed_datasets
+        self.failed_tables      = []
+        self.retry_tables       = [] # tables that failed in the previous run
+        self.retry_pending      = set() # retry tables not done yet, saved as failed so a crash doesn't lose them
+        self.current_dataset    = None
+        self.rows_bytes         = 0
+        self.bq_rows_written    = 0 # rows of the rows file that are in BigQuery
+        self.bq_rows_replayed   = 0 # rows the previous runs had written to BigQuery, the sink starts counting after these
+        self.done_count         = 0
+        self.rows_file          = None
+        self.bq_sink            = None
+
+    def load(self):
+        """
+        Read the state of the previous run, returns False if there isn't one
+        """
+        if not os.path.exists(self.path):
+            print('No checkpoint found at', self.path, 'starting a new crawl')
+            return False
+
+        with open(self.path) as f:
+            state = json.load(f)
+        if state['project'] != self.project:
+            sys.exit('Checkpoint {} is for project {}'.format(self.path, state['project']))
+
+        self.completed_datasets = set(state['completed_datasets'])
+        self.completed_tables   = set(state['completed_tables'])
+        self.retry_tables       = state['failed_tables']
+        self.retry_pending      = set(self.retry_tables)
+        self.current_dataset    = state['current_dataset']
+        self.rows_bytes         = state['rows_bytes']
+        self.bq_rows_written    = state['bq_rows_written']
+        self.bq_rows_replayed   = state['bq_rows_written']
+
+        # drop any rows written after the last checkpoint
+        with open(self.rows_path, 'a') as rows_file:
+            rows_file.truncate(self.rows_bytes)
+        print('Resuming crawl,', len(self.completed_datasets), 'datasets done', len(self.retry_tables), 'tables to retry')
+
+        return True
+
+    def replay_rows(self):
+        """
+        The rows fetched before the checkpoint, in the order they were fetched
+        """
+        if self.rows_bytes == 0:
+            return
+        with open(self.rows_path) as rows_file:
+            for line in rows_file:
+                yield restore_datetimes(TableRow(json.loads(line, object_pairs_hook=OrderedDict)))
+
+    def start(self):
+        mode = 'a' if self.rows_bytes > 0 else 'w'
+        self.rows_file = open(self.rows_path, mode)
+
+    def table_done(self, dataset_table_name, table_details):
+        """
+        Record a fetched or failed table, table_details is None if the fetch failed
+        """
+        dataset = dataset_table_name.split('.')[0]
+
+        # tables come back in listing order, so a new dataset means the previous one is finished
+        if dataset_table_name not in self.retry_tables and dataset != self.current_dataset:
+            if self.current_dataset != None:
+                self.completed_datasets.add(self.current_dataset)
+            self.completed_tables = set()
+            self.current_dataset  = dataset
+
+        self.retry_pending.discard(dataset_table_name)
+        if table_details == None:
+            self.failed_tables.append(dataset_table_name)
+        else:
+            self.completed_tables.add(dataset_table_name)
+            self.rows_file.write(table_details.to_json(json_date_fixer) + '\n')
+
+        self.done_count += 1
+        if self.done_count % checkpoint_every == 0:
+            self.save()
+
+    def save(self):
+        """
+        Flush the rows to disk then swap in the state that points at them
+        """
+        self.rows_file.flush()
+        os.fsync(self.rows_file.fileno())
+        if self.bq_sink != None:
+            self.bq_rows_written = self.bq_rows_replayed + self.bq_sink.committed_count()
+
+        state = {'project'            : self.project,
+                 'saved'              : dt.datetime.now().isoformat(),
+                 'completed_datasets' : sorted(self.completed_datasets),
+                 'completed_tables'   : sorted(self.completed_tables),
+                 'failed_tables'      : self.failed_tables + sorted(self.retry_pending),
+                 'current_dataset'    : self.current_dataset,
+                 'rows_bytes'         : self.rows_file.tell(),
+                 'bq_rows_written'    : self.bq_rows_written}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        """
+        The crawl finished, the checkpoint isn't needed anymore
+        """
+        self.rows_file.close()
+        for path in [self.path, self.rows_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# --- bulk INFORMATION_SCHEMA engine
+# Builds the same rows as get_table_details from a handful of queries per region instead of a get_table call per table.
+# The query results are turned into the API's table resource so table_to_doc can be reused as is.
+
+# INFORMATION_SCHEMA.TABLES table_type -> API table type
+bulk_table_types = {'BASE TABLE'        : 'TABLE',
+                    'CLONE'             : 'TABLE',
+                    'VIEW'              : 'VIEW',
+                    'MATERIALIZED VIEW' : 'MATERIALIZED_VIEW',
+                    'EXTERNAL'          : 'EXTERNAL',
+                    'SNAPSHOT'          : 'SNAPSHOT'}
+
+# standard SQL column types -> the legacy type names returned by the API
+bulk_column_types = {'INT64'   : 'INTEGER',
+                     'FLOAT64' : 'FLOAT',
+                     'BOOL'    : 'BOOLEAN',
+                     'STRUCT'  : 'RECORD'}
+
+# max number of __TABLES__ views in one UNION ALL query, keeps the query well under the query length limit
+bulk_datasets_per_query = 500
+
+
+def bulk_crawler(project):
+    """
+    Crawl all of the datasets and tables in the project using region scoped INFORMATION_SCHEMA queries
+    Returns a generator like crawler()
+    """
+
+    datasets = list_datasets(client)
+    dataset_order = {dataset.dataset_id: i for i, dataset in enumerate(datasets)}
+
+    all_resources = []
+    for region, dataset_ids in dataset_regions(datasets).items():
+        print('Querying region', region, 'with', len(dataset_ids), 'datasets')
+        all_resources.extend(bulk_table_resources(project, region, dataset_ids))
+
+    # --regions queries every dataset of the region, keep the listed ones & the tables that pass the filters
+    listed_count = len(all_resources)
+    all_resources = [resource for resource in all_resources if resource['tableReference']['datasetId'] in dataset_order
+                     and crawl_filter.table_selected(resource['tableReference']['tableId'], resource['type'])]
+    metrics.increment('tables_filtered', listed_count - len(all_resources))
+
+    # same order as the per table crawl, datasets in listing order & tables sorted by name
+    all_resources.sort(key=lambda resource: (dataset_order.get(resource['tableReference']['datasetId'], len(datasets)), resource['tableReference']['tableId']))
+    metrics.increment('tables_listed', len(all_resources))
+    metrics.listing_complete = True
+
+    for resource in all_resources:
+        dataset_table_name = resource['tableReference']['datasetId'] + '.' + resource['tableReference']['tableId']
+        try:
+            table_doc = table_to_doc(bigquery.Table.from_api_repr(resource), dataset_table_name)
+        except Exception as e:
+            print('Failed to get details for', dataset_table_name, e)
+            continue
+        yield table_doc
+
+
+def dataset_regions(datasets):
+    """
+    Group the dataset ids by location, uses --regions if set otherwise looks up each dataset's location
+    """
+
+    regions = OrderedDict()
+    if bulk_regions != None:
+        for region in bulk_regions.split(','):
+            regions[region.strip().lower()] = None # None = every dataset in the region
+        return regions
+
+    for dataset in datasets:
+        location = governor.call('get_dataset', client.get_dataset, dataset.reference).location.lower()
+        regions.setdefault(location, []).append(dataset.dataset_id)
+
+    return regions
+
+
+def bulk_query(query, region):
+    """
+    Run a metadata query in the region & return the rows
+    """
+    return governor.call('query', lambda: list(client.query(query, location=region).result()))
+
+
+def bulk_table_resources(project, region, dataset_ids):
+    """
+    Query the region's INFORMATION_SCHEMA & __TABLES__ and join them by table into API table resources
+    """
+
+    info_schema = '`{}`.`region-{}`.INFORMATION_SCHEMA'.format(project, region)
+
+    schemata = bulk_query('SELECT schema_name, location FROM {}.SCHEMATA'.format(info_schema), region)
+    locations = {row['schema_name']: row['location'] for row in schemata}
+    if dataset_ids == None:
+        dataset_ids = sorted(locations)
+    dataset_ids = [dataset_id for dataset_id in dataset_ids if dataset_id in locations and crawl_filter.dataset_selected(dataset_id)]
+
+    tables = bulk_query('SELECT table_schema, table_name, table_type, creation_time, ddl FROM {}.TABLES'.format(info_schema), region)
+    options = bulk_query('SELECT table_schema, table_name, option_name, option_value FROM {}.TABLE_OPTIONS'.format(info_schema), region)
+    columns = bulk_query("""SELECT table_schema, table_name, column_name, ordinal_position, data_type, is_nullable, clustering_ordinal_position
+FROM   {}.COLUMNS
+WHERE  is_hidden = 'NO'""".format(info_schema), region)
+
+    # __TABLES__ is dataset scoped, UNION ALL them to keep it to a few queries per region
+    storage = []
+    for i in range(0, len(dataset_ids), bulk_datasets_per_query):
+        selects = ['SELECT dataset_id, table_id, last_modified_time, row_count, size_bytes FROM `{}.{}.__TABLES__`'.format(project, dataset_id)
+                   for dataset_id in dataset_ids[i:i + bulk_datasets_per_query]]
+        storage.extend(bulk_query('\nUNION ALL\n'.join(selects), region))
+
+    resources = OrderedDict()
+    wanted = set(dataset_ids)
+    for row in tables:
+        if row['table_schema'] not in wanted:
+            continue
+        resources[(row['table_schema'], row['table_name'])] = {
+            'tableReference' : {'projectId': project, 'datasetId': row['table_schema'], 'tableId': row['table_name']},
+            'id'             : '{}:{}.{}'.format(project, row['table_schema'], row['table_name']),
+            'type'           : bulk_table_types.get(row['table_type'], row['table_type']),
+            'location'       : locations[row['table_schema']],
+            'creationTime'   : str(to_epoch_ms(row['creation_time'])),
+            'schema'         : {'fields': []}}
+        resources[(row['table_schema'], row['table_name'])].update(ddl_partitioning(row['ddl']))
+
+    for row in storage:
+        resource = resources.get((row['dataset_id'], row['table_id']))
+        if resource != None:
+            resource['lastModifiedTime'] = str(row['last_modified_time'])
+            resource['numRows']          = str(row['row_count'])
+            resource['numBytes']         = str(row['size_bytes'])
+
+    for row in options:
+        resource = resources.get((row['table_schema'], row['table_name']))
+        if resource == None:
+            continue
+        if row['option_name'] == 'description':
+            resource['description'] = parse_option_string(row['option_value'])
+        elif row['option_name'] == 'friendly_name':
+            resource['friendlyName'] = parse_option_string(row['option_value'])
+        elif row['option_name'] == 'labels':
+            resource['labels'] = parse_option_labels(row['option_value'])
+        elif row['option_name'] == 'expiration_timestamp':
+            expires = dt.datetime.strptime(parse_option_string(row['option_value'].split(' ', 1)[1])[:19], '%Y-%m-%dT%H:%M:%S')
+            resource['expirationTime'] = str(to_epoch_ms(expires.replace(tzinfo=dt.timezone.utc)))
+
+    clustering = {}
+    for row in sorted(columns, key=lambda row: row['ordinal_position']):
+        resource = resources.get((row['table_schema'], row['table_name']))
+        if resource == None:
+            continue
+        field_type, mode = column_type(row['data_type'])
+        if row['is_nullable'] == 'NO' and mode != 'REPEATED':
+            mode = 'REQUIRED'
+        field = {'name': row['column_name'], 'type': field_type, 'mode': mode}
+        if field_type == 'RECORD':
+            field['fields'] = struct_fields(row['data_type'])
+        resource['schema']['fields'].append(field)
+        if row['clustering_ordinal_position'] != None:
+            clustering.setdefault((row['table_schema'], row['table_name']), []).append((row['clustering_ordinal_position'], row['column_name']))
+
+    for key, fields in clustering.items():
+        resources[key]['clustering'] = {'fields': [name for position, name in sorted(fields)]}
+
+    return list(resources.values())
+
+
+def to_epoch_ms(timestamp):
+    """
+    Convert a timezone aware datetime to the epoch milliseconds the API uses
+    """
+    return int(timestamp.timestamp() * 1000)
+
+
+def column_type(data_type):
+    """
+    Convert an INFORMATION_SCHEMA.COLUMNS data_type into the API's legacy type name & mode
+    """
+    mode = 'NULLABLE'
+    if data_type.startswith('ARRAY<'):
+        mode = 'REPEATED'
+        data_type = data_type[len('ARRAY<'):-1]
+    base_type = re.split(r'[<(]', data_type, 1)[0].strip()
+
+    return bulk_column_types.get(base_type, base_type), mode
+
+
+def struct_fields(data_type):
+    """
+    The nested API fields of a STRUCT or ARRAY<STRUCT> data_type, Ex: STRUCT<a INT64, b ARRAY<STRUCT<c STRING NOT NULL>>>
+    """
+    if data_type.startswith('ARRAY<'):
+        data_type = data_type[len('ARRAY<'):-1]
+    if data_type.startswith('STRUCT<') == False:
+        return []
+
+    # split the members on the commas that aren't inside <>, () or a quoted name
+    members = []
+    depth, quoted, start = 0, False, len('STRUCT<')
+    for i in range(start, len(data_type) - 1):
+        char = data_type[i]
+        if char == '`':
+            quoted = not quoted
+        elif quoted == False and char in '<(':
+            depth += 1
+        elif quoted == False and char in '>)':
+            depth -= 1
+        elif quoted == False and depth == 0 and char == ',':
+            members.append(data_type[start:i])
+            start = i + 1
+    members.append(data_type[start:len(data_type) - 1])
+
+    fields = []
+    for member in members:
+        member = member.strip()
+        if member.startswith('`'):
+            name, member_type = member[1:].split('`', 1)
+        else:
+            name, member_type = member.split(None, 1)
+        member_type = member_type.strip()
+        required = member_type.endswith(' NOT NULL')
+        if required == True:
+            member_type = member_type[:-len(' NOT NULL')].strip()
+        field_type, mode = column_type(member_type)
+        field = {'name': name, 'type': field_type, 'mode': 'REQUIRED' if required == True and mode != 'REPEATED' else mode}
+        if field_type == 'RECORD':
+            field['fields'] = struct_fields(member_type)
+        fields.append(field)
+
+    return fields
+
+
+def parse_option_string(option_value):
+    """
+    TABLE_OPTIONS values are SQL literals, turn a quoted string literal into a python string
+    """
+    try:
+        return json.loads(option_value)
+    except ValueError:
+        return option_value.strip('"')
+
+
+def parse_option_labels(option_value):
+    """
+    Labels are stored as [STRUCT("key", "value"), ...]
+    """
+    return dict((json.loads(key), json.loads(value)) for key, value in re.findall(r'STRUCT\(("(?:[^"\\]|\\.)*"), ("(?:[^"\\]|\\.)*")\)', option_value))
+
+
+def ddl_partitioning(ddl):
+    """
+    Pull the time / integer range partitioning out of the table's DDL
+    """
+
+    match = re.search(r'^PARTITION BY (.+)$', ddl or '', re.MULTILINE)
+    if match == None:
+        return {}
+    expression = match.group(1).replace('`', '').strip()
+
+    range_bucket = re.match(r'RANGE_BUCKET\((\w+), GENERATE_ARRAY\((-?\d+), (-?\d+), (-?\d+)\)\)', expression)
+    if range_bucket != None:
+        field, start, end, interval = range_bucket.groups()
+        return {'rangePartitioning': {'field': field, 'range': {'start': start, 'end': end, 'interval': interval}}}
+
+    if expression in ('_PARTITIONDATE', 'DATE(_PARTITIONTIME)'):
+        return {'timePartitioning': {'type': 'DAY'}}
+
+    truncated = re.match(r'(?:TIMESTAMP|DATETIME|DATE)_TRUNC\((\w+), (\w+)\)', expression)
+    if truncated != None:
+        field, partition_type = truncated.groups()
+    else:
+        field, partition_type = re.match(r'(?:DATE\()?(\w+)\)?', expression).group(1), 'DAY'
+
+    time_partitioning = {'type': partition_type.upper()}
+    if field != '_PARTITIONTIME':
+        time_partitioning['field'] = field
+
+    return {'timePartitioning': time_partitioning}
+
+
+
+# --- output sinks
+# Each sink writes rows as they come out of the crawl, so partial results are on disk while the crawl runs
+
+# rows between flushes of the local output files
+sink_flush_rows = 100
+
+# rows per Parquet row group, larger groups compress better but are held in memory until written
+parquet_row_group_rows = 10000
+
+# streaming insert limits, a request can be 10MB & 50,000 rows but 500 rows is the recommended batch size
+# the byte limit leaves headroom for the request envelope
+bq_batch_size     = 500
+bq_batch_bytes    = 9 * 1024 * 1024
+bq_insert_retries = 5
+
+# first retry waits about this long, doubling with each retry
+backoff_seconds = 1.0
+
+# errors worth retrying an insert or load for
+retryable_errors = (exceptions.TooManyRequests, exceptions.InternalServerError, exceptions.ServiceUnavailable,
+                    exceptions.BadGateway, exceptions.GatewayTimeout, ConnectionError)
+
+
+def json_date_fixer(dic_vals):
+    if isinstance(dic_vals, dt.datetime):
+        return dic_vals.__str__()
+
+
+class CsvSink():
+    """
+    Write the table details to a local csv, the header comes from the first row
+    """
+
+    def __init__(self, path):
+        self.path        = path
+        self.output_file = open(path, 'w')
+        self.writer      = None
+        self.row_count   = 0
+
+    def write(self, row):
+        if self.writer == None:
+            self.writer = csv.writer(self.output_file)
+            self.writer.writerow(row.keys())
+        self.writer.writerow(row.values())
+        self.row_count += 1
+        if self.row_count % sink_flush_rows == 0:
+            with metrics.timer('writer_flush_seconds', 'csv'):
+                self.output_file.flush()
+
+    def close(self):
+        self.output_file.close()
+        print('CSV saved to:', self.path)
+
+
+class JsonSink():
+    """
+    Write the table details to a JSON output file, a single JSON array written one row at a time
+    """
+
+    def __init__(self, path):
+        self.path      = path
+        self.outfile   = open(path, 'w')
+        self.row_count = 0
+        self.outfile.write('[')
+
+    def write(self, row):
+        if self.row_count > 0:
+            self.outfile.write(', ')
+        self.outfile.write(row.to_json(json_date_fixer))
+        self.row_count += 1
+        if self.row_count % sink_flush_rows == 0:
+            with metrics.timer('writer_flush_seconds', 'json'):
+                self.outfile.flush()
+
+    def close(self):
+        self.outfile.write(']')
+        self.outfile.close()
+        print('JSON saved to:', self.path)
+
+
+class JsonLinesSink(JsonSink):
+    """
+    Write the table details to a JSON Lines output file, one JSON object per line
+    """
+
+    def __init__(self, path):
+        self.path      = path
+        self.outfile   = open(path, 'w')
+        self.row_count = 0
+
+    def write(self, row):
+        self.outfile.write(row.to_json(json_date_fixer) + '\n')
+        self.row_count += 1
+        if self.row_count % sink_flush_rows == 0:
+            with metrics.timer('writer_flush_seconds', 'jsonl'):
+                self.outfile.flush()
+
+    def close(self):
+        self.outfile.close()
+        print('JSON Lines saved to:', self.path)
+
+
+class ParquetSink():
+    """
+    Write the table details to a Parquet file typed by the output schema, REPEATED columns are list columns
+    Rows are buffered per column & written as a row group every parquet_row_group_rows rows
+    """
+
+    def __init__(self, path, row_group_rows=None):
+        self.path           = path
+        self.row_group_rows = row_group_rows or parquet_row_group_rows
+        self.arrow_schema   = arrow_schema()
+        self.writer         = pyarrow.parquet.ParquetWriter(path, self.arrow_schema, compression='snappy')
+        self.converters     = [arrow_converter(field) for field in schema]
+        self.columns        = [[] for field in schema]
+        self.buffered       = 0
+        self.row_count      = 0
+
+    def write(self, row):
+        for column, convert, value in zip(self.columns, self.converters, row.values()):
+            column.append(convert(value))
+        self.buffered += 1
+        if self.buffered >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        with metrics.timer('writer_flush_seconds', 'parquet'):
+            self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=arrow_field.type) for column, arrow_field in zip(self.columns, self.arrow_schema)],
+                                                              schema=self.arrow_schema))
+        self.row_count += self.buffered
+        self.columns  = [[] for field in schema]
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        print('Parquet saved to:', self.path)
+
+
+# BigQuery column types -> Arrow types, NUMERIC is a decimal with BigQuery's precision & scale so the file loads into the output table
+arrow_types = {'STRING'   : lambda: pyarrow.string(),
+               'INT64'    : lambda: pyarrow.int64(),
+               'NUMERIC'  : lambda: pyarrow.decimal128(38, 9),
+               'DATETIME' : lambda: pyarrow.timestamp('us')}
+
+
+def arrow_schema():
+    """
+    The output schema as an Arrow schema
+    """
+    fields = []
+    for field in schema:
+        arrow_type = arrow_types[field.field_type]()
+        if field.mode == 'REPEATED':
+            arrow_type = pyarrow.list_(arrow_type)
+        fields.append(pyarrow.field(field.name, arrow_type))
+
+    return pyarrow.schema(fields)
+
+
+def arrow_converter(field):
+    """
+    Function that turns a row value into a value Arrow accepts for the field's type
+    """
+    if field.field_type == 'NUMERIC' and field.mode != 'REPEATED':
+        # the rows hold rounded floats, str() keeps their decimal digits
+        return lambda value: decimal.Decimal(str(value)) if value != None else None
+    if field.mode == 'REPEATED':
+        return lambda value: list(value) if value != None else []
+
+    return lambda value: value
+
+
+class BigQuerySink():
+    """
+    Streams the table details to the BigQuery output table with insert_rows_json
+    Rows are batched by row count & payload size, failed batches are retried with backoff
+    """
+
+    def __init__(self, batch_size=None, batch_bytes=None):
+        self.batch_size   = batch_size or bq_batch_size
+        self.batch_bytes  = batch_bytes or bq_batch_bytes
+        self.buffer       = []
+        self.buffer_bytes = 0
+        self.row_count    = 0
+        self.failed_rows  = [] # (table_name, errors)
+        self.received     = 0
+        self.on_flush     = None # called after each batch is sent, the checkpoint saves how many rows are in BigQuery
+
+    def write(self, row):
+        # the rows are buffered as they are & converted to JSON values when their batch is sent, the size is estimated
+        # from the values. Escapes aren't counted, bq_batch_bytes leaves headroom & a request that's too large is split
+        row_bytes = row_json_bytes(row) + 2 # separator between rows in the request body
+        if len(self.buffer) > 0 and (len(self.buffer) >= self.batch_size or self.buffer_bytes + row_bytes > self.batch_bytes):
+            self.flush()
+        self.buffer.append((str(uuid.uuid4()), row))
+        self.buffer_bytes += row_bytes
+        self.received += 1
+
+    def committed_count(self):
+        """
+        Rows that have been sent to BigQuery, written or failed
+        """
+        return self.received - len(self.buffer)
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        with metrics.timer('writer_flush_seconds', 'bigquery'):
+            self.insert_batch([(row_id, row_to_json(row)) for row_id, row in self.buffer])
+        self.buffer       = []
+        self.buffer_bytes = 0
+        if self.on_flush != None:
+            self.on_flush()
+
+    def insert_batch(self, batch):
+        """
+        Insert one batch, the row ids make retries idempotent
+        Rows BigQuery rejected are recorded, rows it stopped because of another row's error are retried
+        """
+        for attempt in range(bq_insert_retries + 1):
+            try:
+                errors = client.insert_rows_json(output_bq_table, [json_row for row_id, json_row in batch], row_ids=[row_id for row_id, json_row in batch])
+            except retryable_errors as e:
+                if attempt == bq_insert_retries:
+                    self.failed_rows.extend((json_row['table_name'], str(e)) for row_id, json_row in batch)
+                    print('Giving up on', len(batch), 'rows', e)
+                    return
+                metrics.increment('writer_retries')
+                backoff(attempt, e)
+                continue
+            except exceptions.GoogleAPICallError as e:
+                # request too large, split the batch & try each half
+                if (e.code == 413 or 'payload size exceeds' in str(e)) and len(batch) > 1:
+                    self.insert_batch(batch[:len(batch) // 2])
+                    self.insert_batch(batch[len(batch) // 2:])
+                    return
+                self.failed_rows.extend((json_row['table_name'], str(e)) for row_id, json_row in batch)
+                print('Failed to insert', len(batch), 'rows', e)
+                return
+
+            stopped = []
+            for error in errors:
+                reasons = [row_error.get('reason') for row_error in error['errors']]
+                if all(reason == 'stopped' for reason in reasons):
+                    stopped.append(batch[error['index']])
+                else:
+                    self.failed_rows.append((batch[error['index']][1]['table_name'], error['errors']))
+                    print('Row rejected', batch[error['index']][1]['table_name'], error['errors'])
+            self.row_count += len(batch) - len(errors)
+            if len(stopped) == 0:
+                return
+            metrics.increment('writer_retries')
+            batch = stopped
+
+        self.failed_rows.extend((json_row['table_name'], 'stopped') for row_id, json_row in batch)
+
+    def close(self):
+        self.flush()
+        print(self.row_count, 'written to', output_bq_table)
+        if len(self.failed_rows) > 0:
+            print(len(self.failed_rows), 'rows failed to write to', output_bq_table)
+
+
+class BigQueryLoadSink():
+    """
+    Writes the table details to a local NDJSON file & loads it into the BigQuery output table with one load job
+    Load jobs are free & don't have the streaming insert limits
+    """
+
+    def __init__(self):
+        self.outfile   = tempfile.NamedTemporaryFile(mode='w+b', suffix='.json')
+        self.row_count = 0
+
+    def committed_count(self):
+        # nothing is in BigQuery until the load job runs at the end
+        return 0
+
+    def write(self, row):
+        self.outfile.write((json.dumps(row_to_json(row)) + '\n').encode('utf-8'))
+        self.row_count += 1
+
+    def discard(self):
+        """
+        Drop the rows without loading them, a resumed crawl loads them from its checkpoint
+        """
+        self.outfile.close()
+
+    def close(self):
+        if self.row_count == 0:
+            self.outfile.close()
+            return
+        job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                                            schema=schema,
+                                            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+                                            ignore_unknown_values=True)
+        for attempt in range(bq_insert_retries + 1):
+            try:
+                self.outfile.seek(0)
+                with metrics.timer('writer_flush_seconds', 'bigquery_load'):
+                    load_job = client.load_table_from_file(self.outfile, output_bq_table, job_config=job_config)
+                    load_job.result()
+                break
+            except retryable_errors as e:
+                if attempt == bq_insert_retries:
+                    raise
+                metrics.increment('writer_retries')
+                backoff(attempt, e)
+        self.outfile.close()
+        print(self.row_count, 'loaded to', output_bq_table)
+
+
+# the output schema's column names in order & its DATETIME columns
+column_names     = [field.name for field in schema]
+datetime_columns = [field.name for field in schema if field.field_type == 'DATETIME']
+
+
+def row_to_json(row):
+    """
+    Convert a row into the JSON values BigQuery expects, keyed by the output schema in column order
+    """
+    json_row = dict(zip(column_names, row.values()))
+    for name in datetime_columns:
+        if isinstance(json_row[name], dt.datetime):
+            # DATETIME columns don't take a time zone, same as insert_rows
+            json_row[name] = json_row[name].strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+    return json_row
+
+
+# the braces, keys & separators of a row's JSON object, the same for every row
+row_json_overhead = 2 + sum(len(json_key) + 2 for json_key in TableRow.json_keys)
+
+
+def json_bytes(value):
+    """
+    The length of a value's JSON, escapes aren't counted
+    """
+    value_type = type(value)
+    if value_type is str:
+        return len(value) + 2
+    if value is None:
+        return 4
+    if value_type is int or value_type is float:
+        return len(repr(value))
+    if value_type is list:
+        # the column lists are mostly names, a string is counted without a call
+        return 2 + sum([len(item) + 4 if type(item) is str else json_bytes(item) + 2 for item in value])
+    if value_type is bool:
+        return 5
+    if isinstance(value, dt.datetime):
+        return 28 # quoted %Y-%m-%dT%H:%M:%S.%f
+    if isinstance(value, dict):
+        return 2 + sum([len(key) + 4 + json_bytes(item) for key, item in value.items()])
+    if isinstance(value, tuple):
+        return json_bytes(list(value))
+
+    return len(str(value)) + 2
+
+
+def row_json_bytes(row):
+    """
+    Estimate a row's size in an insert request from its values without serializing it
+    """
+    return row_json_overhead + sum([json_bytes(value) for value in row.values()])
+
+
+def backoff(attempt, error):
+    """
+    Exponential backoff with jitter between retries
+    """
+    wait = min(backoff_seconds * 2 ** attempt, 60) * (0.5 + random.random() / 2)
+    print('Retrying in', round(wait, 1), 'seconds', error)
+    time.sleep(wait)
+
+
 def write_to_csv(all_table_details):
     """
     Write the table details to a local csv
     """
-    keys = all_table_details[0].keys()
-    with open(csv_path, 'w') as output_file:
-        dict_writer = csv.DictWriter(output_file, keys)
-        dict_writer.writeheader()
-        dict_writer.writerows(all_table_details)
-    print('CSV saved to:', csv_path)
+    write_to_sink(CsvSink(csv_path), all_table_details)
     
     
 # --- write to BQ
@@ -226,7 +2028,7 @@ def create_table(output_bq_table, dataset_n, table_n):
     
     print('checking if output table exists')
     try:
-        client.get_table(table_ref)
+        table = client.get_table(table_ref)
         table_exists = True
     except NotFound:
         table_exists = False
@@ -236,54 +2038,207 @@ def create_table(output_bq_table, dataset_n, table_n):
         table = bigquery.Table(full_table_name, schema=schema)
         client.create_table(table)
         print("Created table ", output_bq_table)
+    else:
+        # tables created by an older version of the crawler are missing the newer columns, add them at the end
+        existing = set(field.name for field in table.schema)
+        new_fields = [field for field in schema if field.name not in existing]
+        if len(new_fields) > 0:
+            table.schema = list(table.schema) + new_fields
+            client.update_table(table, ['schema'])
+            print('Added columns', ', '.join(field.name for field in new_fields), 'to', output_bq_table)
         
 
 def write_to_bq(all_table_details):
     """
     Write the table details to the BigQuery output table
     """
-    
-    rows = [tuple(row.values()) for row in all_table_details]
-    
-    print('num of rows to write',len(rows))
-    errors = client.insert_rows(output_bq_table, rows, selected_fields=schema)
-    if errors == []:
-        print(len(rows), 'written to', output_bq_table )
+    if bq_write_mode == 'load':
+        write_to_sink(BigQueryLoadSink(), all_table_details)
     else:
-        print(errors)
+        write_to_sink(BigQuerySink(), all_table_details)
 
         
 def write_to_json(all_table_details):
     """
     Write the table details to a JSON output file
     """
-    
-    def json_date_fixer(dic_vals):
-            if isinstance(dic_vals, dt.datetime):
-                return dic_vals.__str__()
-    
-    with open(json_path, 'w') as outfile:
-        json.dump(all_table_details, outfile, default=json_date_fixer)
+    write_to_sink(JsonSink(json_path), all_table_details)
+
+
+def write_to_sink(sink, all_table_details):
+    """
+    Write every row to the sink & close it
+    """
+    for row in all_table_details:
+        sink.write(row)
+    sink.close()
     
 
 def main():
+
+    global crawl_projects, processes, governor, crawl_filter, metrics, metrics_json, metrics_prom
+    global project, csv_path, json_path, jsonl_path, parquet_path, output_bq_table, count_incr, workers, engine, bulk_regions
+    global snapshot_path, bq_delta_only, collapse_shards, schemas_path, schema_store, bq_write_mode, checkpoint_path, resume, checkpoint
+    global des_proj, dataset_n, table_n, client, crawl_log_date
+
+    args = parser.parse_args()
+    project         = args.project
+    processes       = args.processes
+    csv_path        = args.csv_path
+    json_path       = args.json_path
+    jsonl_path      = args.jsonl_path
+    parquet_path    = args.parquet_path
+    output_bq_table = args.output_bq_table
+    bq_write_mode   = args.bq_write_mode
+    count_incr      = args.count_incr
+    workers         = args.workers
+    engine          = args.engine
+    bulk_regions    = args.regions
+    snapshot_path   = args.snapshot
+    bq_delta_only   = args.bq_delta_only
+    collapse_shards = args.collapse_shards
+    schemas_path    = args.schemas_path
+    checkpoint_path = args.checkpoint
+    resume          = args.resume
+
+    if output_bq_table != None:
+        des_proj, dataset_n, table_n = output_bq_table.split('.')
+
+    if csv_path == None and output_bq_table == None and json_path == None and jsonl_path == None and parquet_path == None:
+        sys.exit('No output target, set --csv_path, --json_path, --jsonl_path, --parquet_path or --output_bq_table')
+
+    if parquet_path != None and pyarrow == None:
+        sys.exit('--parquet_path needs pyarrow: pip install pyarrow')
+
+    if snapshot_path != None and engine == 'bulk':
+        sys.exit('--snapshot works with the api engine, the bulk engine already reads every table in a few queries')
+
+    if checkpoint_path != None and (snapshot_path != None or engine == 'bulk'):
+        sys.exit('--checkpoint works with a full crawl using the api engine')
+
+    if resume == True and checkpoint_path == None:
+        sys.exit('--resume needs --checkpoint')
+
+    if args.projects != None:
+        crawl_projects = [project_id.strip() for project_id in args.projects.split(',') if project_id.strip() != '']
+    if args.projects_file != None:
+        with open(args.projects_file) as f:
+            crawl_projects.extend(line.strip() for line in f if line.strip() != '')
+
+    if len(crawl_projects) > 0 and (snapshot_path != None or checkpoint_path != None or engine == 'bulk'):
+        sys.exit('A multi project crawl works with a full crawl using the api engine')
+
+    if collapse_shards == True and (snapshot_path != None or checkpoint_path != None or engine == 'bulk' or len(crawl_projects) > 0):
+        sys.exit('--collapse_shards works with a full crawl of one project using the api engine')
+
+    if schemas_path != None and len(crawl_projects) > 0:
+        sys.exit('--schemas_path works with a crawl of one project')
+
+    try:
+        crawl_filter = CrawlFilter(args.include_datasets, args.exclude_datasets, args.dataset_labels, args.include_tables, args.exclude_tables, args.table_types)
+    except re.error as e:
+        sys.exit('Invalid filter regex: {}'.format(e))
+
+    # create bigquery connection obj
+    client = client_factory(project=project)
+    governor = RequestGovernor(args.max_calls_per_second, workers, args.max_retries)
+    metrics = CrawlMetrics()
+    metrics_json = args.metrics_json
+    metrics_prom = args.metrics_prom
     
+    if schemas_path != None:
+        schema_store = SchemaStore(schemas_path)
+
     print('Starting crawl')
+    crawl_log_date = dt.datetime.now()
     
-    all_table_details = crawler(project)
-    result_count = len(all_table_details)
-    
-    print(result_count, ' tables found')
-    
-    if csv_path != None:
-        write_to_csv(all_table_details)
-        
-    if json_path != None:
-        write_to_json(all_table_details)
-    
+    # the output table is checked before any sink opens its file, a failure doesn't leave half written outputs
     if output_bq_table != None:
         create_table(output_bq_table, dataset_n, table_n)
-        write_to_bq(all_table_details)
+
+    # rows stream from the crawl straight into the sinks
+    sinks = []
+    result_count = 0
+    crawled = False
+    # the sinks are closed even if the crawl fails, so the files they wrote are complete & buffered rows are flushed
+    try:
+        if csv_path != None:
+            sinks.append(CsvSink(csv_path))
+        if json_path != None:
+            sinks.append(JsonSink(json_path))
+        if jsonl_path != None:
+            sinks.append(JsonLinesSink(jsonl_path))
+        if parquet_path != None:
+            sinks.append(ParquetSink(parquet_path))
+        if output_bq_table != None:
+            if bq_write_mode == 'load':
+                bq_sink = BigQueryLoadSink()
+            else:
+                bq_sink = BigQuerySink()
+            if bq_delta_only == False or snapshot_path == None:
+                sinks.append(bq_sink)
+
+        if checkpoint_path != None:
+            checkpoint = Checkpoint(checkpoint_path, project)
+            resuming = resume == True and checkpoint.load() == True
+            checkpoint.start()
+            if output_bq_table != None:
+                # every batch sent to BigQuery is saved in the checkpoint right away, a resume doesn't send it again
+                checkpoint.bq_sink = bq_sink
+                if bq_write_mode == 'stream':
+                    bq_sink.on_flush = checkpoint.save
+            if resuming == True:
+                # rebuild the outputs from the rows fetched before the checkpoint, minus the rows already in BigQuery
+                for row in checkpoint.replay_rows():
+                    for sink in sinks:
+                        if output_bq_table != None and sink is bq_sink and result_count < checkpoint.bq_rows_written:
+                            continue
+                        sink.write(row)
+                    result_count += 1
+
+        if snapshot_path != None:
+            all_table_details, delta_rows, new_snapshot = incremental_crawler(project)
+        elif engine == 'bulk':
+            all_table_details = bulk_crawler(project)
+        elif len(crawl_projects) > 0:
+            all_table_details = multi_project_crawler(crawl_projects)
+        elif collapse_shards == True:
+            all_table_details = shard_crawler(project)
+        else:
+            all_table_details = crawler(project)
+
+        for row in all_table_details:
+            for sink in sinks:
+                sink.write(row)
+            result_count += 1
+            metrics.row_written()
+        crawled = True
+    finally:
+        for sink in sinks:
+            if crawled == False and checkpoint != None and isinstance(sink, BigQueryLoadSink):
+                # the checkpoint can't tell which rows a load job committed, the resumed crawl loads all of them
+                sink.discard()
+            else:
+                sink.close()
+    
+    print(result_count, ' tables found')
+
+    if output_bq_table != None and bq_delta_only == True and snapshot_path != None:
+        write_to_sink(bq_sink, delta_rows)
+
+    # saved after the outputs are written so a failed write is picked up again by the next run
+    if snapshot_path != None:
+        save_snapshot(snapshot_path, new_snapshot)
+
+    if checkpoint != None:
+        checkpoint.remove()
+
+    if schema_store != None:
+        schema_store.close()
+
+    print(metrics.progress_line())
+    print('API calls:', governor.stats())
+    metrics.write(metrics_json, metrics_prom)
         
     print('Crawl completed')
 
@@ -4,15 +4,37 @@
 # update to use Jinja template? 
 
 from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+import re
+import os
 import json
 import csv
+import sys
+import time
+import fnmatch
+import decimal
+import hashlib
 import argparse
 import datetime
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint as prt
 
+# pyarrow & numpy are only needed to profile local files
+try:
+    import numpy
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 
 parser = argparse.ArgumentParser(description='Table profiler with SQL genertor')
-parser.add_argument('-p', '--project',           type=str, help='The project that will execute the BigQuery job', required=True )
+parser.add_argument('-p', '--project',           type=str, help='The project that will execute the BigQuery job, required unless --local_file is set')
 parser.add_argument('-P', '--table_project',     type=str, help='The project that contains the BigQuery table')
 parser.add_argument('-t', '--dataset_tablename', type=str, help='The name of the dataset & table: dataset.tablename')
 parser.add_argument('-o', '--output_dir',        type=str, help='Output directory where you wan to save CSV & JSON data to', default='./')
@@ -23,21 +45,68 @@ parser.add_argument('-c', '--save_csv',                    help='Save the profil
 parser.add_argument('-j', '--save_json',                   help='Save the profiling JSON to a local SQL file',    action='store_true', default=False)
 parser.add_argument('-d', '--show_sql',                    help='Print the SQL query to the terminal',            action='store_true', default=False)
 parser.add_argument('-D', '--show_profile',                help='Print the query results to the terminal',        action='store_true', default=False)
-parser.add_argument('-S', '--sample_data',       type=int, help='Grabs a percentage of the data for faster processing, does not reduce data queried', choices=range(1, 99))
-
-args = parser.parse_args()
-project           = args.project
-table_project     = args.table_project
-dataset_tablename = args.dataset_tablename
-output_dir        = args.output_dir
-table_size_limit  = args.table_size_limit
-run_query         = args.run_query
-save_sql          = args.save_sql
-save_csv          = args.save_csv
-save_json         = args.save_json
-show_sql          = args.show_sql
-show_profile      = args.show_profile
-sample_data       = args.sample_data
+parser.add_argument('-S', '--sample_data',       type=int, help='Profile a percentage of the table, the sampled blocks or partitions are all that is scanned', choices=range(1, 99))
+parser.add_argument('--sample_method',           type=str, help='How -S samples: system reads a percentage of the storage blocks with TABLESAMPLE, partition reads a percentage of the partitions of a partitioned table, rand filters rows with RAND() & scans the whole table (use it for views)', choices=['system', 'partition', 'rand'], default='system')
+parser.add_argument('--local_file',              type=str, help='Profile a local Parquet, CSV or Arrow file instead of a BigQuery table, needs pyarrow & numpy')
+parser.add_argument('--dataset',                 type=str, help='Batch mode: profile every table in this dataset')
+parser.add_argument('--tables_glob',             type=str, help='Batch mode: profile the tables matching a dataset.table glob. Ex: mydataset.events_*')
+parser.add_argument('--tables_file',             type=str, help='Batch mode: profile the tables listed in this file, one dataset.table per line')
+parser.add_argument('--max_jobs',                type=int, help='Batch mode: max number of profiling queries running at once', default=4)
+parser.add_argument('--bytes_budget',            type=float, help='Batch mode: max GB the batch can scan, tables that would go over it are skipped')
+parser.add_argument('--price_per_tb',            type=float, help='Batch mode: on-demand price per TB scanned, for the cost in the summary', default=6.25)
+parser.add_argument('--precision',               type=str, help='exact counts distinct values, approx estimates them with APPROX_COUNT_DISTINCT, minimal only counts values & NULLs', choices=['exact', 'approx', 'minimal'], default='exact')
+parser.add_argument('--shard_expressions',       type=int, help='Max aggregate expressions in one query, wider tables are split into column shards that run in parallel', default=2500)
+parser.add_argument('--cache_dir',               type=str, help='Profiles are cached here & reused while the table & its query are unchanged, an empty string turns the cache off', default=os.path.join(os.path.expanduser('~'), '.cache', 'bq_table_profiler'))
+parser.add_argument('--cache_mb',                type=int, help='Max size of the profile cache in MB, the least recently used profiles are deleted', default=512)
+parser.add_argument('--refresh',                           help='Run the profile queries even when the cache has the profile & cache the new result', action='store_true', default=False)
+parser.add_argument('--incremental_dataset',     type=str, help='Incremental mode: keep per partition profile state in this project.dataset & only profile the partitions written since the last run')
+parser.add_argument('--column_budget',           type=float, help='Max GB the profile of a table can scan, the highest priority columns that fit are profiled & the rest are reported as skipped')
+parser.add_argument('--priority_columns',        type=str, help='Comma separated column globs profiled first within --column_budget. Ex: user_id,event_*, the other columns are added cheapest first')
+parser.add_argument('--per_partition',                     help='Profile each partition of a time or range partitioned table, the rows are streamed to a --partition_format file', action='store_true', default=False)
+parser.add_argument('--partition_format',        type=str, help='The file format of the --per_partition profiles', choices=['csv', 'jsonl', 'parquet'], default='jsonl')
+parser.add_argument('--pack_tables',             type=int, help='Batch mode: profile up to this many small tables with the same schema in one UNION ALL query')
+parser.add_argument('--pack_gb',                 type=float, help='Batch mode: tables up to this size are packed with --pack_tables & a packed query scans at most this many GB', default=1.0)
+parser.add_argument('--shard_gb',                type=float, help='Max GB one column shard query can scan, larger shards are split further')
+
+# the arguments are set in main() so the profiler functions can be imported without a live project
+project           = None
+table_project     = None
+dataset_tablename = None
+output_dir        = './'
+table_size_limit  = 1000
+run_query         = False
+save_sql          = False
+save_csv          = False
+save_json         = False
+show_sql          = False
+show_profile      = False
+sample_data       = None
+sample_method     = 'system'
+max_jobs          = 4
+bytes_budget      = None
+price_per_tb      = 6.25
+precision         = 'exact'
+shard_expressions = 2500
+shard_gb          = None
+incremental_dataset = None
+refresh           = False
+column_budget     = None
+priority_columns  = None
+partition_format  = 'jsonl'
+pack_tables       = None
+pack_gb           = 1.0
+
+# the ProfileCache set up in main(), None when the cache is off
+profile_cache = None
+
+# BigQuery rejects queries longer than 1024K characters, shards are kept under this
+max_query_chars = 1000000
+
+# seconds between polls of the running batch jobs
+poll_seconds = 1.0
+
+# creates the BigQuery clients, swapped for a fake client by the benchmarks
+client_factory = bigquery.Client
 
 
 ### Get table metadata
@@ -47,7 +116,7 @@ def get_schema(table_project, dataset_tablename):
     """
 
     # create the client connection & grab the table schema
-    client = bigquery.Client(project=table_project)
+    client = client_factory(project=table_project)
     table = client.get_table(dataset_tablename)
     table_schema = table.schema
 
@@ -117,6 +186,14 @@ def sql_cols(fields_ls):
 
 
 ### SQL Generator
+# the distinct count of the exact & approx precision, minimal doesn't count distinct values
+distinct_counters = {'exact'  : 'COUNT(DISTINCT `{column_name}`)',
+                     'approx' : 'APPROX_COUNT_DISTINCT(`{column_name}`)'}
+
+# a minimal profile only counts the values of a column, the NULLs are counted by empty_null_counter
+minimal_snipit = """        COUNT(`{column_name}`) {spacer} AS {alias_name}_count,
+        # ▲ """
+
 def empty_null_counter(comment, column_name):
     """
     Measure column density by counting the number of NULLs
@@ -143,7 +220,7 @@ def string_profiler(column_name, alias_name, field_mode):
 
     comment = "# ▼ Column: {column_name}, Type: String ▼"
 
-    query_snipit = """        COUNT(DISTINCT `{column_name}`) {spacer} AS {alias_name}_count_distinct,
+    query_snipit = """        {count_distinct} {spacer} AS {alias_name}_count_distinct,
         COUNT(`{column_name}`) {spacer} AS {alias_name}_count,
         MIN(LENGTH(`{column_name}`)) {spacer} AS {alias_name}_char_length_min,
         CAST(ROUND(AVG(LENGTH(`{column_name}`)), 0)AS INT64) {spacer} AS {alias_name}_char_length_avg,
@@ -151,6 +228,7 @@ def string_profiler(column_name, alias_name, field_mode):
         SUM(LENGTH(`{column_name}`)) {spacer} AS {alias_name}_char_total_count,
         APPROX_QUANTILES(CHAR_LENGTH(`{column_name}`), 10) {spacer} AS {alias_name}_quantiles,
         # ▲ """
+    query_snipit = minimal_snipit if precision == 'minimal' else query_snipit.replace('{count_distinct}', distinct_counters[precision])
     
     # if the field is nullable, get the null percentage 
     if field_mode == 'NULLABLE':
@@ -167,13 +245,14 @@ def numbers_profiler(column_name, alias_name, field_mode):
     #NUMERIC handles INT64 overflow
     comment = "# ▼ Column: {column_name}, Type: Numeric ▼"
     query_snipit = """        COUNT(`{column_name}`) {spacer} AS {alias_name}_count,
-        COUNT(DISTINCT `{column_name}`) {spacer} AS {alias_name}_count_distinct,
+        {count_distinct} {spacer} AS {alias_name}_count_distinct,
         MIN(`{column_name}`) {spacer} AS {alias_name}_min,
         AVG(`{column_name}`) {spacer} AS {alias_name}_avg,
         MAX(`{column_name}`) {spacer} AS {alias_name}_max,
         SUM( CAST(`{column_name}` AS NUMERIC) ) {spacer} AS {alias_name}_sum,
         APPROX_QUANTILES(`{column_name}`, 10) {spacer} AS {alias_name}_approx_quantiles,
         # ▲ """
+    query_snipit = minimal_snipit if precision == 'minimal' else query_snipit.replace('{count_distinct}', distinct_counters[precision])
     
     if field_mode == 'NULLABLE':
         query_snipit = empty_null_counter(comment, column_name) + '\n' + query_snipit
@@ -188,13 +267,14 @@ def time_profiler(column_name, alias_name, field_mode):
     
     comment = "# ▼ Column: {column_name}, Type: Time ▼"
     query_snipit = """        COUNT(`{column_name}`) {spacer} AS {alias_name}_count,
-        COUNT(DISTINCT `{column_name}`) {spacer} AS {alias_name}_count_distinct,
+        {count_distinct} {spacer} AS {alias_name}_count_distinct,
         MIN(`{column_name}`) {spacer} AS {alias_name}_min,
         MAX(`{column_name}`) {spacer} AS {alias_name}_max,
         DATE_DIFF(MAX(CAST(`{column_name}` AS DATE)), MIN(CAST(`{column_name}` AS DATE)),  DAY) {spacer} AS {alias_name}_day_count,
         DATE_DIFF(MAX(CAST(`{column_name}` AS DATE)), MIN(CAST(`{column_name}` AS DATE)),  YEAR) {spacer} AS {alias_name}_year_count,
         DATE_DIFF(MAX(CAST(`{column_name}` AS DATE)), MIN(CAST(`{column_name}` AS DATE)),  MONTH) {spacer} AS {alias_name}_month_count,
         # ▲ """
+    query_snipit = minimal_snipit if precision == 'minimal' else query_snipit.replace('{count_distinct}', distinct_counters[precision])
     
     if field_mode == 'NULLABLE':
         query_snipit = empty_null_counter(comment, column_name) + '\n' + query_snipit
@@ -241,134 +321,510 @@ def array_struct_profiler(column_name, alias_name, field_mode):
     return query_snipit.replace('{column_name}', column_name).replace('{alias_name}', alias_name)
 
 
-def sql_gen(sql_cols_dic, unnest_cols):
+# the profiler function of each column category
+profilers = {'STRING'   : string_profiler,
+             'NUMBERS'  : numbers_profiler,
+             'TIME'     : time_profiler,
+             'BOOLEAN'  : boolean_profiler,
+             'REPEATED' : array_struct_profiler,
+             'STRUCT'   : array_struct_profiler}
+
+
+# the SQL builder: each profiler's snippet is compiled once per category & field mode into a format string that
+# knows how wide its lines are before their spacers, so the aligned SELECT is rendered with one format call per
+# column without splitting & re-joining the statement. The SELECT of each schema is cached, tables with the same columns reuse it
+compiled_templates = {}        # (column_type, field_mode) -> CompiledTemplate
+select_cache       = OrderedDict() # (select_key, precision) -> SELECT statement, least recently used first
+select_cache_size  = 64
+cache_lock         = threading.Lock()
+
+
+def name_terms(text):
     """
-    Generates the complete SQL statement
+    The width of template text as (fixed chars, column name count, alias name count)
+    """
+    column_count = text.count('{column_name}')
+    alias_count  = text.count('{alias_name}')
+
+    return len(text) - column_count * len('{column_name}') - alias_count * len('{alias_name}'), column_count, alias_count
+
+
+class CompiledTemplate():
+    """
+    A profiler's snippet compiled into one format string, {0} is the column name, {1} the alias name, {2} the comment
+    spacer & {3}... the spacers of the AS lines. The widths of the text before each spacer are kept as
+    (fixed chars, column name count, alias name count) so a column is rendered with a single format call
     """
 
-    # iterate through the columns & use the SQL profiler functions to create the select statement body
-    select_statement_ls = []
+    def __init__(self, profiler, field_mode):
+        self.expressions  = 0  # the aggregates the snippet selects
+        self.fields       = [] # (field name template, precision tier) of each aggregate
+        self.spacer_terms = [] # width terms of the text before each AS line's spacer, in order
+        widest            = {} # (column name count, alias name count) -> the most fixed chars of the statements
+        line_formats      = []
+        for line in profiler('{column_name}', '{alias_name}', field_mode).split('\n'):
+            line_format = line.replace('{', '{{').replace('}', '}}').replace('{{column_name}}', '{0}').replace('{{alias_name}}', '{1}')
+            if 'AS ' in line:
+                alias = re.search(r'\{spacer\}\s*AS (\{alias_name\}\w*)', line)
+                if alias != None:
+                    self.expressions += 1
+                    self.fields.append((alias.group(1), 'approx' if 'APPROX_' in line else 'exact'))
+                line_format = line_format.replace('{{spacer}}', '{' + str(3 + len(self.spacer_terms)) + '}')
+                self.spacer_terms.append(name_terms(line.split('{spacer}')[0].rstrip()))
+            elif '{comment}' in line or '{spacer}# ▼' in line:
+                line_format = line_format.replace('{{spacer}}', '{2}')
+            if 'AS ' in line or '#' in line:
+                fixed, column_count, alias_count = name_terms(line.split(' {spacer} ')[0].rstrip())
+                widest[(column_count, alias_count)] = max(fixed, widest.get((column_count, alias_count), 0))
+            line_formats.append(line_format)
+        self.snippet     = '\n'.join(line_formats)
+        self.width_terms = [(fixed, column_count, alias_count) for (column_count, alias_count), fixed in widest.items()]
+
+    def width(self, column_name, alias_name):
+        """
+        The longest statement of the column's snippet, before its spacer
+        """
+        column_length, alias_length = len(column_name), len(alias_name)
+
+        return max([fixed + column_count * column_length + alias_count * alias_length for fixed, column_count, alias_count in self.width_terms] or [0])
+
+    def render(self, column_name, alias_name, char_length):
+        """
+        The column's lines with their spacers sized to char_length
+        """
+        column_length, alias_length = len(column_name), len(alias_name)
+        spacers = [' ' * (char_length - fixed - column_count * column_length - alias_count * alias_length)
+                   for fixed, column_count, alias_count in self.spacer_terms]
+
+        return self.snippet.format(column_name, alias_name, ' ' * (char_length + 2), *spacers)
+
+
+def field_precision(sql_cols_dic):
+    """
+    The precision tier of each profile field, approx for the estimated distinct counts & the quantiles
+    """
+    tiers = OrderedDict()
     for column_type, column_names in sql_cols_dic.items():
-        if len(column_names) > 0:
-            for column_name, alias_name, field_mode in column_names:
-                if column_type == 'STRING':
-                    string_statement = string_profiler(column_name, alias_name, field_mode)
-                    select_statement_ls.append(string_statement)
-                elif column_type == 'NUMBERS':
-                    string_statement = numbers_profiler(column_name, alias_name, field_mode)
-                    select_statement_ls.append(string_statement)
-                elif column_type == 'TIME':
-                    string_statement = time_profiler(column_name, alias_name, field_mode)
-                    select_statement_ls.append(string_statement)
-                elif column_type == 'BOOLEAN':
-                    string_statement = boolean_profiler(column_name, alias_name, field_mode)
-                    select_statement_ls.append(string_statement)
-                elif  column_type == 'REPEATED':
-                    string_statement = array_struct_profiler(column_name, alias_name, field_mode)
-                    select_statement_ls.append(string_statement)
-                elif column_type == 'STRUCT':
-                    string_statement = array_struct_profiler(column_name, alias_name, field_mode)
-                    select_statement_ls.append(string_statement)
-                else:
-                    print('Miss:\t', column_name)
+        for column_name, alias_name, field_mode in column_names:
+            if column_type in profilers:
+                for field, tier in compiled_template(column_type, field_mode).fields:
+                    tiers[field.replace('{alias_name}', alias_name)] = tier
+
+    return tiers
 
-    # create the full table name escaping it with backticks
-    full_table_name = "`{table_project}.{dataset_table}`".replace('{table_project}', table_project).replace('{dataset_table}', dataset_tablename)
-    char_length = 0
 
-    # Find the longest statement and sets the spacer char width
-    select_statement_unformatted = '\n'.join(select_statement_ls)
-    for i in select_statement_unformatted.split('\n'):
-        if 'AS ' in i or '#' in i:
-            statement = i.split(' {spacer} ')[0].rstrip()
-            statement_len = len(statement)
-            if statement_len > char_length:
-                char_length = statement_len
+def add_precision(table_profile, tiers, profile_precision=None):
+    """
+    Record the --precision of the profile, or the precision it was actually run with, & the tier each field was computed with
+    """
+    table_profile['precision']        = precision if profile_precision == None else profile_precision
+    table_profile['field_precision'] = dict(tiers)
+
+    return table_profile
+
+
+def compiled_template(column_type, field_mode):
+    """
+    The compiled template of a column category & field mode, compiled the first time it's used
+    """
+    key = (column_type, field_mode, precision)
+    if key not in compiled_templates:
+        compiled_templates[key] = CompiledTemplate(profilers[column_type], field_mode)
+
+    return compiled_templates[key]
+
+
+def select_key(sql_cols_dic):
+    """
+    Hash of the categorized columns & the options that change the SELECT statement
+    """
+    select_json = json.dumps(sql_cols_dic)
+
+    return hashlib.sha1(select_json.encode('utf-8')).hexdigest()
+
+
+def select_gen(sql_cols_dic):
+    """
+    The aligned SELECT statement body of the columns, from the cache when a table with the same columns was generated
+    """
+    key = (select_key(sql_cols_dic), precision)
+    with cache_lock:
+        if key in select_cache:
+            select_cache.move_to_end(key)
+            return select_cache[key]
+
+    # find the longest statement to set the spacer char width
+    columns = []
+    char_length = 0
+    for column_type, column_names in sql_cols_dic.items():
+        for column_name, alias_name, field_mode in column_names:
+            if column_type in profilers:
+                template = compiled_template(column_type, field_mode)
+                columns.append((template, column_name, alias_name))
+                char_length = max(char_length, template.width(column_name, alias_name))
+            else:
+                print('Miss:\t', column_name)
     char_length = char_length + 2 # add padding for longest line
 
-    # Split each statement & replace the spacer place holder with a appropriately sized spacer
-    select_statement_formated = []
-    for i in select_statement_unformatted.split('\n'):
-        if 'AS ' in i:
-            statement = i.split('{spacer}')[0].rstrip()
-            statement_len = len(statement)
-            spacer = ' ' * (char_length - statement_len)
-            new_statement = i.replace('{spacer}', spacer)
-            select_statement_formated.append(new_statement)
-        elif '{comment}' in i or '{spacer}# ▼' in i:
-            spacer = ' ' * (char_length + 2)
-            new_statement = i.replace('{spacer}', spacer)#.replace('\r', '\n')
-            select_statement_formated.append(new_statement)
-        else:
-            select_statement_formated.append(i)
+    select_statement = '\n'.join([template.render(column_name, alias_name, char_length) for template, column_name, alias_name in columns])
 
-    # fill the skelton in with the select & unnest statements
-    query_skelton = """
-# Created by BigQuery Table Profiler: https://github.com/go-dustin/gcp_data_utilities
-# Empty & Null profile returns Infinity if a divide by zero occurs
-SELECT 
-{select_statement}
-FROM   {full_table_name}"""
+    with cache_lock:
+        select_cache[key] = select_statement
+        while len(select_cache) > select_cache_size:
+            select_cache.popitem(last=False)
+
+    return select_statement
+
+
+def sql_gen(sql_cols_dic, unnest_cols, table_id=None, sample=None):
+    """
+    Generates the complete SQL statement
+    table_id is project.dataset.table, the table set on the command line by default
+    sample is the table's sample_plan(), the whole table is profiled without it
+    """
+
+    # create the full table name escaping it with backticks
+    if table_id == None:
+        table_id = table_project + '.' + dataset_tablename
+    full_table_name = "`{table_id}`".replace('{table_id}', table_id)
 
     # create the unnest statement 
-    nested_statement = ',\n'
-    for nested in unnest_cols:
-        nested_statement = nested_statement + '        UNNEST({}),\n'.format(nested)
-    # remove trailing chars that will causes an error
-    if nested_statement[-2:] == ',\n':
-        nested_statement = nested_statement[:-2]
-    # add the unnest statement below the FROM statement
-    query_skelton = query_skelton + nested_statement
-    # convert the list of select statements to a string
-    select_statement = '\n'.join(select_statement_formated)
-    # fill in the select statements & the table name
-    query = query_skelton.replace('{select_statement}', select_statement).replace('{full_table_name}', full_table_name)
-    
+    nested_statement = ''.join(',\n        UNNEST({})'.format(nested) for nested in unnest_cols)
+
+    # fill the skelton in with the select, table name & unnest statements
+    query = ('\n# Created by BigQuery Table Profiler: https://github.com/go-dustin/gcp_data_utilities'
+             '\n# Empty & Null profile returns Infinity if a divide by zero occurs'
+             '\nSELECT \n' + select_gen(sql_cols_dic) + '\nFROM   ' + full_table_name)
+
     # if the sample data parameter is passed the profilers will query a subset of the data 
-    # placeholder replace with one that doesn't do a full table scan
-    if sample_data != None:
-        if sample_data > 0:
-            sample_statement = '\nWHERE   RAND() < {sample_data} / (SELECT COUNT(*) FROM {full_table_name})'
-            sample_statement = sample_statement.replace('{sample_data}', str(sample_data)).replace('{full_table_name}', full_table_name)
-            query = query + sample_statement
-        elif sample_data <= 0:
-            print('Sample data is to small')
+    if sample != None:
+        query = query + sample['tablesample'] + nested_statement + sample['where']
+    else:
+        query = query + nested_statement
 
     return query
 
+
+def sample_plan(table_id):
+    """
+    How -S samples the table, a dict of the TABLESAMPLE clause that follows the table name, the WHERE statement,
+    the method & the sample rate. None when the table isn't sampled
+    system keeps -S percent of the storage blocks, partition keeps -S percent of the partitions spread evenly
+    across the table & its rate is the share of the table's rows they hold
+    """
+    if sample_data == None:
+        return None
+    if sample_method == 'system':
+        return {'method': 'system', 'tablesample': ' TABLESAMPLE SYSTEM ({} PERCENT)'.format(sample_data), 'where': '', 'rate': sample_data / 100}
+    if sample_method == 'rand':
+        return {'method': 'rand', 'tablesample': '', 'where': '\nWHERE  RAND() < {}'.format(sample_data / 100), 'rate': sample_data / 100}
+
+    client = client_factory(project=project)
+    table = client.get_table(table_id)
+    partitions = [partition for partition in table_partitions(client, table) if partition['partition_id'] not in ['__NULL__', '__UNPARTITIONED__']]
+    if (table.time_partitioning == None and table.range_partitioning == None) or len(partitions) == 0:
+        raise ValueError('{} has no partitions to sample, use --sample_method system'.format(table_id))
+
+    # every nth partition so the sample covers the whole time or key range
+    count = max(1, int(round(len(partitions) * sample_data / 100)))
+    sampled = [partitions[int(i * len(partitions) / count)] for i in range(count)]
+    total_rows = sum(partition['total_rows'] for partition in partitions)
+    rate = sum(partition['total_rows'] for partition in sampled) / total_rows if total_rows > 0 else count / len(partitions)
+    where = partition_filter(table, [partition['partition_id'] for partition in sampled])
+
+    return {'method': 'partition', 'tablesample': '', 'where': where, 'rate': rate}
+
+
+### Partitions
+# time partitions are identified by their start formatted like the partition ids of INFORMATION_SCHEMA.PARTITIONS
+partition_formats = {'HOUR': '%Y%m%d%H', 'DAY': '%Y%m%d', 'MONTH': '%Y%m', 'YEAR': '%Y'}
+
+# column partitioned tables put the rows outside of these dates in the __UNPARTITIONED__ partition
+first_partition_date = datetime.datetime(1960, 1, 1)
+last_partition_date  = datetime.datetime(2160, 1, 1)
+
+
+def table_partitions(client, table):
+    """
+    The partitions of the table sorted by partition id, dicts of partition_id, total_rows & last_modified_time
+    """
+    partitions_query = ("SELECT partition_id, total_rows, last_modified_time FROM `{}.{}.INFORMATION_SCHEMA.PARTITIONS` "
+                        "WHERE table_name = '{}'").format(table.project, table.dataset_id, table.table_id)
+    partitions = [{'partition_id': row['partition_id'], 'total_rows': row['total_rows'] or 0, 'last_modified_time': row['last_modified_time']}
+                  for row in client.query(partitions_query).result()]
+
+    return sorted(partitions, key=lambda partition: partition['partition_id'])
+
+
+def partition_column(table):
+    """
+    The partition column of the table & its type, _PARTITIONTIME for ingestion time partitioned tables
+    """
+    if table.range_partitioning != None:
+        return '`{}`'.format(table.range_partitioning.field), 'INTEGER'
+    if table.time_partitioning.field == None:
+        return '_PARTITIONTIME', 'TIMESTAMP'
+    field_type = [field.field_type for field in table.schema if field.name == table.time_partitioning.field][0]
+
+    return '`{}`'.format(table.time_partitioning.field), field_type
+
+
+def partition_filter(table, partition_ids):
+    """
+    WHERE statement that keeps the rows of the partitions, constant bounds on the partition column let BigQuery prune the others
+    """
+    column, field_type = partition_column(table)
+    literal = "DATE '%Y-%m-%d'" if field_type == 'DATE' else field_type + " '%Y-%m-%d %H:%M:%S'"
+    if table.range_partitioning != None:
+        partition_range = table.range_partitioning.range_
+        first, last = partition_range.start, partition_range.end
+    else:
+        first, last = first_partition_date.strftime(literal), last_partition_date.strftime(literal)
+
+    ranges = []
+    for partition_id in partition_ids:
+        if partition_id == '__NULL__':
+            ranges.append('{} IS NULL'.format(column))
+        elif partition_id == '__UNPARTITIONED__' and column == '_PARTITIONTIME':
+            ranges.append('{} IS NULL'.format(column)) # rows still in the streaming buffer
+        elif partition_id == '__UNPARTITIONED__':
+            ranges.append('({} < {} OR {} >= {})'.format(column, first, column, last))
+        elif table.range_partitioning != None:
+            ranges.append('({} >= {} AND {} < {})'.format(column, partition_id, column, int(partition_id) + partition_range.interval))
+        else:
+            start = datetime.datetime.strptime(partition_id, partition_formats[table.time_partitioning.type_])
+            end = partition_end(start, table.time_partitioning.type_)
+            ranges.append('({} >= {} AND {} < {})'.format(column, start.strftime(literal), column, end.strftime(literal)))
+
+    return '\nWHERE  ' + '\n    OR '.join(ranges)
+
+
+def partition_id_sql(table):
+    """
+    SQL expression of the partition id of a row, the same ids INFORMATION_SCHEMA.PARTITIONS uses
+    """
+    column, field_type = partition_column(table)
+    if table.range_partitioning != None:
+        partition_range = table.range_partitioning.range_
+        partition_id = 'CAST(DIV({column} - {start}, {interval}) * {interval} + {start} AS STRING)'.format(
+                       column=column, start=partition_range.start, interval=partition_range.interval)
+        first, last = partition_range.start, partition_range.end
+    else:
+        partition_id = "FORMAT_{}('{}', {})".format(field_type, partition_formats[table.time_partitioning.type_], column)
+        literal = "DATE '%Y-%m-%d'" if field_type == 'DATE' else field_type + " '%Y-%m-%d %H:%M:%S'"
+        first, last = first_partition_date.strftime(literal), last_partition_date.strftime(literal)
+    if column == '_PARTITIONTIME':
+        return "IFNULL({}, '__UNPARTITIONED__')".format(partition_id)
+
+    return ("CASE WHEN {column} IS NULL THEN '__NULL__' WHEN {column} < {first} OR {column} >= {last} THEN '__UNPARTITIONED__' "
+            "ELSE {partition_id} END").format(column=column, first=first, last=last, partition_id=partition_id)
+
+
+def partition_end(start, partition_type):
+    """
+    The start of the partition after the one that starts at start
+    """
+    if partition_type == 'HOUR':
+        return start + datetime.timedelta(hours=1)
+    if partition_type == 'DAY':
+        return start + datetime.timedelta(days=1)
+    if partition_type == 'MONTH':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+
+    return start.replace(year=start.year + 1)
+
+
+def shard_queries(sql_cols_dic, unnest_cols, table_id=None, sample=None):
+    """
+    Split the columns into shards that each fit in one query & dry run them, returns a list of (query, total_bytes)
+    A shard has at most --shard_expressions aggregates, shards longer than BigQuery allows or scanning more than
+    --shard_gb are halved until they fit. A column's aggregates always stay in one shard & every shard has the same
+    FROM & UNNEST, so the merged shard rows are the same profile the single query returns
+    """
+
+    # pack the columns in order, sql_gen lays them out by category so the shards keep the profile's column order
+    shards = [[]]
+    expressions = 0
+    for column_type, column_names in sql_cols_dic.items():
+        for column in column_names:
+            column_expressions = compiled_template(column_type, column[2]).expressions if column_type in profilers else 0
+            if expressions + column_expressions > shard_expressions and len(shards[-1]) > 0:
+                shards.append([])
+                expressions = 0
+            shards[-1].append((column_type, column))
+            expressions += column_expressions
+
+    def shard_sql(shard):
+        shard_cols_dic = {column_type: [] for column_type in sql_cols_dic}
+        for column_type, column in shard:
+            shard_cols_dic[column_type].append(column)
+        return sql_gen(shard_cols_dic, unnest_cols, table_id, sample)
+
+    # the shards are dry run in parallel, any that are too long or scan too much are halved & tried again
+    planned = {} # index of the shard's first column -> (query, total_bytes)
+    first_column = [0]
+    for shard in shards[:-1]:
+        first_column.append(first_column[-1] + len(shard))
+    shards = list(zip(first_column, shards))
+    with ThreadPoolExecutor(max_workers=max(max_jobs, 1)) as executor:
+        while len(shards) > 0:
+            queries = [shard_sql(shard) for start, shard in shards]
+            too_long = [len(query) > max_query_chars and len(shard) > 1 for query, (start, shard) in zip(queries, shards)]
+            estimates = executor.map(lambda query: get_estimate(project, query, sample)[0], [query for query, long in zip(queries, too_long) if long == False])
+            split = []
+            for query, long, (start, shard) in zip(queries, too_long, shards):
+                total_bytes = None if long == True else next(estimates)
+                if len(shard) > 1 and (long == True or (shard_gb != None and total_bytes > shard_gb * 1073741824)):
+                    half = len(shard) // 2
+                    split.extend([(start, shard[:half]), (start + half, shard[half:])])
+                else:
+                    planned[start] = (query, total_bytes)
+            shards = split
+
+    return [planned[start] for start in sorted(planned)]
+
+
+def column_costs(sql_cols_dic, unnest_cols, table_id=None, sample=None):
+    """
+    Dry run the profile of each column on its own in parallel, returns a list of (column_type, column, total_bytes)
+    BigQuery bills the columns a query reads, so a column's dry run is what it adds to the profile's scan
+    """
+    columns = [(column_type, column) for column_type, column_names in sql_cols_dic.items() for column in column_names
+               if column_type in profilers]
+
+    def column_bytes(column_type_column):
+        column_type, column = column_type_column
+        column_cols_dic = {column_type: [column]}
+        return get_estimate(project, sql_gen(column_cols_dic, unnest_cols, table_id, sample), sample)[0]
+
+    with ThreadPoolExecutor(max_workers=max(max_jobs, 1)) as executor:
+        estimates = list(executor.map(column_bytes, columns))
+
+    return [(column_type, column, total_bytes) for (column_type, column), total_bytes in zip(columns, estimates)]
+
+
+def column_priority(alias_name):
+    """
+    The index of the first --priority_columns glob the column matches, columns that match none come last
+    """
+    for index, pattern in enumerate(priority_columns or []):
+        if fnmatch.fnmatchcase(alias_name, pattern.strip()):
+            return index
+
+    return len(priority_columns or [])
+
+
+def plan_columns(sql_cols_dic, unnest_cols, table_id=None, sample=None):
+    """
+    Choose the columns to profile within --column_budget, the --priority_columns first & then the cheapest columns
+    so the most columns fit. Returns the sql_cols_dic of the chosen columns & a list of the skipped (alias_name, total_bytes)
+    """
+    budget = int(column_budget * 1073741824)
+    costs = column_costs(sql_cols_dic, unnest_cols, table_id, sample)
+
+    # a column that doesn't fit is skipped & the cheaper columns after it are still tried
+    chosen = set()
+    skipped = []
+    planned_bytes = 0
+    for column_type, column, total_bytes in sorted(costs, key=lambda cost: (column_priority(cost[1][1]), cost[2])):
+        if planned_bytes + total_bytes <= budget:
+            chosen.add(column[1])
+            planned_bytes += total_bytes
+        else:
+            skipped.append((column[1], total_bytes))
+
+    if len(chosen) == 0:
+        raise ValueError('none of the columns fit in the {} GB --column_budget'.format(column_budget))
+
+    # the chosen columns keep their schema order so the profile has the order of a full profile
+    chosen_cols_dic = {column_type: [column for column in column_names if column[1] in chosen]
+                       for column_type, column_names in sql_cols_dic.items()}
+    if len(skipped) > 0:
+        print('Column budget: {} of {} columns fit in {} GB, skipped {} GB'.format(len(chosen), len(costs), column_budget,
+              round(sum(total_bytes for alias_name, total_bytes in skipped) / 1073741824, 2)))
+
+    return chosen_cols_dic, skipped
+
+
+def add_skipped(table_profile, skipped):
+    """
+    Record the columns --column_budget left out of the profile
+    """
+    table_profile['skipped_columns'] = [alias_name for alias_name, total_bytes in skipped]
+
+    return table_profile
+
 ### End SQL geneerator 
 
 
-def get_estimate(project, query):
+def get_estimate(project, query, sample=None):
     """
     Performs a dry run to get query cost
     """
 
-    client = bigquery.Client(project=project)
+    client = client_factory(project=project)
     job_config = bigquery.QueryJobConfig(dry_run=True)
     query_job = client.query((query),job_config=job_config,)
     total_bytes = query_job.total_bytes_processed 
+    # a dry run estimates a TABLESAMPLE query as a scan of the whole table, only the sampled blocks are read
+    if sample != None and sample['method'] == 'system':
+        total_bytes = int(total_bytes * sample['rate'])
     total_megabytes = int(total_bytes / 1048576)
     total_gigabytes = round(total_bytes / 1073741824, 2)
     
     return total_bytes, total_megabytes, total_gigabytes
 
 
-def run_profiler(query):
+def run_profiler(queries):
     """
-    Runs the query and returns the results
+    Runs the column shard queries in parallel and merges their results into one profile
     """
     
-    client = bigquery.Client(project=project)
-    job_config = bigquery.QueryJobConfig(use_query_cache=False)
-    query_job = client.query((query),job_config=job_config,)
-    table_profile = dict(list(query_job.result())[0])
+    client = client_factory(project=project)
+
+    def run_shard(query):
+        job_config = bigquery.QueryJobConfig(use_query_cache=False)
+        query_job = client.query((query),job_config=job_config,)
+        return dict(list(query_job.result())[0])
+
+    with ThreadPoolExecutor(max_workers=max(min(max_jobs, len(queries)), 1)) as executor:
+        shard_profiles = list(executor.map(run_shard, queries))
+
+    # each shard has its own columns, merged in shard order they're the columns of the single query
+    table_profile = {}
+    for shard_profile in shard_profiles:
+        table_profile.update(shard_profile)
     
     return table_profile 
 
 
+def add_sample(table_profile, sample):
+    """
+    Record how the profiled rows were sampled in the profile
+    """
+    table_profile['sample_method'] = sample['method']
+    table_profile['sample_rate']   = round(sample['rate'], 6)
+
+    return table_profile
+
+
+def clean_profile(table_profile):
+    """
+    Replace any values that can't be serialized to JSON
+    """
+    for k, v in table_profile.items():
+        if isinstance(v, decimal.Decimal):
+            table_profile[k] = int(v) if v == v.to_integral_value() else float(v)
+        elif v == float('inf'):
+            table_profile[k] = None
+        elif isinstance(v, datetime.date) == True:
+            table_profile[k] = v.isoformat()
+
+    return table_profile
+
+
 
-def write_json(output_dir, table_profile):
+def write_json(output_dir, table_profile, table_name=None):
     """
     Write the profile to a local JSON file
     """
@@ -379,16 +835,16 @@ def write_json(output_dir, table_profile):
             return x.isoformat()
         raise TypeError("Unknown type")
     
-    json_path_filename = output_dir + '/' + 'profile_' + dataset_tablename.replace('.', '_') + '.json'
+    json_path_filename = output_dir + '/' + 'profile_' + (table_name or dataset_tablename).replace('.', '_') + '.json'
     with open(json_path_filename, 'w') as f:
         json.dump(table_profile, f, indent=4, default=datetime_handler)
         
 
-def write_csv(output_dir, table_profile):
+def write_csv(output_dir, table_profile, table_name=None):
     """
     Write the profile to a local CSV file
     """
-    csv_path_filename = output_dir + '/' + 'profile_' + dataset_tablename.replace('.', '_') + '.csv'
+    csv_path_filename = output_dir + '/' + 'profile_' + (table_name or dataset_tablename).replace('.', '_') + '.csv'
     with open(csv_path_filename, 'w', newline='') as csvfile:
         fieldnames = list(table_profile.keys())
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
@@ -396,32 +852,1298 @@ def write_csv(output_dir, table_profile):
         writer.writerow(table_profile)
     
 
-def write_sql(output_dir, query):
+def write_sql(output_dir, query, table_name=None):
     """
     Write the SQL query to a local .sql file
     """
 
-    sql_path_filename = output_dir + '/' + 'profile_' + dataset_tablename.replace('.', '_') + '.sql'
+    sql_path_filename = output_dir + '/' + 'profile_' + (table_name or dataset_tablename).replace('.', '_') + '.sql'
     with open(sql_path_filename, "w") as f:
         f.write(query)
 
 
+### Incremental profiling
+# --incremental_dataset keeps a state table for each profiled table with a row of mergeable partial aggregates per
+# partition: counts, sums, min/max, HLL++ sketches of the distinct values & KLL sketches of the quantiles.
+# A run only scans the partitions written since they were profiled, replaces their rows in the state table & merges
+# the state table into a profile with the same columns as the full table profile. Only BigQuery can merge its
+# sketches so the state stays in BigQuery, merging it scans the state table & not the profiled table
+
+# the null & empty count of NULLABLE columns
+null_state = ['COUNTIF(`{column_name}` IS NULL OR CAST(`{column_name}` AS STRING) = "") AS {alias_name}_null_empty']
+null_merge = ['ROUND(IEEE_DIVIDE(SUM({alias_name}_null_empty), SUM({alias_name}_count)), 1) AS {alias_name}_null_empty_perct']
+
+# the partial aggregates each category keeps per partition & how they merge into the profile's columns
+state_templates = {
+    'STRING'   : (['COUNT(`{column_name}`) AS {alias_name}_count',
+                   'HLL_COUNT.INIT(`{column_name}`) AS {alias_name}_hll',
+                   'MIN(LENGTH(`{column_name}`)) AS {alias_name}_length_min',
+                   'MAX(LENGTH(`{column_name}`)) AS {alias_name}_length_max',
+                   'SUM(LENGTH(`{column_name}`)) AS {alias_name}_length_sum',
+                   'KLL_QUANTILES.INIT_INT64(CHAR_LENGTH(`{column_name}`)) AS {alias_name}_kll'],
+                  ['HLL_COUNT.MERGE({alias_name}_hll) AS {alias_name}_count_distinct',
+                   'SUM({alias_name}_count) AS {alias_name}_count',
+                   'MIN({alias_name}_length_min) AS {alias_name}_char_length_min',
+                   'CAST(ROUND(SAFE_DIVIDE(SUM({alias_name}_length_sum), SUM({alias_name}_count)), 0) AS INT64) AS {alias_name}_char_length_avg',
+                   'MAX({alias_name}_length_max) AS {alias_name}_char_length_max',
+                   'SUM({alias_name}_length_sum) AS {alias_name}_char_total_count',
+                   'KLL_QUANTILES.MERGE_INT64({alias_name}_kll, 10) AS {alias_name}_quantiles']),
+    'NUMBERS'  : (['COUNT(`{column_name}`) AS {alias_name}_count',
+                   'HLL_COUNT.INIT(CAST(`{column_name}` AS STRING)) AS {alias_name}_hll',
+                   'MIN(`{column_name}`) AS {alias_name}_min',
+                   'MAX(`{column_name}`) AS {alias_name}_max',
+                   'SUM( CAST(`{column_name}` AS NUMERIC) ) AS {alias_name}_sum',
+                   'KLL_QUANTILES.INIT_FLOAT64(CAST(`{column_name}` AS FLOAT64)) AS {alias_name}_kll'],
+                  ['SUM({alias_name}_count) AS {alias_name}_count',
+                   'HLL_COUNT.MERGE({alias_name}_hll) AS {alias_name}_count_distinct',
+                   'MIN({alias_name}_min) AS {alias_name}_min',
+                   'CAST(SAFE_DIVIDE(SUM({alias_name}_sum), SUM({alias_name}_count)) AS FLOAT64) AS {alias_name}_avg',
+                   'MAX({alias_name}_max) AS {alias_name}_max',
+                   'SUM({alias_name}_sum) AS {alias_name}_sum',
+                   'KLL_QUANTILES.MERGE_FLOAT64({alias_name}_kll, 10) AS {alias_name}_approx_quantiles']),
+    'TIME'     : (['COUNT(`{column_name}`) AS {alias_name}_count',
+                   'HLL_COUNT.INIT(CAST(`{column_name}` AS STRING)) AS {alias_name}_hll',
+                   'MIN(`{column_name}`) AS {alias_name}_min',
+                   'MAX(`{column_name}`) AS {alias_name}_max'],
+                  ['SUM({alias_name}_count) AS {alias_name}_count',
+                   'HLL_COUNT.MERGE({alias_name}_hll) AS {alias_name}_count_distinct',
+                   'MIN({alias_name}_min) AS {alias_name}_min',
+                   'MAX({alias_name}_max) AS {alias_name}_max',
+                   'DATE_DIFF(CAST(MAX({alias_name}_max) AS DATE), CAST(MIN({alias_name}_min) AS DATE), DAY) AS {alias_name}_day_count',
+                   'DATE_DIFF(CAST(MAX({alias_name}_max) AS DATE), CAST(MIN({alias_name}_min) AS DATE), YEAR) AS {alias_name}_year_count',
+                   'DATE_DIFF(CAST(MAX({alias_name}_max) AS DATE), CAST(MIN({alias_name}_min) AS DATE), MONTH) AS {alias_name}_month_count']),
+    'BOOLEAN'  : (['COUNT(`{column_name}`) AS {alias_name}_count',
+                   'COUNTIF(`{column_name}` = True) AS {alias_name}_true',
+                   'COUNTIF(`{column_name}` = False) AS {alias_name}_false'],
+                  ['SUM({alias_name}_count) AS {alias_name}_count',
+                   'SUM({alias_name}_true) AS {alias_name}_true',
+                   'SUM({alias_name}_false) AS {alias_name}_false']),
+    'REPEATED' : (['COUNT(ARRAY_LENGTH(`{column_name}`)) AS {alias_name}_count',
+                   'MIN(ARRAY_LENGTH(`{column_name}`)) AS {alias_name}_length_min',
+                   'MAX(ARRAY_LENGTH(`{column_name}`)) AS {alias_name}_length_max',
+                   'SUM(ARRAY_LENGTH(`{column_name}`)) AS {alias_name}_length_sum'],
+                  ['MIN({alias_name}_length_min) AS {alias_name}_min_array_len',
+                   'CAST(SAFE_DIVIDE(SUM({alias_name}_length_sum), SUM({alias_name}_count)) AS INT64) AS {alias_name}_avg_array_len',
+                   'MAX({alias_name}_length_max) AS {alias_name}_max_array_len'])}
+state_templates['STRUCT'] = state_templates['REPEATED']
+
+
+def state_expressions(sql_cols_dic, merge):
+    """
+    The partial aggregates of every column for the state table, or with merge the expressions that merge them
+    """
+    expressions = []
+    for column_type, column_names in sql_cols_dic.items():
+        for column_name, alias_name, field_mode in column_names:
+            if column_type not in state_templates:
+                continue
+            templates = state_templates[column_type][1 if merge == True else 0]
+            if field_mode == 'NULLABLE' and column_type not in ['REPEATED', 'STRUCT']:
+                templates = (null_merge if merge == True else null_state) + templates
+            expressions.extend(template.replace('{column_name}', column_name).replace('{alias_name}', alias_name) for template in templates)
+
+    return expressions
+
+
+def state_precision(sql_cols_dic):
+    """
+    The precision tier of each merged profile field, approx for the HLL++ distinct counts & the KLL quantiles
+    """
+    tiers = OrderedDict()
+    for expression in state_expressions(sql_cols_dic, merge=True):
+        tiers[expression.rsplit(' AS ', 1)[1]] = 'approx' if 'HLL_COUNT.' in expression or 'KLL_QUANTILES.' in expression else 'exact'
+
+    return tiers
+
+
+def state_sql_gen(sql_cols_dic, unnest_cols, table, where=''):
+    """
+    The query of the state rows, one per partition of the rows the WHERE statement keeps
+    """
+    select = ([partition_id_sql(table) + ' AS partition_id',
+               'CURRENT_TIMESTAMP() AS profiled_at',
+               "'{}' AS schema_hash".format(select_key(sql_cols_dic)[:16])]
+              + state_expressions(sql_cols_dic, merge=False))
+    nested_statement = ''.join(',\n        UNNEST({})'.format(nested) for nested in unnest_cols)
+
+    return ('SELECT ' + ',\n       '.join(select) + '\nFROM   `{}.{}.{}`'.format(table.project, table.dataset_id, table.table_id)
+            + nested_statement + where + '\nGROUP BY partition_id')
+
+
+def merge_sql_gen(sql_cols_dic, state_table_id):
+    """
+    The query that merges the state table's partitions into the table profile
+    """
+    select = state_expressions(sql_cols_dic, merge=True) + ['COUNT(*) AS partition_count']
+
+    return 'SELECT ' + ',\n       '.join(select) + '\nFROM   `{}`'.format(state_table_id)
+
+
+def state_table_id(table):
+    """
+    The state table of a profiled table in --incremental_dataset
+    """
+    dataset = incremental_dataset if '.' in incremental_dataset else project + '.' + incremental_dataset
+    name = 'profile_state_{}_{}_{}'.format(table.project, table.dataset_id, table.table_id).replace('-', '_')
+
+    return dataset + '.' + name
+
+
+def plan_incremental(table_id, sql_cols_dic, unnest_cols):
+    """
+    Compare the table's partitions with its state table, returns a dict of the script that brings the state up to
+    date & its query of the state rows (both None when the state is current), the merge query & the changed partition ids
+    """
+    client = client_factory(project=project)
+    table = client.get_table(table_id)
+    if table.time_partitioning == None and table.range_partitioning == None:
+        raise ValueError('{} is not partitioned, incremental profiling needs a time or range partitioned table'.format(table_id))
+    state_id = state_table_id(table)
+    key = select_key(sql_cols_dic)[:16]
+
+    partitions = table_partitions(client, table)
+    try:
+        state = {row['partition_id']: row for row in client.query('SELECT partition_id, profiled_at, schema_hash FROM `{}`'.format(state_id)).result()}
+    except NotFound:
+        state = None
+
+    # a new state table or new columns profile the whole table again
+    plan = {'script': None, 'state_query': None, 'merge_query': merge_sql_gen(sql_cols_dic, state_id), 'changed': []}
+    if state == None or any(row['schema_hash'] != key for row in state.values()):
+        plan['changed']     = [partition['partition_id'] for partition in partitions]
+        plan['state_query'] = state_sql_gen(sql_cols_dic, unnest_cols, table)
+        plan['script']      = 'CREATE OR REPLACE TABLE `{}` AS\n{}'.format(state_id, plan['state_query'])
+        return plan
+
+    # partitions written after they were profiled, the state of dropped partitions is deleted
+    changed = [partition['partition_id'] for partition in partitions if partition['partition_id'] not in state
+               or partition['last_modified_time'] > state[partition['partition_id']]['profiled_at']]
+    partition_ids = set(partition['partition_id'] for partition in partitions)
+    dropped = [partition_id for partition_id in state if partition_id not in partition_ids]
+    plan['changed'] = changed
+    if len(changed) == 0 and len(dropped) == 0:
+        return plan
+
+    script = ['BEGIN TRANSACTION;',
+              'DELETE FROM `{}` WHERE partition_id IN ({});'.format(state_id, ', '.join("'{}'".format(partition_id) for partition_id in changed + dropped))]
+    if len(changed) > 0:
+        plan['state_query'] = state_sql_gen(sql_cols_dic, unnest_cols, table, partition_filter(table, changed))
+        script.append('INSERT INTO `{}`\n{};'.format(state_id, plan['state_query']))
+    script.append('COMMIT TRANSACTION;')
+    plan['script'] = '\n'.join(script)
+
+    return plan
+
+
+def run_incremental(sql_cols_dic, unnest_cols):
+    """
+    Profile the changed partitions of the table into its state table & merge the state into the profile
+    """
+    table_id = table_project + '.' + dataset_tablename
+    plan = plan_incremental(table_id, sql_cols_dic, unnest_cols)
+    script, merge_query, changed = plan['script'], plan['merge_query'], plan['changed']
+    print('Partitions to profile:', len(changed))
+
+    # the dry run is of the state rows' query, the state table is small next to the profiled table
+    total_bytes = 0
+    if plan['state_query'] != None:
+        total_bytes = get_estimate(project, plan['state_query'])[0]
+    total_gigabytes = round(total_bytes / 1073741824, 2)
+    print('KB: {}\nMB: {}\nGB: {}'.format(total_bytes, int(total_bytes / 1048576), total_gigabytes))
+
+    query = ';\n'.join(statement for statement in [script, merge_query] if statement != None)
+    if save_sql == True:
+        write_sql(output_dir, query)
+    if show_sql == True:
+        print('Display query', query)
+
+    if total_gigabytes > table_size_limit or run_query == False or True not in [save_csv, save_json, show_profile]:
+        print('Query did not run')
+        return
+
+    client = client_factory(project=project)
+    if script != None:
+        client.query(script).result()
+    table_profile = dict(list(client.query(merge_query, job_config=bigquery.QueryJobConfig(use_query_cache=False)).result())[0])
+    table_profile['partitions_profiled'] = len(changed)
+    # the state keeps sketches, the distinct counts are estimated whatever --precision is
+    table_profile = add_precision(table_profile, state_precision(sql_cols_dic), 'approx')
+    write_profile(clean_profile(table_profile))
+
+
+### Per partition profiles
+# --per_partition groups the profile's aggregates by the partition id of each row, one profile row per partition
+# from a single scan. The result is read a page at a time & each row is written as it arrives, years of daily
+# partitions are never held in memory. Column shards are ordered by partition id & read in step, each row is the
+# shards' columns merged like the single table profile
+partition_page_rows = 500
+
+# the Parquet types of the profile's result columns after clean_profile
+parquet_types = {'STRING': 'string', 'INTEGER': 'int64', 'INT64': 'int64', 'FLOAT': 'float64', 'FLOAT64': 'float64',
+                 'NUMERIC': 'float64', 'BIGNUMERIC': 'float64', 'BOOLEAN': 'bool', 'BOOL': 'bool'}
+
+
+def partition_sql(query, table):
+    """
+    The profile query grouped by the partition id of each row, ordered by it
+    """
+    query = query.replace('\nSELECT \n', '\nSELECT \n        {} AS partition_id,\n'.format(partition_id_sql(table)), 1)
+
+    return query + '\nGROUP BY partition_id\nORDER BY partition_id'
+
+
+def shard_rows(rows):
+    """
+    The rows of a query result fetched a page at a time
+    """
+    for page in rows.pages:
+        for row in page:
+            yield dict(row)
+
+
+class PartitionWriter():
+    """
+    Writes the partition profile rows to a CSV, JSONL or Parquet file as they're read, Parquet rows are written
+    in row groups of partition_page_rows
+    """
+
+    def __init__(self, path, partition_format, schema):
+        self.path             = path
+        self.partition_format = partition_format
+        self.buffer           = []
+        self.rows             = 0
+        self.f                = None
+        self.writer           = None
+        if partition_format == 'parquet':
+            self.schema = pyarrow.schema([(field.name, self.parquet_type(field)) for field in schema])
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.f = open(path, 'w', newline='')
+            if partition_format == 'csv':
+                self.writer = csv.DictWriter(self.f, fieldnames=[field.name for field in schema])
+                self.writer.writeheader()
+
+    def parquet_type(self, field):
+        # times are ISO strings once the rows are cleaned
+        arrow_type = pyarrow.type_for_alias(parquet_types.get(field.field_type, 'string'))
+        return pyarrow.list_(arrow_type) if field.mode == 'REPEATED' else arrow_type
+
+    def write(self, row):
+        self.rows += 1
+        if self.partition_format == 'csv':
+            self.writer.writerow(row)
+        elif self.partition_format == 'jsonl':
+            self.f.write(json.dumps(row) + '\n')
+        else:
+            self.buffer.append(row)
+            if len(self.buffer) >= partition_page_rows:
+                self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.writer.write_table(pyarrow.Table.from_pylist(self.buffer, schema=self.schema))
+            self.buffer = []
+
+    def close(self):
+        if self.partition_format == 'parquet':
+            self.flush()
+            self.writer.close()
+        else:
+            self.f.close()
+
+
+def run_per_partition(sql_cols_dic, unnest_cols, skipped=None):
+    """
+    Profile each partition of the table & stream the profile rows to a --partition_format file
+    skipped is the columns --column_budget left out, every row records them
+    """
+    table_id = table_project + '.' + dataset_tablename
+    client = client_factory(project=project)
+    table = client.get_table(table_id)
+    if table.time_partitioning == None and table.range_partitioning == None:
+        raise ValueError('{} is not partitioned, --per_partition needs a time or range partitioned table'.format(table_id))
+
+    sample = sample_plan(table_id)
+    queries = [partition_sql(query, table) for query, shard_bytes in shard_queries(sql_cols_dic, unnest_cols, sample=sample)]
+    with ThreadPoolExecutor(max_workers=max(min(max_jobs, len(queries)), 1)) as executor:
+        total_bytes = sum(executor.map(lambda query: get_estimate(project, query, sample)[0], queries))
+    total_gigabytes = round(total_bytes / 1073741824, 2)
+    if len(queries) > 1:
+        print('Column shards:', len(queries))
+    print('KB: {}\nMB: {}\nGB: {}'.format(total_bytes, int(total_bytes / 1048576), total_gigabytes))
+
+    query = ';\n'.join(queries)
+    if save_sql == True:
+        write_sql(output_dir, query)
+    if show_sql == True:
+        print('Display query', query)
+
+    if total_gigabytes > table_size_limit or run_query == False:
+        print('Query did not run')
+        return
+
+    # the shard jobs run at once, their results are read in step a page at a time
+    jobs = [client.query(query, job_config=bigquery.QueryJobConfig(use_query_cache=False)) for query in queries]
+    results = [job.result(page_size=partition_page_rows) for job in jobs]
+    schema = OrderedDict((field.name, field) for rows in results for field in rows.schema)
+    if sample != None:
+        schema['sample_method'] = bigquery.SchemaField('sample_method', 'STRING')
+        schema['sample_rate']   = bigquery.SchemaField('sample_rate', 'FLOAT')
+    if skipped != None:
+        schema['skipped_columns'] = bigquery.SchemaField('skipped_columns', 'STRING', mode='REPEATED')
+    # every row has the same tiers, field_precision is a JSON string so it fits a CSV or Parquet column
+    schema['precision']       = bigquery.SchemaField('precision', 'STRING')
+    schema['field_precision'] = bigquery.SchemaField('field_precision', 'STRING')
+    tiers = json.dumps(field_precision(sql_cols_dic))
+    path = output_dir + '/' + 'profile_' + dataset_tablename.replace('.', '_') + '_partitions.' + partition_format
+    writer = PartitionWriter(path, partition_format, list(schema.values()))
+    try:
+        for shard_profiles in zip(*[shard_rows(rows) for rows in results]):
+            partition_profile = {}
+            for shard_profile in shard_profiles:
+                if shard_profile['partition_id'] != shard_profiles[0]['partition_id']:
+                    raise ValueError('the column shards returned different partitions')
+                partition_profile.update(shard_profile)
+            if sample != None:
+                partition_profile = add_sample(partition_profile, sample)
+            if skipped != None:
+                partition_profile = add_skipped(partition_profile, skipped)
+            partition_profile['precision']       = precision
+            partition_profile['field_precision'] = tiers
+            writer.write(clean_profile(partition_profile))
+    finally:
+        writer.close()
+    print(writer.rows, 'partition profiles saved to:', path)
+
+
+### Profile cache
+class ProfileCache():
+    """
+    Profiles saved as JSON files named by their cache key, a hit touches the file so the least recently used
+    profiles are deleted first when the files go over max_bytes
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path      = path
+        self.max_bytes = max_bytes
+        self.lock      = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        """
+        The cached profile or None
+        """
+        path = os.path.join(self.path, key + '.json')
+        try:
+            with open(path) as f:
+                table_profile = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        return table_profile
+
+    def put(self, key, table_profile):
+        path = os.path.join(self.path, key + '.json')
+        with self.lock:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(table_profile, f, default=str)
+            os.replace(temp_path, path)
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used profiles until the cache fits in max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_bytes = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+
+def cache_key(table_id, queries):
+    """
+    Key of a table's profile in the cache, a hash of the table's id, modified time, etag, schema & profile SQL
+    None when rows are still streaming into the table, its modified time doesn't cover them
+    """
+    table = client_factory(project=project).get_table(table_id)
+    if table.streaming_buffer != None:
+        return None
+    schema_json = json.dumps([field.to_api_repr() for field in table.schema], sort_keys=True)
+    key_json = json.dumps([table.full_table_id,
+                           table.modified.isoformat() if table.modified != None else None,
+                           table.etag,
+                           hashlib.sha1(schema_json.encode('utf-8')).hexdigest(),
+                           hashlib.sha1(';\n'.join(queries).encode('utf-8')).hexdigest()])
+
+    return hashlib.sha1(key_json.encode('utf-8')).hexdigest()
+
+
+### Local engine
+# --local_file profiles a Parquet, CSV or Arrow file without BigQuery. The columns are planned with sql_cols() and
+# the file is read in record batches, each column's metrics are accumulated with Arrow compute & NumPy kernels so
+# files larger than memory can be profiled. Only the distinct values of exact precision grow with the data.
+# The profile has the same fields in the same order as the BigQuery profile of the same data
+local_batch_rows     = 65536
+quantile_sample_size = 100000 # values kept per column for the quantiles
+hll_precision        = 14     # 2^14 HyperLogLog registers for the approx distinct counts
+
+
+def arrow_field_type(arrow_type):
+    """
+    The BigQuery type of an Arrow type, BYTES for the types the profiler skips
+    """
+    if pyarrow.types.is_string(arrow_type) or pyarrow.types.is_large_string(arrow_type):
+        return 'STRING'
+    if pyarrow.types.is_integer(arrow_type):
+        return 'INTEGER'
+    if pyarrow.types.is_floating(arrow_type):
+        return 'FLOAT'
+    if pyarrow.types.is_decimal(arrow_type):
+        return 'NUMERIC'
+    if pyarrow.types.is_boolean(arrow_type):
+        return 'BOOLEAN'
+    if pyarrow.types.is_timestamp(arrow_type):
+        return 'TIMESTAMP'
+    if pyarrow.types.is_date(arrow_type):
+        return 'DATE'
+    if pyarrow.types.is_struct(arrow_type):
+        return 'RECORD'
+
+    return 'BYTES'
+
+
+def local_schema(arrow_fields, parent=None):
+    """
+    The file's columns in get_schema's format, struct columns are flattened with '__' like nested BigQuery columns
+    & list columns are REPEATED
+    """
+    fields_ls = []
+    for field in arrow_fields:
+        name = field.name if parent == None else parent + '__' + field.name
+        if pyarrow.types.is_struct(field.type):
+            fields_ls.extend(local_schema([field.type.field(i) for i in range(field.type.num_fields)], name))
+            continue
+        if pyarrow.types.is_list(field.type) or pyarrow.types.is_large_list(field.type):
+            mode, field_type = 'REPEATED', arrow_field_type(field.type.value_type)
+        else:
+            mode, field_type = 'NULLABLE' if field.nullable == True else 'REQUIRED', arrow_field_type(field.type)
+        fields_ls.append({'name': name, 'col_name': field.name, 'mode': mode, 'field_type': field_type, 'path': parent})
+
+    return fields_ls
+
+
+def open_local_file(path):
+    """
+    The Arrow schema of a Parquet, CSV or Arrow IPC file & an iterator of its record batches
+    """
+    if path.endswith('.parquet') or path.endswith('.pq'):
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        return parquet_file.schema_arrow, parquet_file.iter_batches(batch_size=local_batch_rows)
+    if '.csv' in path:
+        reader = pyarrow.csv.open_csv(path)
+        return reader.schema, iter(reader)
+    try:
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path))
+        return reader.schema, (reader.get_batch(i) for i in range(reader.num_record_batches))
+    except pyarrow.ArrowInvalid:
+        reader = pyarrow.ipc.open_stream(pyarrow.memory_map(path))
+        return reader.schema, iter(reader)
+
+
+def flatten_batch(batch):
+    """
+    The batch as a table with its struct columns flattened into parent__child columns
+    """
+    table = pyarrow.Table.from_batches([batch])
+    while any(pyarrow.types.is_struct(field.type) for field in table.schema):
+        table = table.flatten()
+
+    return table.rename_columns([name.replace('.', '__') for name in table.column_names])
+
+
+def temporal_ints(values):
+    """
+    Dates & times as the int64 of their storage, other values unchanged
+    """
+    if pyarrow.types.is_date32(values.type):
+        return values.cast(pyarrow.int32()).cast(pyarrow.int64())
+    if pyarrow.types.is_temporal(values.type) or pyarrow.types.is_integer(values.type):
+        return values.cast(pyarrow.int64())
+
+    return values
+
+
+def hash64(values):
+    """
+    64 bit hashes of the values, numbers are hashed by their bits & other types by Python's hash, mixed with splitmix64
+    """
+    if pyarrow.types.is_floating(values.type):
+        bits = (values.to_numpy(zero_copy_only=False).astype(numpy.float64) + 0.0).view(numpy.uint64) # + 0.0 makes -0.0 0.0
+    elif pyarrow.types.is_integer(values.type) or pyarrow.types.is_temporal(values.type):
+        bits = temporal_ints(values).to_numpy(zero_copy_only=False).view(numpy.uint64)
+    else:
+        bits = numpy.array([hash(value) for value in values.to_pylist()], dtype=numpy.int64).view(numpy.uint64)
+    with numpy.errstate(over='ignore'):
+        bits = bits + numpy.uint64(0x9E3779B97F4A7C15)
+        bits = (bits ^ (bits >> numpy.uint64(30))) * numpy.uint64(0xBF58476D1CE4E5B9)
+        bits = (bits ^ (bits >> numpy.uint64(27))) * numpy.uint64(0x94D049BB133111EB)
+
+    return bits ^ (bits >> numpy.uint64(31))
+
+
+def hll_estimate(registers):
+    """
+    HyperLogLog estimate of the distinct count, with the linear counting correction for small counts
+    """
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / numpy.sum(numpy.power(2.0, -registers.astype(numpy.float64)))
+    zeros = int(numpy.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * numpy.log(m / zeros)
+
+    return int(round(estimate))
+
+
+def round_half_away(value):
+    """
+    ROUND & CAST to INT64 round halves away from zero, Python's round() rounds them to even
+    """
+    return int(numpy.sign(value) * numpy.floor(abs(value) + 0.5))
+
+
+def as_date(value):
+    """
+    CAST(value AS DATE), timestamps are cast in UTC
+    """
+    if isinstance(value, datetime.datetime):
+        return (value.astimezone(datetime.timezone.utc) if value.tzinfo != None else value).date()
+
+    return value
+
+
+class LocalColumn():
+    """
+    Accumulates a column's metrics over the record batches of a local file
+    """
+
+    def __init__(self, column_type, alias_name, field_mode):
+        self.column_type = column_type
+        self.alias_name  = alias_name
+        self.field_mode  = field_mode
+        self.count       = 0
+        self.null_empty  = 0
+        self.minimum     = None
+        self.maximum     = None
+        self.total       = 0
+        self.trues       = 0
+        self.lengths     = None # (min, max, sum, count) of the string or array lengths
+        self.distinct    = set() if precision == 'exact' else None
+        self.uniques     = None # the distinct numbers & times of exact precision
+        self.registers   = numpy.zeros(2 ** hll_precision, dtype=numpy.uint8) if precision == 'approx' else None
+        self.sample_keys = numpy.empty(0)
+        self.sample      = numpy.empty(0)
+        self.random      = numpy.random.default_rng(0)
+
+    def update(self, values):
+        values = values.combine_chunks() if isinstance(values, pyarrow.ChunkedArray) else values
+        if self.column_type in ['REPEATED', 'STRUCT']:
+            self.add_lengths(pyarrow.compute.list_value_length(values))
+            return
+
+        non_null = values.drop_null()
+        self.count += len(non_null)
+        if self.field_mode == 'NULLABLE':
+            self.null_empty += values.null_count
+            if self.column_type == 'STRING':
+                self.null_empty += pyarrow.compute.sum(pyarrow.compute.equal(non_null, '')).as_py() or 0
+        if self.column_type == 'BOOLEAN':
+            self.trues += pyarrow.compute.sum(non_null.cast(pyarrow.int64())).as_py() or 0
+            return
+        if precision == 'minimal' or len(non_null) == 0:
+            return
+        self.add_distinct(non_null)
+        if self.column_type == 'STRING':
+            lengths = pyarrow.compute.utf8_length(non_null)
+            self.add_lengths(lengths)
+            self.add_sample(lengths.to_numpy(zero_copy_only=False))
+            return
+
+        min_max = pyarrow.compute.min_max(non_null).as_py()
+        self.minimum = min_max['min'] if self.minimum == None else min(self.minimum, min_max['min'])
+        self.maximum = min_max['max'] if self.maximum == None else max(self.maximum, min_max['max'])
+        if self.column_type == 'NUMBERS':
+            self.total += pyarrow.compute.sum(non_null).as_py()
+            self.add_sample(non_null.cast(pyarrow.float64()).to_numpy(zero_copy_only=False))
+
+    def add_lengths(self, lengths):
+        lengths = lengths.drop_null()
+        if len(lengths) == 0:
+            return
+        min_max = pyarrow.compute.min_max(lengths).as_py()
+        chunk = (min_max['min'], min_max['max'], pyarrow.compute.sum(lengths).as_py(), len(lengths))
+        if self.lengths == None:
+            self.lengths = chunk
+        else:
+            self.lengths = (min(self.lengths[0], chunk[0]), max(self.lengths[1], chunk[1]), self.lengths[2] + chunk[2], self.lengths[3] + chunk[3])
+
+    def add_distinct(self, values):
+        unique = pyarrow.compute.unique(values)
+        if self.registers is not None:
+            hashes = hash64(unique)
+            index = (hashes >> numpy.uint64(64 - hll_precision)).astype(numpy.int64)
+            # the rank is the position of the first 1 bit after the index bits, the lowest 11 bits are dropped
+            # so the rest converts to a float exactly
+            rest = ((hashes << numpy.uint64(hll_precision)) >> numpy.uint64(11)).astype(numpy.float64)
+            with numpy.errstate(divide='ignore'):
+                rank = numpy.where(rest > 0, 53 - numpy.floor(numpy.log2(rest)), 64 - hll_precision + 1).astype(numpy.uint8)
+            numpy.maximum.at(self.registers, index, rank)
+        elif pyarrow.types.is_integer(values.type) or pyarrow.types.is_floating(values.type) or pyarrow.types.is_temporal(values.type):
+            numbers = temporal_ints(unique).to_numpy(zero_copy_only=False)
+            self.uniques = numbers if self.uniques is None else numpy.union1d(self.uniques, numbers)
+        else:
+            self.distinct.update(unique.to_pylist())
+
+    def add_sample(self, numbers):
+        """
+        Keep the values with the smallest random keys, a uniform sample of the column for its quantiles
+        """
+        self.sample_keys = numpy.concatenate([self.sample_keys, self.random.random(len(numbers))])
+        self.sample      = numpy.concatenate([self.sample, numbers])
+        if len(self.sample) > quantile_sample_size:
+            keep = numpy.argpartition(self.sample_keys, quantile_sample_size)[:quantile_sample_size]
+            self.sample_keys, self.sample = self.sample_keys[keep], self.sample[keep]
+
+    def count_distinct(self):
+        if self.registers is not None:
+            return hll_estimate(self.registers)
+        if self.uniques is not None:
+            return len(self.uniques) + len(self.distinct)
+
+        return len(self.distinct)
+
+    def quantiles(self, minimum, maximum, integers):
+        """
+        The 11 values of APPROX_QUANTILES(x, 10): the min, the deciles & the max
+        """
+        if len(self.sample) == 0:
+            return None
+        quantiles = [float(value) for value in numpy.quantile(self.sample, numpy.linspace(0, 1, 11), method='nearest')]
+        quantiles[0], quantiles[-1] = float(minimum), float(maximum)
+
+        return [int(value) for value in quantiles] if integers == True else quantiles
+
+    def result(self):
+        """
+        The column's metrics keyed by their profile field names
+        """
+        alias = self.alias_name
+        fields = {}
+        if self.field_mode == 'NULLABLE' and self.column_type not in ['REPEATED', 'STRUCT']:
+            # IEEE_DIVIDE: Infinity when there are only NULLs, NaN when there are no rows
+            null_empty_perct = self.null_empty / self.count if self.count > 0 else (float('inf') if self.null_empty > 0 else float('nan'))
+            fields[alias + '_null_empty_perct'] = round_half_away(null_empty_perct * 10) / 10 if numpy.isfinite(null_empty_perct) else null_empty_perct
+        if self.column_type in ['REPEATED', 'STRUCT']:
+            min_length, max_length, sum_length, count_length = self.lengths or (None, None, None, 0)
+            fields[alias + '_min_array_len'] = min_length
+            fields[alias + '_avg_array_len'] = round_half_away(sum_length / count_length) if count_length > 0 else None
+            fields[alias + '_max_array_len'] = max_length
+            return fields
+
+        fields[alias + '_count'] = self.count
+        fields[alias + '_count_distinct'] = self.count_distinct() if precision != 'minimal' else None
+        if self.column_type == 'STRING':
+            min_length, max_length, sum_length, count_length = self.lengths or (None, None, None, 0)
+            fields[alias + '_char_length_min']  = min_length
+            fields[alias + '_char_length_avg']  = round_half_away(sum_length / count_length) if count_length > 0 else None
+            fields[alias + '_char_length_max']  = max_length
+            fields[alias + '_char_total_count'] = sum_length
+            fields[alias + '_quantiles']        = self.quantiles(min_length, max_length, integers=True)
+        elif self.column_type == 'NUMBERS':
+            fields[alias + '_min']              = self.minimum
+            fields[alias + '_avg']              = float(self.total) / self.count if self.count > 0 else None
+            fields[alias + '_max']              = self.maximum
+            fields[alias + '_sum']              = self.total if self.count > 0 else None
+            fields[alias + '_approx_quantiles'] = self.quantiles(self.minimum, self.maximum, integers=isinstance(self.minimum, int))
+        elif self.column_type == 'TIME':
+            fields[alias + '_min'] = self.minimum
+            fields[alias + '_max'] = self.maximum
+            if self.minimum != None:
+                first, last = as_date(self.minimum), as_date(self.maximum)
+                fields[alias + '_day_count']   = (last - first).days
+                fields[alias + '_year_count']  = last.year - first.year
+                fields[alias + '_month_count'] = (last.year - first.year) * 12 + last.month - first.month
+        elif self.column_type == 'BOOLEAN':
+            fields[alias + '_true']  = self.trues
+            fields[alias + '_false'] = self.count - self.trues
+
+        return fields
+
+
+def profile_local(path):
+    """
+    Profile a local file, returns the profile with the fields of the BigQuery profile
+    """
+    schema, batches = open_local_file(path)
+    sql_cols_dic = sql_cols(local_schema(list(schema)))
+    columns = [LocalColumn(column_type, alias_name, field_mode)
+               for column_type, column_names in sql_cols_dic.items() for column_name, alias_name, field_mode in column_names]
+
+    rows = 0
+    for batch in batches:
+        table = flatten_batch(batch)
+        rows += table.num_rows
+        for column in columns:
+            column.update(table.column(column.alias_name))
+
+    # the fields in the order of the SQL profile, only the fields the precision tier computes
+    values = {}
+    for column in columns:
+        values.update(column.result())
+    tiers = field_precision(sql_cols_dic)
+    table_profile = OrderedDict((field, values.get(field)) for field in tiers)
+    print('Profiled', rows, 'rows of', path)
+
+    return add_precision(table_profile, tiers)
+
+
+### Table packs
+# Small tables spend most of their batch time on per job overhead. --pack_tables packs the small tables with the same
+# schema into one query, a UNION ALL of each table's profile query tagged with its name, & splits the result rows back
+# into the tables' profiles. Tables are grouped by their columns & types so the UNION ALL's columns always line up,
+# a pack is one dry run & one job that the batch schedules like a table
+
+
+def table_sizes(client, tables):
+    """
+    The size in bytes of each dataset.table from its dataset's __TABLES__ view, one query per dataset
+    The tables of a dataset whose query fails are left out, they're profiled on their own & report their own errors
+    """
+    sizes = {}
+    for dataset in sorted(set(table.split('.')[0] for table in tables)):
+        query = 'SELECT table_id, size_bytes FROM `{}.{}.__TABLES__`'.format(table_project, dataset)
+        try:
+            rows = list(client.query(query).result())
+        except Exception as e:
+            print('Failed to read the table sizes of', dataset, e)
+            continue
+        for row in rows:
+            sizes[dataset + '.' + row['table_id']] = row['size_bytes']
+
+    return sizes
+
+
+def plan_pack_table(table_name):
+    """
+    A small table's profile query for a pack, returns a dict of its summary record, the pack_key of its columns & types,
+    its query & sample_plan(), the precision tier of each of its profile fields, its cache key & its number of aggregates
+    """
+    table_id = table_project + '.' + table_name
+    plan = {'record': batch_record(table_name), 'pack_key': None, 'query': None, 'sample': None, 'tiers': None, 'key': None, 'expressions': 0}
+    try:
+        fields_ls, unnest_cols = get_schema(table_project, table_name)
+        sample = sample_plan(table_id)
+        sql_cols_dic = sql_cols(fields_ls)
+        plan['query']       = sql_gen(sql_cols_dic, unnest_cols, table_id, sample)
+        plan['sample']      = sample
+        plan['tiers']       = field_precision(sql_cols_dic)
+        plan['pack_key']    = hashlib.sha1(json.dumps([fields_ls, unnest_cols], sort_keys=True).encode('utf-8')).hexdigest()
+        plan['expressions'] = sum(compiled_template(column_type, column[2]).expressions
+                                  for column_type, column_names in sql_cols_dic.items() if column_type in profilers for column in column_names)
+        plan['key']         = cache_key(table_id, [plan['query']]) if profile_cache != None else None
+        plan['record']['sample_rate'] = sample['rate'] if sample != None else None
+        plan['record']['shards']      = 1
+    except Exception as e:
+        plan['record']['status'] = 'failed'
+        plan['record']['error']  = 'planning: {}'.format(e)
+
+    return plan
+
+
+def pack_plans(plans, sizes):
+    """
+    Group the small tables' plans by their pack_key & fill packs of at most --pack_tables tables, --pack_gb & max_query_chars
+    characters. Returns a list of packs, each a list of plans
+    """
+    groups = OrderedDict()
+    for plan in plans:
+        groups.setdefault(plan['pack_key'], []).append(plan)
+
+    packs = []
+    for group in groups.values():
+        pack, chars, size = [], 0, 0
+        for plan in group:
+            plan_chars = len(plan['query']) + len(plan['record']['table']) + 64 # the SELECT that tags the table's row
+            plan_size  = sizes.get(plan['record']['table'], 0)
+            if len(pack) > 0 and (len(pack) >= pack_tables or chars + plan_chars > max_query_chars or size + plan_size > pack_gb * 1073741824):
+                packs.append(pack)
+                pack, chars, size = [], 0, 0
+            pack.append(plan)
+            chars += plan_chars
+            size  += plan_size
+        if len(pack) > 0:
+            packs.append(pack)
+
+    return packs
+
+
+def pack_sql(pack):
+    """
+    The UNION ALL of the pack's profile queries, each row is tagged with its table in the table_name column
+    """
+    return '\nUNION ALL\n'.join("SELECT '{}' AS table_name, * FROM ({}\n)".format(plan['record']['table'], plan['query']) for plan in pack)
+
+
+def plan_packs(tables, executor):
+    """
+    Plan the tables of --pack_tables packs, returns a list of pack records with their (query, total_bytes), the
+    plans of the tables that were cached or failed planning & the tables that are profiled on their own
+    """
+    client = client_factory(project=project)
+    sizes = table_sizes(client, tables)
+    small = [table for table in tables if table in sizes and sizes[table] <= pack_gb * 1073741824]
+    plans = list(executor.map(plan_pack_table, small))
+
+    # wide tables are sharded on their own, failed & cached tables aren't packed
+    packable, unpacked = [], []
+    large = [table for table in tables if table not in small]
+    for plan in plans:
+        table_profile = profile_cache.get(plan['key']) if run_query == True and plan['key'] != None and refresh == False else None
+        if plan['record']['status'] == 'failed':
+            unpacked.append(plan)
+        elif plan['expressions'] > shard_expressions or len(plan['query']) > max_query_chars:
+            large.append(plan['record']['table'])
+        elif table_profile != None:
+            plan['record']['status']       = 'cached'
+            plan['record']['billed_bytes'] = 0
+            write_profile(table_profile, plan['record']['table'])
+            print('Profile of', plan['record']['table'], 'is unchanged, from the cache')
+            unpacked.append(plan)
+        else:
+            packable.append(plan)
+
+    # the tables of a pack share -S & --sample_method, the first one's sample scales the estimate
+    def pack_bytes(pack_query):
+        pack, query = pack_query
+        return get_estimate(project, query, pack[0]['sample'])[0]
+
+    packs = pack_plans(packable, sizes)
+    queries = [pack_sql(pack) for pack in packs]
+    estimates = list(executor.map(pack_bytes, zip(packs, queries)))
+    pack_records = []
+    for number, (pack, query, total_bytes) in enumerate(zip(packs, queries, estimates)):
+        record = batch_record('pack_{}'.format(number))
+        record['shards']          = 1
+        record['estimated_bytes'] = total_bytes
+        record['plans']           = pack
+        record['sizes']           = [sizes[plan['record']['table']] for plan in pack]
+        for plan in pack:
+            plan['record']['pack'] = record['table']
+        pack_records.append((record, query))
+    if len(packs) > 0:
+        print(len(packable), 'small tables packed into', len(packs), 'queries')
+
+    large = set(large)
+    return pack_records, unpacked, [table for table in tables if table in large]
+
+
+def finish_pack(record, rows):
+    """
+    Split a pack's result rows into the profiles of its tables & write them
+    """
+    plans = {plan['record']['table']: plan for plan in record['plans']}
+    for row in rows:
+        plan = plans[row.pop('table_name')]
+        table_profile = row
+        if plan['record']['sample_rate'] != None:
+            table_profile = add_sample(table_profile, {'method': sample_method, 'rate': plan['record']['sample_rate']})
+        table_profile = add_precision(table_profile, plan['tiers'])
+        table_profile = clean_profile(table_profile)
+        if plan['key'] != None:
+            profile_cache.put(plan['key'], table_profile)
+        plan['record']['status'] = 'done'
+        write_profile(table_profile, plan['record']['table'])
+    record['status'] = 'done'
+
+
+def unpack_records(pack_records):
+    """
+    Copy each pack's status to its tables' records & split its estimated & billed bytes between them by their size
+    """
+    for record, query in pack_records:
+        total_size = sum(record['sizes'])
+        for plan, size in zip(record['plans'], record['sizes']):
+            share = size / total_size if total_size > 0 else 1 / len(record['plans'])
+            table_record = plan['record']
+            if table_record['status'] != 'done' and record['status'] == 'done':
+                table_record['status'] = 'failed'
+                table_record['error']  = 'no profile row in the pack result'
+            elif table_record['status'] != 'done':
+                table_record['status'] = record['status']
+                table_record['error']  = record['error']
+            table_record['seconds']         = record['seconds']
+            table_record['estimated_bytes'] = int(record['estimated_bytes'] * share)
+            table_record['billed_bytes']    = int(record['billed_bytes'] * share) if record['billed_bytes'] != None else None
+
+
+### Batch mode
+def batch_tables(client, dataset, tables_glob, tables_file):
+    """
+    The dataset.table names to profile from --dataset, --tables_glob & --tables_file
+    """
+    tables = []
+    if dataset != None:
+        tables.extend(dataset + '.' + table.table_id for table in client.list_tables(dataset))
+    if tables_glob != None:
+        glob_dataset = tables_glob.split('.')[0]
+        tables.extend(glob_dataset + '.' + table.table_id for table in client.list_tables(glob_dataset)
+                      if fnmatch.fnmatchcase(glob_dataset + '.' + table.table_id, tables_glob))
+    if tables_file != None:
+        with open(tables_file) as f:
+            tables.extend(line.strip() for line in f if line.strip() != '')
+
+    # keep the first of any duplicates
+    seen = set()
+    return [x for x in tables if (x not in seen) and (not seen.add(x))]
+
+
+def batch_record(table_name):
+    """
+    A table's record in the batch summary
+    """
+    return {'table': table_name, 'status': None, 'shards': None, 'pack': None, 'sample_rate': None, 'estimated_bytes': None,
+            'billed_bytes': None, 'cost': None, 'seconds': None, 'skipped_columns': None, 'error': None}
+
+
+def plan_table(table_name):
+    """
+    Generate a table's shard queries & dry run them, returns the summary record of the table with its (query, total_bytes)
+    shards, the precision tier of each of its profile fields & its cache key
+    """
+    record = batch_record(table_name)
+    try:
+        fields_ls, unnest_cols = get_schema(table_project, table_name)
+        sample = sample_plan(table_project + '.' + table_name)
+        sql_cols_dic = sql_cols(fields_ls)
+        if column_budget != None:
+            sql_cols_dic, skipped = plan_columns(sql_cols_dic, unnest_cols, table_project + '.' + table_name, sample)
+            record['skipped_columns'] = [alias_name for alias_name, total_bytes in skipped]
+        shards = shard_queries(sql_cols_dic, unnest_cols, table_project + '.' + table_name, sample)
+        record['sample_rate']     = sample['rate'] if sample != None else None
+        record['shards']          = len(shards)
+        record['estimated_bytes'] = sum(total_bytes for query, total_bytes in shards)
+        key = cache_key(table_project + '.' + table_name, [query for query, total_bytes in shards]) if profile_cache != None else None
+    except Exception as e:
+        record['status'] = 'failed'
+        record['error']  = 'planning: {}'.format(e)
+        return record, None, None, None
+
+    return record, shards, field_precision(sql_cols_dic), key
+
+
+def profile_batch(tables):
+    """
+    Profile many tables. The queries are generated & dry run in parallel, then submitted as jobs, at most
+    --max_jobs at once & within --bytes_budget. A wide table's column shards are separate jobs. The jobs are
+    polled without blocking & each profile is written as soon as the last of its shards finishes. Returns the
+    summary records
+    """
+    client = client_factory(project=project)
+    budget = int(bytes_budget * 1073741824) if bytes_budget != None else None
+
+    pack_records, unpacked = [], []
+    with ThreadPoolExecutor(max_workers=max(max_jobs, 1)) as executor:
+        if pack_tables != None and column_budget == None:
+            pack_records, unpacked, tables = plan_packs(tables, executor)
+        plans = list(executor.map(plan_table, tables))
+    print(len(plans) + len(unpacked) + sum(len(record['plans']) for record, query in pack_records), 'tables planned')
+
+    pending = deque() # (record, shard index, query, estimated bytes)
+    summary = []
+    # a pack is scheduled like a table, its tables' records are in the summary
+    for record, query in pack_records:
+        summary.extend(plan['record'] for plan in record['plans'])
+        if save_sql == True:
+            write_sql(output_dir, query, record['table'])
+        pending.append((record, 0, query, record['estimated_bytes']))
+    for plan in unpacked:
+        summary.append(plan['record'])
+        if plan['record']['status'] == 'failed':
+            print('Failed:', plan['record']['table'], plan['record']['error'])
+    tiers = {} # table -> precision tier of each profile field
+    keys = {}  # table -> cache key of its profile, None when it isn't cached
+    for record, shards, table_tiers, key in plans:
+        summary.append(record)
+        tiers[record['table']] = table_tiers
+        keys[record['table']]  = key
+        if shards == None:
+            print('Failed:', record['table'], record['error'])
+            continue
+        if save_sql == True:
+            write_sql(output_dir, ';\n'.join(query for query, total_bytes in shards), record['table'])
+
+        # tables that haven't changed since they were profiled don't run a query
+        table_profile = profile_cache.get(key) if run_query == True and key != None and refresh == False else None
+        if table_profile != None:
+            record['status']       = 'cached'
+            record['billed_bytes'] = 0
+            write_profile(table_profile, record['table'])
+            print('Profile of', record['table'], 'is unchanged, from the cache')
+            continue
+        pending.extend((record, index, query, total_bytes) for index, (query, total_bytes) in enumerate(shards))
+
+    if run_query == False:
+        for record, index, query, total_bytes in pending:
+            record['status'] = 'planned'
+        unpack_records(pack_records)
+        return summary
+
+    shard_profiles = {} # table -> the profile of each of its shards, None until the shard finishes
+    started = {}        # table -> when its first shard was submitted
+    running = []        # (job, record, shard index, estimated bytes)
+    reserved = 0        # estimated bytes of the running & waiting shards & billed bytes of the finished ones
+    while len(pending) > 0 or len(running) > 0:
+        # fill the free job slots, the whole table is checked against the limits when its first shard is submitted
+        while len(pending) > 0 and len(running) < max_jobs:
+            record, index, query, shard_bytes = pending.popleft()
+            if record['status'] == 'skipped':
+                continue
+            if record['status'] == 'failed':
+                reserved -= shard_bytes # another shard of the table failed, this one won't run
+                continue
+            if index == 0:
+                if record['estimated_bytes'] / 1073741824 > table_size_limit:
+                    record['status'] = 'skipped'
+                    record['error']  = 'over the table size limit'
+                    continue
+                if budget != None and reserved + record['estimated_bytes'] > budget:
+                    record['status'] = 'skipped'
+                    record['error']  = 'over the bytes budget'
+                    continue
+                reserved += record['estimated_bytes']
+                record['status']       = 'running'
+                record['billed_bytes'] = 0
+                shard_profiles[record['table']] = [None] * record['shards']
+                started[record['table']] = time.monotonic()
+            job_config = bigquery.QueryJobConfig(use_query_cache=False)
+            running.append((client.query(query, job_config=job_config), record, index, shard_bytes))
+
+        # collect the finished jobs, done() doesn't block on the query
+        still_running = []
+        for job, record, index, shard_bytes in running:
+            if job.done() == False:
+                still_running.append((job, record, index, shard_bytes))
+                continue
+            reserved -= shard_bytes
+            try:
+                if 'plans' in record:
+                    rows = [dict(row) for row in job.result()]
+                else:
+                    shard_profile = dict(list(job.result())[0])
+            except Exception as e:
+                if record['status'] != 'failed':
+                    record['status']  = 'failed'
+                    record['error']   = str(e)
+                    record['seconds'] = round(time.monotonic() - started[record['table']], 1)
+                    print('Failed:', record['table'], e)
+                continue
+            billed = job.total_bytes_billed or 0
+            reserved += billed
+            record['billed_bytes'] += billed
+            if record['status'] == 'failed':
+                continue
+            if 'plans' in record:
+                finish_pack(record, rows)
+                record['seconds'] = round(time.monotonic() - started[record['table']], 1)
+                print('Profiled', len(rows), 'tables of', record['table'], 'in', record['seconds'], 'seconds,', round(record['billed_bytes'] / 1073741824, 2), 'GB billed')
+                continue
+            shard_profiles[record['table']][index] = shard_profile
+            if None in shard_profiles[record['table']]:
+                continue
+
+            # the last shard finished, merge the shards in order into the table's profile
+            table_profile = {}
+            for shard_profile in shard_profiles.pop(record['table']):
+                table_profile.update(shard_profile)
+            if record['sample_rate'] != None:
+                table_profile = add_sample(table_profile, {'method': sample_method, 'rate': record['sample_rate']})
+            if record['skipped_columns'] != None:
+                table_profile['skipped_columns'] = record['skipped_columns']
+            table_profile = add_precision(table_profile, tiers[record['table']])
+            table_profile = clean_profile(table_profile)
+            if keys[record['table']] != None:
+                profile_cache.put(keys[record['table']], table_profile)
+            record['status']  = 'done'
+            record['seconds'] = round(time.monotonic() - started[record['table']], 1)
+            write_profile(table_profile, record['table'])
+            print('Profiled', record['table'], 'in', record['seconds'], 'seconds,', round(record['billed_bytes'] / 1073741824, 2), 'GB billed')
+        if len(still_running) == len(running) and len(running) > 0:
+            time.sleep(poll_seconds)
+        running = still_running
+
+    # failed tables are charged for the shards that finished
+    unpack_records(pack_records)
+    for record in summary:
+        if record['billed_bytes'] != None:
+            record['cost'] = round(record['billed_bytes'] / 1099511627776 * price_per_tb, 4)
+
+    return summary
+
+
+def write_profile(table_profile, table_name=None):
+    """
+    Save the profile to CSV, JSON or display it in the terminal
+    """
+    if save_csv == True:
+        write_csv(output_dir, table_profile, table_name)
+    if save_json == True:
+        write_json(output_dir, table_profile, table_name)
+    if show_profile == True:
+        prt(table_profile)
+
+
+def write_summary(output_dir, summary):
+    """
+    Print the batch summary & save it to profile_summary.csv
+    """
+    print('{:<50} {:<8} {:>10} {:>10} {:>8}  {}'.format('table', 'status', 'est. GB', 'billed GB', 'cost', 'error'))
+    for record in summary:
+        print('{:<50} {:<8} {:>10} {:>10} {:>8}  {}'.format(record['table'], record['status'],
+              round(record['estimated_bytes'] / 1073741824, 2) if record['estimated_bytes'] != None else '',
+              round(record['billed_bytes'] / 1073741824, 2) if record['billed_bytes'] != None else '',
+              record['cost'] if record['cost'] != None else '', record['error'] or ''))
+
+    failed = [record for record in summary if record['status'] in ['failed', 'skipped']]
+    total_cost = sum(record['cost'] or 0 for record in summary)
+    print(len(summary) - len(failed), 'of', len(summary), 'tables profiled, cost', round(total_cost, 2))
+
+    summary_path_filename = output_dir + '/' + 'profile_summary.csv'
+    with open(summary_path_filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(summary[0].keys()) if len(summary) > 0 else ['table'])
+        writer.writeheader()
+        writer.writerows(summary)
+    print('Summary saved to:', summary_path_filename)
+
+
 def main():
     """
     Runs the script
     """
 
     global project, table_project, dataset_tablename, output_dir, table_size_limit, run_query
-    global save_sql, save_csv, save_json, show_sql, show_profile, sample_data
+    global save_sql, save_csv, save_json, show_sql, show_profile, sample_data, max_jobs, bytes_budget, price_per_tb
+    global shard_expressions, shard_gb, sample_method, incremental_dataset, precision, refresh, profile_cache
+    global column_budget, priority_columns, partition_format, pack_tables, pack_gb
+
+    args = parser.parse_args()
+    if args.project == None and args.local_file == None:
+        parser.error('-p/--project is required unless --local_file is set')
+    project           = args.project
+    table_project     = args.table_project
+    dataset_tablename = args.dataset_tablename
+    output_dir        = args.output_dir
+    table_size_limit  = args.table_size_limit
+    run_query         = args.run_query
+    save_sql          = args.save_sql
+    save_csv          = args.save_csv
+    save_json         = args.save_json
+    show_sql          = args.show_sql
+    show_profile      = args.show_profile
+    sample_data       = args.sample_data
+    sample_method     = args.sample_method
+    max_jobs          = args.max_jobs
+    bytes_budget      = args.bytes_budget
+    price_per_tb      = args.price_per_tb
+    precision         = args.precision
+    refresh           = args.refresh
+    shard_expressions = args.shard_expressions
+    shard_gb          = args.shard_gb
+    incremental_dataset = args.incremental_dataset
+    column_budget     = args.column_budget
+    priority_columns  = args.priority_columns.split(',') if args.priority_columns != None else None
+    partition_format  = args.partition_format
+    pack_tables       = args.pack_tables
+    pack_gb           = args.pack_gb
 
     if table_project == None:
         table_project = project
-
-    # Generate query  &  perform a dry run
+    if args.cache_dir != '':
+        profile_cache = ProfileCache(args.cache_dir, args.cache_mb * 1048576)
+    if incremental_dataset != None and sample_data != None:
+        sys.exit('--incremental_dataset profiles every row of the changed partitions, it can not be used with -S')
+    if incremental_dataset != None and args.per_partition == True:
+        sys.exit('--per_partition profiles every partition, it can not be used with --incremental_dataset')
+    if incremental_dataset != None and precision == 'minimal':
+        sys.exit('--incremental_dataset keeps HLL++ & KLL sketches of every partition, it can not be used with --precision minimal')
+
+    if args.local_file != None:
+        if pyarrow == None:
+            sys.exit('--local_file needs pyarrow & numpy: pip install pyarrow numpy')
+        if True not in [save_csv, save_json, show_profile]:
+            sys.exit('Set -c CSV, -j JSON or -D to save or display the profile')
+        table_profile = clean_profile(profile_local(args.local_file))
+        write_profile(table_profile, os.path.basename(args.local_file))
+        return
+
+    if args.dataset != None or args.tables_glob != None or args.tables_file != None:
+        if incremental_dataset != None or args.per_partition == True:
+            sys.exit('--incremental_dataset & --per_partition profile one table, set -t/--dataset_tablename')
+        tables = batch_tables(client_factory(project=table_project), args.dataset, args.tables_glob, args.tables_file)
+        summary = profile_batch(tables)
+        write_summary(output_dir, summary)
+        return
+
+    if dataset_tablename == None:
+        sys.exit('Set -t/--dataset_tablename, or --dataset, --tables_glob or --tables_file for batch mode')
+
+    if incremental_dataset != None:
+        fields_ls, unnest_cols = get_schema(table_project, dataset_tablename)
+        run_incremental(sql_cols(fields_ls), unnest_cols)
+        return
+
+    if args.per_partition == True:
+        if partition_format == 'parquet' and pyarrow == None:
+            sys.exit('--partition_format parquet needs pyarrow: pip install pyarrow numpy')
+        fields_ls, unnest_cols = get_schema(table_project, dataset_tablename)
+        sql_cols_dic = sql_cols(fields_ls)
+        skipped = None
+        if column_budget != None:
+            sql_cols_dic, skipped = plan_columns(sql_cols_dic, unnest_cols, sample=sample_plan(table_project + '.' + dataset_tablename))
+            if len(skipped) > 0:
+                print('Skipped columns:', ', '.join('{} ({} GB)'.format(alias_name, round(total_bytes / 1073741824, 2)) for alias_name, total_bytes in skipped))
+        run_per_partition(sql_cols_dic, unnest_cols, skipped)
+        return
+
+    # Generate the column shard queries  &  perform a dry run of each
     fields_ls, unnest_cols = get_schema(table_project, dataset_tablename)
     sql_cols_dic = sql_cols(fields_ls)
-    query = sql_gen(sql_cols_dic, unnest_cols)
-    total_bytes, total_megabytes, total_gigabytes = get_estimate(project, query)
+    sample = sample_plan(table_project + '.' + dataset_tablename)
+    skipped = None
+    if column_budget != None:
+        sql_cols_dic, skipped = plan_columns(sql_cols_dic, unnest_cols, sample=sample)
+        if len(skipped) > 0:
+            print('Skipped columns:', ', '.join('{} ({} GB)'.format(alias_name, round(total_bytes / 1073741824, 2)) for alias_name, total_bytes in skipped))
+    shards = shard_queries(sql_cols_dic, unnest_cols, sample=sample)
+    queries = [query for query, shard_bytes in shards]
+    query = ';\n'.join(queries)
+    total_bytes = sum(shard_bytes for query, shard_bytes in shards)
+    total_megabytes = int(total_bytes / 1048576)
+    total_gigabytes = round(total_bytes / 1073741824, 2)
+    if len(shards) > 1:
+        print('Column shards:', len(shards))
+    if sample != None:
+        print('Sample rate:', round(sample['rate'], 4), '({})'.format(sample['method']))
     print('KB: {}\nMB: {}\nGB: {}'.format(total_bytes, total_megabytes, total_gigabytes))
 
     # Write SQL query to a local file
@@ -433,26 +2155,30 @@ def main():
         print('Display query', query)
 
         
+    # the cached profile when the table & the query haven't changed since it was profiled
+    key = None
+    if profile_cache != None and run_query == True and True in [save_csv, save_json, show_profile]:
+        key = cache_key(table_project + '.' + dataset_tablename, queries)
+        table_profile = profile_cache.get(key) if key != None and refresh == False else None
+        if table_profile != None:
+            print('Table is unchanged, profile from the cache')
+            write_profile(table_profile)
+            return
+
     # run query if it does not exceed the table size limit
     if total_gigabytes <= table_size_limit and run_query == True and True in [save_csv, save_json, show_profile]:
-        table_profile = run_profiler(query)
-        # Replace any values tht can't be serialized to JSON
-        for k, v in table_profile.items():
-            if 'sum' in k:
-                table_profile[k] = int(v.to_eng_string())
-            elif v == float('inf'):
-                table_profile[k] = None
-            elif isinstance(v, datetime.datetime) == True:
-                table_profile[k] = v.isoformat()
+        table_profile = run_profiler(queries)
+        if sample != None:
+            table_profile = add_sample(table_profile, sample)
+        if skipped != None:
+            table_profile = add_skipped(table_profile, skipped)
+        table_profile = add_precision(table_profile, field_precision(sql_cols_dic))
+        table_profile = clean_profile(table_profile)
+        if key != None:
+            profile_cache.put(key, table_profile)
         
         # save the query results to CSV, JSON or display in the terminal
-        
-        if save_csv == True:
-            write_csv(output_dir, table_profile)
-        if save_json == True:
-            write_json(output_dir, table_profile)
-        if show_profile == True:
-            prt(table_profile)
+        write_profile(table_profile)
     else:
         print('Query did not run')
 